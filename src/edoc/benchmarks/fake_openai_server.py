@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from edoc.gpt_helpers.rate_limiter import TokenBucket, estimate_request_cost
+
+#A local stand in for the OpenAI API that enforces its own RPM and TPM limits and answers 429s
+#with the same headers OpenAI sends, for checking the rate limit scheduler without an account.
+#Run the comparison with: python -m edoc.benchmarks.fake_openai_server --bulk-workers 16 --chat-workers 2
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, rpm_limit=600, tpm_limit=60000, latency=0.05, burst_seconds=1.0):
+        """
+        Serve /v1/chat/completions and /v1/embeddings on localhost.
+
+        Like OpenAI, the per minute limits are enforced over short windows, so a burst of more than
+        burst_seconds worth of budget is answered with 429s even when the minute is not used up.
+
+        Args:
+            port (int): Port to listen on, 0 picks a free one.
+            rpm_limit (int): Requests per minute per model before answering 429.
+            tpm_limit (int): Tokens per minute per model before answering 429.
+            latency (float): Seconds each successful request takes.
+            burst_seconds (float): Seconds of budget that may be spent at once. Default is 1.
+        """
+        super().__init__(("127.0.0.1", port), _FakeOpenAIHandler)
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.latency = latency
+        self.burst_seconds = burst_seconds
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counts = {"ok": 0, "rate_limited": 0}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def admit(self, model, tokens):
+        """
+        Take the request from the model's buckets if they allow it.
+
+        Returns:
+            tuple: (admitted, headers), headers carry the x-ratelimit-* values and retry-after-ms on a 429.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if model not in self.buckets:
+                self.buckets[model] = (
+                    TokenBucket(max(1, int(self.rpm_limit * self.burst_seconds / 60)), period_seconds=self.burst_seconds),
+                    TokenBucket(max(1, int(self.tpm_limit * self.burst_seconds / 60)), period_seconds=self.burst_seconds),
+                )
+            requests, token_bucket = self.buckets[model]
+
+            wait = max(requests.wait_time(1, now), token_bucket.wait_time(tokens, now))
+            admitted = wait == 0
+            if admitted:
+                requests.take(1, now)
+                token_bucket.take(tokens, now)
+                self.counts["ok"] += 1
+            else:
+                self.counts["rate_limited"] += 1
+
+            #Remaining budgets are reported per minute, like the limits
+            scale = 60 / self.burst_seconds
+            headers = {
+                "x-ratelimit-limit-requests": str(self.rpm_limit),
+                "x-ratelimit-limit-tokens": str(self.tpm_limit),
+                "x-ratelimit-remaining-requests": str(max(int(requests.level * scale), 0)),
+                "x-ratelimit-remaining-tokens": str(max(int(token_bucket.level * scale), 0)),
+                "x-ratelimit-reset-requests": f"{60.0 / self.rpm_limit:.3f}s",
+                "x-ratelimit-reset-tokens": f"{max(tokens, 1) * 60.0 / self.tpm_limit:.3f}s",
+            }
+            if not admitted:
+                headers["retry-after-ms"] = str(int(wait * 1000) + 1)
+            return admitted, headers
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status, payload, headers):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        model, tokens = estimate_request_cost(body)
+
+        if not self.path.endswith(("/chat/completions", "/embeddings")):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, {})
+            return
+
+        admitted, headers = self.server.admit(model, tokens)
+        if not admitted:
+            self._send_json(429, {
+                "error": {
+                    "message": f"Rate limit reached for {model}.",
+                    "type": "requests",
+                    "code": "rate_limit_exceeded",
+                }
+            }, headers)
+            return
+
+        time.sleep(self.server.latency)
+        payload = json.loads(body)
+
+        if self.path.endswith("/embeddings"):
+            inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+            self._send_json(200, {
+                "object": "list",
+                "model": model,
+                "data": [{"object": "embedding", "index": i, "embedding": [0.0] * 8} for i in range(len(inputs))],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }, headers)
+            return
+
+        answer = "Fake answer."
+        self._send_json(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": tokens, "completion_tokens": 3, "total_tokens": tokens + 3},
+        }, headers)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_openai_server(port=0, rpm_limit=600, tpm_limit=60000, latency=0.05, burst_seconds=1.0):
+    """
+    Start a FakeOpenAIServer on a background thread, see FakeOpenAIServer for the arguments.
+
+    Returns:
+        FakeOpenAIServer: The running server, call shutdown() to stop it.
+    """
+    server = FakeOpenAIServer(port=port, rpm_limit=rpm_limit, tpm_limit=tpm_limit, latency=latency, burst_seconds=burst_seconds)
+    threading.Thread(target=server.serve_forever, name="edoc-fake-openai", daemon=True).start()
+    return server
+
+def run_traffic(bulk_workers, bulk_requests, chat_workers, chat_requests):
+    """
+    Send bulk and chat completions at the same time through create_chat_completion.
+
+    Returns:
+        dict: Latencies per priority and the failures.
+    """
+    from edoc.gpt_helpers.gpt_basics import create_chat_completion
+    from edoc.gpt_helpers.rate_limiter import request_priority
+
+    latencies = {"chat": [], "bulk": []}
+    failures = []
+    lock = threading.Lock()
+
+    def worker(priority, count):
+        with request_priority(priority):
+            for i in range(count):
+                start = time.perf_counter()
+                try:
+                    create_chat_completion([{"role": "user", "content": f"{priority} request {i} " + "word " * 200}])
+                    with lock:
+                        latencies[priority].append(time.perf_counter() - start)
+                except Exception as e:
+                    with lock:
+                        failures.append(f"{type(e).__name__}: {e}")
+
+    threads = [threading.Thread(target=worker, args=("bulk", bulk_requests)) for _ in range(bulk_workers)]
+    #Chat starts once bulk traffic has filled the budgets
+    threads += [threading.Timer(1.0, worker, args=("chat", chat_requests)) for _ in range(chat_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {"latencies": latencies, "failures": failures}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the OpenAI rate limit scheduler against a local server that answers 429s.")
+    parser.add_argument("--rpm", type=int, default=300, help="Requests per minute the fake server allows.")
+    parser.add_argument("--tpm", type=int, default=200000, help="Tokens per minute the fake server allows.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per successful request.")
+    parser.add_argument("--bulk-workers", type=int, default=16, help="Threads sending bulk (ingestion) requests.")
+    parser.add_argument("--bulk-requests", type=int, default=5, help="Requests per bulk thread.")
+    parser.add_argument("--chat-workers", type=int, default=2, help="Threads sending chat requests.")
+    parser.add_argument("--chat-requests", type=int, default=3, help="Requests per chat thread.")
+    parser.add_argument("--no-scheduler", action="store_true", help="Use the OpenAI client's own retries instead of the scheduler.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+
+    server = start_fake_openai_server(rpm_limit=args.rpm, tpm_limit=args.tpm, latency=args.latency)
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+    os.environ["EDOC_MODEL_BACKEND"] = "openai"
+    os.environ["EDOC_RATE_LIMITER"] = "false" if args.no_scheduler else "true"
+
+    start = time.perf_counter()
+    result = run_traffic(args.bulk_workers, args.bulk_requests, args.chat_workers, args.chat_requests)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    from edoc.gpt_helpers.rate_limiter import get_scheduler
+
+    def percentiles(values):
+        if not values:
+            return None
+        p50, p95 = np.percentile(values, [50, 95])
+        return {"count": len(values), "p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1)}
+
+    completed = sum(len(values) for values in result["latencies"].values())
+    report = {
+        "scheduler": not args.no_scheduler,
+        "elapsed_seconds": round(elapsed, 3),
+        "completed": completed,
+        "failed": len(result["failures"]),
+        "throughput_rps": round(completed / elapsed, 3),
+        "server_429s": server.counts["rate_limited"],
+        "chat_latency": percentiles(result["latencies"]["chat"]),
+        "bulk_latency": percentiles(result["latencies"]["bulk"]),
+        "scheduler_stats": get_scheduler().stats() if not args.no_scheduler else None,
+        "sample_failures": result["failures"][:3],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'Scheduler' if report['scheduler'] else 'Client retries only'}: {completed} completed, {report['failed']} failed "
+              f"in {report['elapsed_seconds']}s ({report['throughput_rps']} req/s), {report['server_429s']} 429s from the server")
+        print(f"Chat latency: {report['chat_latency']}")
+        print(f"Bulk latency: {report['bulk_latency']}")
+        for failure in report["sample_failures"]:
+            print(f"Failure: {failure}")
+
+    return 0 if report["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
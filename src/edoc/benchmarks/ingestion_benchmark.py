@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+from datetime import datetime
+
+#Build a synthetic repo of a chosen size and shape and time CodebaseGraph.create_graph on it, stage by
+#stage, against Neo4j and the local stand in models. The JSON report can be diffed between runs.
+#Run with: python -m edoc.benchmarks.ingestion_benchmark --files 200 --depth 3 --json --output run.json
+
+#Extensions and code templates per language. Every template takes the same fields so any
+#language can be mixed in; Python is what the stand in entity extractor understands best.
+LANGUAGE_TEMPLATES = {
+    "python": {
+        "extension": ".py",
+        "header": "import os\nfrom collections import {import_name}\n\n",
+        "class": "class {class_name}({base}):\n    \"\"\"{doc}\"\"\"\n\n",
+        "function": "def {function_name}({parameters}):\n    \"\"\"{doc}\"\"\"\n{body}    return {result}\n\n",
+        "statement": "    {variable} = {expression}\n",
+    },
+    "javascript": {
+        "extension": ".js",
+        "header": "import {{ {import_name} }} from './{module}';\n\n",
+        "class": "// {doc}\nclass {class_name} extends {base} {{}}\n\n",
+        "function": "// {doc}\nfunction {function_name}({parameters}) {{\n{body}  return {result};\n}}\n\n",
+        "statement": "  const {variable} = {expression};\n",
+    },
+    "go": {
+        "extension": ".go",
+        "header": "package {module}\n\nimport \"{import_name}\"\n\n",
+        "class": "// {doc}\ntype {class_name} struct {{ {base} }}\n\n",
+        "function": "// {doc}\nfunc {function_name}({parameters}) int {{\n{body}  return {result}\n}}\n\n",
+        "statement": "  {variable} := {expression}\n",
+    },
+    "java": {
+        "extension": ".java",
+        "header": "import java.util.{import_name};\n\n",
+        "class": "/** {doc} */\nclass {class_name} extends {base} {{}}\n\n",
+        "function": "/** {doc} */\nstatic int {function_name}({parameters}) {{\n{body}  return {result};\n}}\n\n",
+        "statement": "  int {variable} = {expression};\n",
+    },
+}
+
+_WORDS = [
+    "graph", "chunk", "summary", "index", "vector", "parse", "token", "cache", "node", "edge",
+    "query", "batch", "store", "load", "route", "merge", "split", "embed", "score", "rank",
+]
+
+def parse_language_mix(text):
+    """
+    Parse a language mix like 'python=0.6,javascript=0.3,go=0.1' into normalized weights.
+
+    Raises:
+        ValueError: If a language has no template or the weights do not add up to more than 0.
+    """
+    mix = {}
+    for part in text.split(","):
+        language, _, weight = part.partition("=")
+        language = language.strip().lower()
+        if language not in LANGUAGE_TEMPLATES:
+            raise ValueError(f"Unknown language [{language}], choose from {', '.join(LANGUAGE_TEMPLATES)}")
+        mix[language] = float(weight or 1)
+
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("The language weights must add up to more than 0")
+    return {language: weight / total for language, weight in mix.items()}
+
+def _name(rng, parts=2):
+    return "_".join(rng.choice(_WORDS) for _ in range(parts))
+
+def _source_file(rng, template, functions_per_file, function_lines):
+    """
+    Generate one source file: a header, a class, then functions of about function_lines lines each.
+    """
+    doc = lambda: f"{_name(rng, 3).replace('_', ' ').capitalize()}."
+    parts = [
+        template["header"].format(import_name=_name(rng, 1).capitalize(), module=_name(rng, 1)),
+        template["class"].format(class_name=_name(rng).title().replace("_", ""), base=_name(rng, 1).capitalize(), doc=doc()),
+    ]
+
+    for _ in range(functions_per_file):
+        #Vary each function's length around the target so chunk sizes are not all the same
+        lines = max(1, int(rng.gauss(function_lines, function_lines / 4)))
+        body = "".join(
+            template["statement"].format(variable=f"{_name(rng, 1)}_{i}", expression=f"{rng.randint(0, 999)} + {rng.randint(0, 999)}")
+            for i in range(lines)
+        )
+        parts.append(template["function"].format(
+            function_name=_name(rng),
+            parameters=", ".join(_name(rng, 1) for _ in range(rng.randint(0, 3))),
+            body=body,
+            result=rng.randint(0, 9),
+            doc=doc(),
+        ))
+    return "".join(parts)
+
+def generate_synthetic_repo(root, files=100, depth=3, fanout=3, languages="python=1", functions_per_file=5,
+                            function_lines=20, duplicate_ratio=0.0, seed=0):
+    """
+    Write a synthetic codebase to root, the same one every time for the same arguments.
+
+    Args:
+        root (str): Directory to create the repo in, it must not exist yet.
+        files (int): Number of source files.
+        depth (int): Levels of directories below root.
+        fanout (int): Subdirectories per directory.
+        languages (str | dict): Language mix, e.g. 'python=0.6,javascript=0.4'.
+        functions_per_file (int): Functions in each file.
+        function_lines (int): Mean lines per function, sets the file and chunk lengths.
+        duplicate_ratio (float): Share of files that are copies of an earlier file, as vendored or generated code is.
+        seed (int): Seed for the random generator.
+
+    Returns:
+        dict: The repo's shape: files, directories, bytes, duplicates and files per language.
+    """
+    rng = random.Random(seed)
+    mix = parse_language_mix(languages) if isinstance(languages, str) else languages
+
+    #Every directory down to depth, files are spread over all of them
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"{_name(rng, 1)}_{i}") for parent in level for i in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        os.makedirs(directory)
+
+    written = {language: [] for language in mix}
+    per_language = {language: 0 for language in mix}
+    duplicates = 0
+    total_bytes = 0
+    for i in range(files):
+        language = rng.choices(list(mix), weights=list(mix.values()))[0]
+        template = LANGUAGE_TEMPLATES[language]
+
+        if written[language] and rng.random() < duplicate_ratio:
+            contents = rng.choice(written[language])
+            duplicates += 1
+        else:
+            contents = _source_file(rng, template, functions_per_file, function_lines)
+            written[language].append(contents)
+
+        path = os.path.join(rng.choice(directories), f"{_name(rng, 1)}_{i}{template['extension']}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(contents)
+        per_language[language] += 1
+        total_bytes += len(contents.encode("utf-8"))
+
+    return {
+        "files": files,
+        "directories": len(directories),
+        "bytes": total_bytes,
+        "duplicates": duplicates,
+        "files_per_language": per_language,
+    }
+
+def _kind_totals(tracer):
+    """
+    Calls, seconds and tokens per span kind (cypher, llm, embedding) so far.
+    """
+    totals = {}
+    for key, entry in tracer.summary().items():
+        kind = key.split(":", 1)[0]
+        kind_totals = totals.setdefault(kind, {"count": 0, "seconds": 0.0, "tokens_in": 0, "tokens_out": 0})
+        for name in kind_totals:
+            kind_totals[name] += entry[name]
+    return totals
+
+def _rate(count, seconds):
+    return round(count / seconds, 3) if seconds > 0 else None
+
+def run_ingestion_benchmark(repo_root, project_id, tracer, chunk_size=3500):
+    """
+    Build the graph for repo_root and measure each stage.
+
+    Args:
+        repo_root (str): The codebase to ingest.
+        project_id (str): The project to build it under, rebuilt from scratch if it exists.
+        tracer (Tracer): The active tracer, its Cypher, LLM and embedding spans are counted per stage.
+        chunk_size (int): Chunk size passed to CodebaseGraph.
+
+    Returns:
+        dict: Total seconds, the build's counters, and per stage seconds, units done, throughput,
+            Cypher round trips and model calls.
+    """
+    #Imported here so the backend environment variables are set first
+    from edoc.kg_construction.bulk_load import CodebaseGraph
+    from edoc.kg_construction.build_tools.progress import IngestionProgress
+
+    class BenchmarkProgress(IngestionProgress):
+        """
+        IngestionProgress that also takes the tracer's per kind totals at every stage boundary.
+        """
+        def __init__(self):
+            super().__init__()
+            self.stage_calls = []
+            self._calls_at_start = _kind_totals(tracer)
+
+        def _close_stage(self):
+            if self._stage is None:
+                return
+            now = _kind_totals(tracer)
+            self.stage_calls.append({
+                kind: {name: now[kind][name] - self._calls_at_start.get(kind, {}).get(name, 0) for name in now[kind]}
+                for kind in now
+            })
+            self._calls_at_start = now
+
+        def start_stage(self, stage, total=None):
+            self._close_stage()
+            super().start_stage(stage, total=total)
+
+        def finish(self):
+            self._close_stage()
+            super().finish()
+
+    progress = BenchmarkProgress()
+    start = time.perf_counter()
+    graph = CodebaseGraph(root_directory=repo_root, project_id=project_id, chunk_size=chunk_size)
+    graph.create_graph(progress=progress, reload=True)
+    elapsed = time.perf_counter() - start
+
+    snapshot = progress.snapshot()
+    counters = snapshot["counters"]
+    stages = []
+    for stage, calls in zip(snapshot["finished_stages"], progress.stage_calls):
+        seconds = stage["seconds"]
+        cypher = calls.get("cypher", {}).get("count", 0)
+        llm = calls.get("llm", {}).get("count", 0)
+        embedding = calls.get("embedding", {}).get("count", 0)
+        stages.append({
+            "stage": stage["stage"],
+            "seconds": round(seconds, 3),
+            "done": stage["done"],
+            "units_per_second": _rate(stage["done"], seconds),
+            "cypher_round_trips": cypher,
+            "cypher_seconds": round(calls.get("cypher", {}).get("seconds", 0.0), 3),
+            "llm_calls": llm,
+            "embedding_calls": embedding,
+            "api_calls": llm + embedding,
+            "tokens_in": sum(kind.get("tokens_in", 0) for kind in calls.values()),
+            "tokens_out": sum(kind.get("tokens_out", 0) for kind in calls.values()),
+        })
+
+    totals = _kind_totals(tracer)
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "files_per_second": _rate(counters.get("files_chunked", 0), elapsed),
+        "chunks_per_second": _rate(counters.get("chunks_summarized", 0), elapsed),
+        "cypher_round_trips": totals.get("cypher", {}).get("count", 0),
+        "api_calls": totals.get("llm", {}).get("count", 0) + totals.get("embedding", {}).get("count", 0),
+        "counters": counters,
+        "stages": stages,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time graph ingestion of a synthetic repo, stage by stage.")
+    parser.add_argument("--files", type=int, default=100, help="Number of source files.")
+    parser.add_argument("--depth", type=int, default=3, help="Levels of directories.")
+    parser.add_argument("--fanout", type=int, default=3, help="Subdirectories per directory.")
+    parser.add_argument("--languages", type=str, default="python=0.7,javascript=0.2,go=0.1", help="Language mix, e.g. 'python=0.6,java=0.4'.")
+    parser.add_argument("--functions-per-file", type=int, default=5, help="Functions in each file.")
+    parser.add_argument("--function-lines", type=int, default=20, help="Mean lines per function, sets chunk lengths.")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="Share of files that copy an earlier file.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic repo.")
+    parser.add_argument("--chunk-size", type=int, default=3500, help="Chunk size passed to CodebaseGraph.")
+    parser.add_argument("--repo-dir", type=str, default=None, help="Where to generate the repo. Defaults to a temporary directory.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated repo and its project in the graph.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--output", type=str, default=None, help="Also write the JSON report to this file.")
+    args = parser.parse_args(argv)
+
+    os.environ["EDOC_MODEL_BACKEND"] = "local"
+    #The stand in graph stores nothing, so no file would ever be chunked; ingestion needs a real Neo4j
+    os.environ["EDOC_GRAPH_BACKEND"] = "neo4j"
+
+    from edoc.monitoring.tracing import enable_tracing
+    tracer = enable_tracing()
+
+    parent = args.repo_dir or tempfile.mkdtemp(prefix="edoc-ingestion-benchmark-")
+    repo_root = os.path.join(parent, f"synthetic_repo_{args.seed}")
+    project_id = f"benchmark-{args.seed}"
+
+    repo = generate_synthetic_repo(
+        repo_root,
+        files=args.files,
+        depth=args.depth,
+        fanout=args.fanout,
+        languages=args.languages,
+        functions_per_file=args.functions_per_file,
+        function_lines=args.function_lines,
+        duplicate_ratio=args.duplicate_ratio,
+        seed=args.seed,
+    )
+
+    #Kept in the report so runs can be compared like for like
+    config = {key: value for key, value in vars(args).items() if key not in ("json", "output", "keep", "repo_dir")}
+
+    try:
+        result = run_ingestion_benchmark(repo_root, project_id, tracer, chunk_size=args.chunk_size)
+        error = None
+    except Exception as e:
+        result = None
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        if not args.keep:
+            shutil.rmtree(parent if not args.repo_dir else repo_root, ignore_errors=True)
+
+    if result is not None and not args.keep:
+        from edoc.gpt_helpers.connect import connect_to_neo4j
+        from edoc.kg_construction.build_tools.projects import delete_project
+        delete_project(connect_to_neo4j(), project_id)
+
+    report = {
+        "benchmark": "ingestion",
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "config": config,
+        "repo": repo,
+        "result": result,
+        "error": error,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif error:
+        print(f"Benchmark failed: {error}")
+    else:
+        print(f"{repo['files']} files ({repo['bytes']} bytes, {repo['duplicates']} duplicates) in {result['elapsed_seconds']}s: "
+              f"{result['files_per_second']} files/s, {result['chunks_per_second']} chunks/s, "
+              f"{result['cypher_round_trips']} Cypher round trips, {result['api_calls']} API calls")
+        for stage in result["stages"]:
+            print(f"  {stage['stage']}: {stage['seconds']}s, {stage['done']} done ({stage['units_per_second']}/s), "
+                  f"{stage['cypher_round_trips']} Cypher, {stage['api_calls']} API calls")
+
+    return 0 if error is None else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+import numpy as np
+
+#Simulated users drive the chatbot handler directly, against the local stand in model and graph by default.
+#Run with: python -m edoc.benchmarks.load_generator --users 20 --questions-per-user 5
+
+QUESTION_TEMPLATES = [
+    "What is the purpose of the {name} module?",
+    "What parameters does {name}() take?",
+    "How is the {name} folder organized?",
+    "Which class implements {name} and what does it return?",
+    "Explain how {name} is called during ingestion.",
+]
+
+class FakeRequest:
+    """
+    Stands in for gr.Request, the handler only reads session_hash.
+    """
+    def __init__(self, session_hash):
+        self.session_hash = session_hash
+
+def build_questions(user, count, allow_cache_hits=False):
+    """
+    Questions for one simulated user.
+
+    Args:
+        user (int): The user number.
+        count (int): How many questions.
+        allow_cache_hits (bool): If True every user asks the same questions, so the answer cache serves most of them.
+            Otherwise each question is unique and every answer is computed.
+
+    Returns:
+        list: The questions.
+    """
+    questions = []
+    for i in range(count):
+        template = QUESTION_TEMPLATES[i % len(QUESTION_TEMPLATES)]
+        name = f"component_{i}" if allow_cache_hits else f"component_u{user}_q{i}"
+        questions.append(template.format(name=name))
+    return questions
+
+async def simulate_user(aresponse, user, questions, mode, think_time, results):
+    """
+    Ask each question in turn, waiting think_time seconds between answers like a person reading.
+    Records latency, time to first token and the final answer length per question.
+    """
+    request = FakeRequest(f"load-user-{user}")
+
+    for question in questions:
+        start = time.perf_counter()
+        first_token = None
+        answer = ""
+        error = None
+
+        try:
+            async for partial in aresponse(question, [], mode=mode, request=request):
+                if first_token is None and not partial.startswith("_"):
+                    first_token = time.perf_counter() - start
+                answer = partial
+        except Exception as e:
+            error = str(e)
+
+        results.append({
+            "user": user,
+            "latency": time.perf_counter() - start,
+            "ttft": first_token,
+            "answer_chars": len(answer),
+            "error": error or (answer if answer.startswith("Error") else None),
+        })
+
+        if think_time > 0:
+            await asyncio.sleep(think_time)
+
+def percentiles(values):
+    """
+    p50, p95 and p99 of the values in milliseconds, or None if there are none.
+    """
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1), "p99_ms": round(p99 * 1000, 1)}
+
+async def run_load(users, questions_per_user, mode="combine", think_time=0.0, allow_cache_hits=False):
+    """
+    Run the simulated users together and summarize the results.
+
+    Args:
+        users (int): Number of simulated users.
+        questions_per_user (int): Questions each user asks.
+        mode (str): Answer mode, 'combine' or 'single_pass'.
+        think_time (float): Seconds each user waits between questions.
+        allow_cache_hits (bool): Let users share questions, see build_questions.
+
+    Returns:
+        dict: Throughput, latency and time to first token percentiles, errors, and per user completions.
+    """
+    #Imported here so the backend environment variables are set first
+    from edoc.chatbot_components.utils import aresponse, warm_up_responder
+    from edoc.chatbot_components.serving import chat_limiter
+
+    await asyncio.to_thread(warm_up_responder)
+
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        simulate_user(aresponse, user, build_questions(user, questions_per_user, allow_cache_hits), mode, think_time, results)
+        for user in range(users)
+    ])
+    elapsed = time.perf_counter() - start
+
+    completed = [result for result in results if result["error"] is None]
+    per_user = [sum(1 for result in completed if result["user"] == user) for user in range(users)]
+
+    return {
+        "users": users,
+        "questions_per_user": questions_per_user,
+        "mode": mode,
+        "chat_concurrency": chat_limiter.total_limit,
+        "per_user_concurrency": chat_limiter.per_user_limit,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": len(results),
+        "errors": len(results) - len(completed),
+        "throughput_rps": round(len(completed) / elapsed, 3) if elapsed > 0 else None,
+        "latency": percentiles([result["latency"] for result in completed]),
+        "time_to_first_token": percentiles([result["ttft"] for result in completed if result["ttft"] is not None]),
+        "per_user_completed": {"min": min(per_user, default=0), "max": max(per_user, default=0)},
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the chatbot with simulated concurrent users.")
+    parser.add_argument("--users", type=int, default=10, help="Number of simulated users.")
+    parser.add_argument("--questions-per-user", type=int, default=3, help="Questions each user asks.")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds each user waits between questions.")
+    parser.add_argument("--mode", choices=["combine", "single_pass"], default="combine", help="Answer mode.")
+    parser.add_argument("--models", choices=["local", "openai"], default="local", help="Use the stand in models or OpenAI.")
+    parser.add_argument("--graph", choices=["local", "neo4j"], default="local", help="Use the stand in graph or Neo4j.")
+    parser.add_argument("--allow-cache-hits", action="store_true", help="Let users ask the same questions.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args(argv)
+
+    os.environ["EDOC_MODEL_BACKEND"] = args.models
+    os.environ["EDOC_GRAPH_BACKEND"] = args.graph
+    #Status lines would count as the first token
+    os.environ.setdefault("EDOC_SHOW_RETRIEVAL_STATUS", "false")
+
+    report = asyncio.run(run_load(
+        users=args.users,
+        questions_per_user=args.questions_per_user,
+        mode=args.mode,
+        think_time=args.think_time,
+        allow_cache_hits=args.allow_cache_hits
+    ))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['requests']} requests from {report['users']} users in {report['elapsed_seconds']}s "
+              f"({report['throughput_rps']} req/s, {report['errors']} errors)")
+        print(f"Concurrency: {report['chat_concurrency']} total, {report['per_user_concurrency']} per user")
+        print(f"Latency: {report['latency']}")
+        print(f"Time to first token: {report['time_to_first_token']}")
+        print(f"Completed per user: {report['per_user_completed']}")
+
+    return 0 if report["errors"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
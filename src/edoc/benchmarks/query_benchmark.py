@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+from datetime import datetime
+
+from edoc.benchmarks.load_generator import percentiles
+from edoc.benchmarks.ingestion_benchmark import generate_synthetic_repo
+
+#Ask a fixed set of questions about a pinned fixture repo through both retrievers and the full answer
+#chain, with the local stand in models, and report cold and warm latency, Cypher queries, embedding
+#calls and context sizes per question. Several configurations can be run side by side.
+#Run with: python -m edoc.benchmarks.query_benchmark --config base:top_k=1 --config wide:top_k=5 --json
+
+#The fixture is generated from a fixed seed, so every run asks about the same code
+FIXTURE_REPO = {
+    "files": 60,
+    "depth": 2,
+    "fanout": 3,
+    "languages": "python=0.7,javascript=0.2,go=0.1",
+    "functions_per_file": 4,
+    "function_lines": 12,
+    "duplicate_ratio": 0.1,
+    "seed": 49,
+}
+FIXTURE_PROJECT_ID = "query-benchmark-fixture"
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "edoc_query_benchmark", "fixture_repo")
+
+#Questions mix structure, entity and behaviour questions, using the fixture's vocabulary
+QUESTION_CORPUS = [
+    "How is the repository organized into folders?",
+    "Which folder holds the embedding code?",
+    "What does the graph_chunk function do?",
+    "What parameters does merge_split take?",
+    "What does the query_rank function return?",
+    "Which files define a class that extends Cache?",
+    "Which files import Token from collections?",
+    "Where is the summary index built?",
+    "Explain how batch loading works in this codebase.",
+    "Summarize the purpose of the vector_store code.",
+    "How are tokens parsed and scored?",
+    "What calls score_node and why?",
+]
+
+#What each question is run through
+BENCHMARK_TARGETS = ("dir_file_structured_retriever", "code_structured_retriever", "get_full_response")
+
+#Settings a --config may change, with their defaults
+DEFAULT_BENCHMARK_CONFIG = {
+    "top_k": 1,
+    "next_chunk_limit": 1,
+    "retrieval_backend": "neo4j",
+    "context_token_budget": 6000,
+    "mode": "combine",
+    "route": "auto",
+}
+
+def parse_config(text):
+    """
+    Parse a configuration like 'wide:top_k=5,retrieval_backend=local'.
+
+    Returns:
+        tuple: (name, settings), settings being DEFAULT_BENCHMARK_CONFIG with the given values replaced.
+
+    Raises:
+        ValueError: If a setting is not in DEFAULT_BENCHMARK_CONFIG.
+    """
+    name, _, assignments = text.partition(":")
+    settings = dict(DEFAULT_BENCHMARK_CONFIG)
+    for assignment in filter(None, assignments.split(",")):
+        key, _, value = assignment.partition("=")
+        key = key.strip()
+        if key not in settings:
+            raise ValueError(f"Unknown setting [{key}], choose from {', '.join(DEFAULT_BENCHMARK_CONFIG)}")
+        value = value.strip()
+        if value.lower() == "none":
+            settings[key] = None
+        elif value.lstrip("-").isdigit():
+            settings[key] = int(value)
+        else:
+            settings[key] = value
+    return name.strip() or "default", settings
+
+def prepare_fixture(reingest=False):
+    """
+    Generate the fixture repo if missing and ingest it if its project is not in the graph.
+
+    Args:
+        reingest (bool): Build the project again even if it exists.
+
+    Returns:
+        dict: The fixture's path, project and whether it was ingested in this run.
+    """
+    from edoc.gpt_helpers.connect import connect_to_neo4j
+    from edoc.kg_construction.bulk_load import CodebaseGraph
+    from edoc.kg_construction.build_tools.projects import list_projects
+
+    if not os.path.isdir(FIXTURE_DIR):
+        os.makedirs(os.path.dirname(FIXTURE_DIR), exist_ok=True)
+        generate_synthetic_repo(FIXTURE_DIR, **FIXTURE_REPO)
+
+    ingested = False
+    existing = {project["project_id"] for project in list_projects(connect_to_neo4j())}
+    if reingest or FIXTURE_PROJECT_ID not in existing:
+        CodebaseGraph(root_directory=FIXTURE_DIR, project_id=FIXTURE_PROJECT_ID).create_graph(reload=True)
+        ingested = True
+
+    return {"path": FIXTURE_DIR, "project_id": FIXTURE_PROJECT_ID, "ingested": ingested, **FIXTURE_REPO}
+
+def reset_warm_state():
+    """
+    Drop the process wide stores, matchers and mapped indexes, so the next question pays the cold start costs again.
+    """
+    from edoc.rag_components.vector_registry import get_vector_registry
+    from edoc.rag_components.entity_matcher import clear_entity_matchers
+    from edoc.rag_components.local_vector_backend import get_local_vector_backend
+
+    get_vector_registry().clear()
+    clear_entity_matchers()
+    get_local_vector_backend().unload()
+
+def _run_target(responder, target, question, settings):
+    if target == "get_full_response":
+        return responder.get_full_response(question, project_id=FIXTURE_PROJECT_ID, **settings)
+
+    from edoc.rag_components.structured_retrievers import dir_file_structured_retriever, code_structured_retriever
+
+    retriever = dir_file_structured_retriever if target == "dir_file_structured_retriever" else code_structured_retriever
+    return retriever({
+        "kg": responder.kg,
+        "question": question,
+        "top_k": settings["top_k"],
+        "next_chunk_limit": settings["next_chunk_limit"],
+        "retrieval_backend": settings["retrieval_backend"],
+        "token_budget": settings["context_token_budget"],
+        "project_id": FIXTURE_PROJECT_ID,
+    })
+
+def measure(responder, tracer, target, question, settings):
+    """
+    Run one question through one target and count what it cost.
+
+    Returns:
+        dict: Latency in seconds, Cypher queries, embedding and LLM calls, the context tokens and
+            bytes packed, the output length, and the error if it failed.
+    """
+    tracer.reset()
+    start = time.perf_counter()
+    error = None
+    output = ""
+    try:
+        output = _run_target(responder, target, question, settings)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    latency = time.perf_counter() - start
+
+    totals = tracer.summary()
+    count = lambda kind: sum(entry["count"] for key, entry in totals.items() if key.startswith(f"{kind}:"))
+    contexts = [span for span in tracer.spans() if span["name"] == "assemble_context"]
+
+    return {
+        "latency": latency,
+        "cypher_queries": count("cypher"),
+        "embedding_calls": count("embedding"),
+        "llm_calls": count("llm"),
+        "context_tokens": sum(span["attributes"].get("tokens_used", 0) for span in contexts),
+        "context_bytes": sum(span["bytes_out"] for span in contexts),
+        "output_chars": len(output or ""),
+        "error": error,
+    }
+
+def run_config(responder, tracer, settings, questions, warm_runs):
+    """
+    Ask every question through every target once cold, then warm_runs more times warm.
+
+    Returns:
+        dict: Per target cold and warm latency percentiles, and per question measurements.
+    """
+    reset_warm_state()
+
+    per_question = []
+    for question in questions:
+        entry = {"question": question}
+        for target in BENCHMARK_TARGETS:
+            cold = measure(responder, tracer, target, question, settings)
+            warm = [measure(responder, tracer, target, question, settings) for _ in range(warm_runs)]
+            entry[target] = {"cold": cold, "warm": warm}
+        per_question.append(entry)
+
+    targets = {}
+    for target in BENCHMARK_TARGETS:
+        cold = [entry[target]["cold"] for entry in per_question]
+        warm = [run for entry in per_question for run in entry[target]["warm"]]
+        targets[target] = {
+            "cold_latency": percentiles([run["latency"] for run in cold if run["error"] is None]),
+            "warm_latency": percentiles([run["latency"] for run in warm if run["error"] is None]),
+            "errors": sum(run["error"] is not None for run in cold + warm),
+        }
+
+    questions_report = []
+    for entry in per_question:
+        question_report = {"question": entry["question"]}
+        for target in BENCHMARK_TARGETS:
+            cold = entry[target]["cold"]
+            warm = entry[target]["warm"]
+            warm_latencies = sorted(run["latency"] for run in warm)
+            question_report[target] = {
+                "cold_ms": round(cold["latency"] * 1000, 1),
+                "warm_median_ms": round(warm_latencies[len(warm_latencies) // 2] * 1000, 1) if warm_latencies else None,
+                "cypher_queries": cold["cypher_queries"],
+                "warm_cypher_queries": warm[-1]["cypher_queries"] if warm else None,
+                "embedding_calls": cold["embedding_calls"],
+                "llm_calls": cold["llm_calls"],
+                "context_tokens": cold["context_tokens"],
+                "context_bytes": cold["context_bytes"],
+                "output_chars": cold["output_chars"],
+                "error": cold["error"] or next((run["error"] for run in warm if run["error"]), None),
+            }
+        questions_report.append(question_report)
+
+    return {"targets": targets, "questions": questions_report}
+
+def compare_configs(results):
+    """
+    Warm and cold p50 and p95 of every configuration against the first one.
+
+    Returns:
+        dict: Configuration name to per target latency differences in milliseconds, negative is faster.
+    """
+    names = list(results)
+    baseline = results[names[0]]["targets"]
+    comparison = {}
+    for name in names[1:]:
+        comparison[name] = {}
+        for target, latencies in results[name]["targets"].items():
+            differences = {}
+            for phase in ("cold_latency", "warm_latency"):
+                base, other = baseline[target][phase], latencies[phase]
+                if base and other:
+                    differences[phase] = {
+                        "p50_ms": round(other["p50_ms"] - base["p50_ms"], 1),
+                        "p95_ms": round(other["p95_ms"] - base["p95_ms"], 1),
+                    }
+            comparison[name][target] = differences
+    return comparison
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time retrieval and answers for a fixed question corpus on a pinned fixture repo.")
+    parser.add_argument("--config", action="append", default=None,
+                        help="A configuration to run, 'name:key=value,...' with keys from DEFAULT_BENCHMARK_CONFIG. Repeat to compare.")
+    parser.add_argument("--warm-runs", type=int, default=3, help="Times each question is asked again after the cold run.")
+    parser.add_argument("--questions", type=int, default=None, help="Only ask the first n questions of the corpus.")
+    parser.add_argument("--graph", choices=["neo4j", "local"], default="neo4j",
+                        help="Neo4j, or the empty stand in graph (only the pipeline overhead is measured).")
+    parser.add_argument("--reingest", action="store_true", help="Build the fixture project again even if it exists.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--output", type=str, default=None, help="Also write the JSON report to this file.")
+    args = parser.parse_args(argv)
+
+    configs = dict(parse_config(text) for text in (args.config or ["default:"]))
+
+    os.environ["EDOC_MODEL_BACKEND"] = "local"
+    os.environ["EDOC_GRAPH_BACKEND"] = args.graph
+    #No simulated model latency, the benchmark measures our own work
+    os.environ.setdefault("EDOC_STAND_IN_CHAT_LATENCY", "0")
+    os.environ.setdefault("EDOC_STAND_IN_TOKEN_DELAY", "0")
+    os.environ.setdefault("EDOC_STAND_IN_EMBED_LATENCY", "0")
+
+    #Tracing must be on before the responder connects, so its graph is traced
+    from edoc.monitoring.tracing import enable_tracing
+    tracer = enable_tracing()
+
+    fixture = prepare_fixture(reingest=args.reingest)
+
+    from edoc.rag_components.responder import BuildResponse
+    responder = BuildResponse()
+
+    questions = QUESTION_CORPUS[:args.questions] if args.questions else QUESTION_CORPUS
+    results = {}
+    for name, settings in configs.items():
+        results[name] = {"config": settings, **run_config(responder, tracer, settings, questions, args.warm_runs)}
+
+    report = {
+        "benchmark": "query",
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "graph": args.graph,
+        "warm_runs": args.warm_runs,
+        "fixture": fixture,
+        "results": results,
+        "comparison": compare_configs(results) if len(results) > 1 else None,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    errors = sum(target["errors"] for result in results.values() for target in result["targets"].values())
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, result in results.items():
+            print(f"[{name}] {json.dumps(result['config'])}")
+            for target, latencies in result["targets"].items():
+                print(f"  {target}: cold {latencies['cold_latency']}, warm {latencies['warm_latency']}, {latencies['errors']} errors")
+        if report["comparison"]:
+            print(f"Against [{next(iter(results))}]: {json.dumps(report['comparison'], indent=2)}")
+
+    return 0 if errors == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
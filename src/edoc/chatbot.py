@@ -1,6 +1,9 @@
 import gradio as gr
 from edoc.gpt_helpers.connect import OpenAiConfig
-from edoc.chatbot_components.utils import response, set_openai_api_key, create_graph_from_zip, create_graph_from_git, delete_graph_data
+from edoc.chatbot_components.utils import aresponse, warm_up_responder, set_openai_api_key, create_graph_from_zip, create_graph_from_git, delete_graph_data, ingestion_status, cancel_ingestion, project_choices
+from edoc.chatbot_components.serving import CHAT_ADMISSION_LIMIT, QUEUE_MAX_SIZE
+from edoc.monitoring.tracing import tracing_enabled, start_metrics_server
+import os
 
 OPENAI_API_KEY = OpenAiConfig.get_openai_api_key()
 
@@ -12,7 +15,22 @@ with gr.Blocks(fill_height=True) as demo:
         """
     )
 
-    gr.ChatInterface(response)
+    #Choices are filled in on page load, projects come and go while the app runs
+    chat_project = gr.Dropdown(choices=[("All projects", "")], value="", label="Project", render=False)
+
+    gr.ChatInterface(
+        aresponse,
+        additional_inputs=[
+            gr.Dropdown(
+                choices=[("Combine partial answers (thorough)", "combine"), ("Single pass (faster, cheaper)", "single_pass")],
+                value="combine",
+                label="Answer mode"
+            ),
+            chat_project
+        ],
+        #Admits more than run at once, chat_limiter then shares the running slots fairly between users
+        concurrency_limit=CHAT_ADMISSION_LIMIT
+    )
 
     with gr.Accordion("Manage", open=False):
 
@@ -27,12 +45,20 @@ with gr.Blocks(fill_height=True) as demo:
         with gr.Tab("Upload files"):
             gr.Markdown("## Choose Your Method to Upload Code Files")
 
-            upload_output = gr.Textbox(label="Graph Progress")
+            upload_output = gr.Textbox(label="Graph Progress", lines=4)
+            ingestion_job_id = gr.State(None)
+            with gr.Row():
+                cancel_ingestion_button = gr.Button("Cancel ingestion")
+
+            #Builds run on background workers, these handlers only start, poll and cancel them so they never hold a slot for long
+            cancel_ingestion_button.click(cancel_ingestion, ingestion_job_id, upload_output, concurrency_limit=None)
+            ingestion_timer = gr.Timer(2.0)
+            ingestion_timer.tick(ingestion_status, ingestion_job_id, upload_output, concurrency_limit=None, show_progress="hidden")
 
             with gr.Group():
                 gr.Markdown("### Upload Your Zipped Code Files")
                 upload_zip_button = gr.UploadButton(label="Select ZIP File", file_types=[".zip"], file_count="single")
-                upload_zip_button.upload(create_graph_from_zip, upload_zip_button, upload_output)
+                upload_zip_button.upload(create_graph_from_zip, upload_zip_button, [upload_output, ingestion_job_id], concurrency_limit=None)
 
             with gr.Group():
                 gr.Markdown("### Import Your Git Project via URL")
@@ -43,14 +69,31 @@ with gr.Blocks(fill_height=True) as demo:
 
                 upload_git_button = gr.Button("Import Git Project")
 
-                upload_git_button.click(create_graph_from_git, [upload_git_input, set_access_token, set_branch], upload_output) 
+                upload_git_button.click(create_graph_from_git, [upload_git_input, set_access_token, set_branch], [upload_output, ingestion_job_id], concurrency_limit=None)
 
         with gr.Tab("Delete data"):
+            delete_project_input = gr.Dropdown(choices=[], label="Project to delete")
             keyword_input = gr.Textbox(label="Please enter 'Delete' to remove data.")
             submit_button = gr.Button("Submit")
 
             delete_output = gr.Textbox(label="Output")
-            submit_button.click(delete_graph_data, inputs=keyword_input, outputs=delete_output)
+            submit_button.click(
+                delete_graph_data, inputs=[keyword_input, delete_project_input], outputs=delete_output, concurrency_id="graph_write", concurrency_limit=1
+            ).then(
+                lambda: (gr.update(choices=project_choices(), value=""), gr.update(choices=project_choices(include_all=False), value=None)),
+                outputs=[chat_project, delete_project_input]
+            )
+
+    demo.load(
+        lambda: (gr.update(choices=project_choices()), gr.update(choices=project_choices(include_all=False))),
+        outputs=[chat_project, delete_project_input]
+    )
 
 if __name__ == "__main__":
+    #Prometheus scrape endpoint for the spans, only with EDOC_TRACING on
+    if tracing_enabled() and os.getenv("EDOC_METRICS_PORT"):
+        start_metrics_server(port=int(os.getenv("EDOC_METRICS_PORT")))
+    warm_up_responder()
+    #Chat has its own concurrency group and graph builds run on background workers, so a long upload never holds up answers
+    demo.queue(max_size=QUEUE_MAX_SIZE)
     demo.launch(share=True)
@@ -0,0 +1,305 @@
+import re
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_question(question):
+    """
+    Normalize a question for cache lookups: lowercase, single spaces, no trailing punctuation.
+
+    Args:
+        question (str): The user's question.
+
+    Returns:
+        str: The normalized question.
+    """
+    question = _WHITESPACE.sub(" ", question.strip().lower())
+    return question.rstrip("?!. ")
+
+class AnswerCache:
+    def __init__(self, max_entries=512, similarity_threshold=None, embed_fn=None):
+        """
+        Cache finished answers per graph version, coalescing identical questions that are in flight.
+
+        Answers are keyed by the normalized question text plus any settings that change the answer
+        (top_k, mode, ...). Each entry is stamped with the graph version it was computed against and
+        is never served once the graph has moved on. Optionally, a question that is not an exact hit
+        can reuse the answer of a cached question whose embedding is close enough.
+
+        Args:
+            max_entries (int): The most answers kept, least recently used are dropped first. Default is 512.
+            similarity_threshold (float, optional): Cosine similarity above which a cached answer is reused
+                for a different question. None disables the semantic lookup.
+            embed_fn (callable, optional): Maps a question to an embedding, required with similarity_threshold.
+        """
+        if similarity_threshold is not None and embed_fn is None:
+            raise ValueError("embed_fn must be provided when similarity_threshold is set.")
+
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.embed_fn = embed_fn
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+        self.hits = 0
+        self.semantic_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _semantic_lookup(self, embedding, graph_version, settings):
+        """
+        Find the cached answer with the closest question embedding above the threshold. Caller holds the lock.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return None
+
+        best_key, best_similarity = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if entry["graph_version"] != graph_version or key[1] != settings or entry["embedding"] is None:
+                continue
+            cached = entry["embedding"]
+            similarity = float(np.dot(query, cached) / (query_norm * np.linalg.norm(cached)))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key]["answer"]
+
+    def _claim(self, question, graph_version, settings):
+        """
+        Look up a finished answer, or join or claim the in flight computation for it.
+
+        Returns:
+            tuple: (key, answer, in flight Future, owner). answer is set on a hit, otherwise the caller
+                either owns the Future and must finish it, or waits on it.
+        """
+        key = (normalize_question(question), settings)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["graph_version"] == graph_version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, entry["answer"], None, False
+
+            in_flight = self._in_flight.get((key, graph_version))
+            if in_flight is None:
+                in_flight = Future()
+                self._in_flight[(key, graph_version)] = in_flight
+                return key, None, in_flight, True
+
+            self.coalesced += 1
+            return key, None, in_flight, False
+
+    def _lookup_similar(self, embedding, graph_version, settings):
+        """
+        Semantic lookup for a claimed question, counted as a semantic hit if found.
+        """
+        with self._lock:
+            answer = self._semantic_lookup(embedding, graph_version, settings)
+            if answer is not None:
+                self.semantic_hits += 1
+        return answer
+
+    def _fail(self, key, graph_version, in_flight, error):
+        with self._lock:
+            self._in_flight.pop((key, graph_version), None)
+        in_flight.set_exception(error)
+
+    def _finish(self, key, graph_version, in_flight, answer, embedding, computed):
+        #Store before releasing the in flight slot so no caller can slip between the two and recompute
+        with self._lock:
+            if computed:
+                self.misses += 1
+            self._entries[key] = {
+                "answer": answer,
+                "graph_version": graph_version,
+                "embedding": np.asarray(embedding, dtype=np.float32) if embedding is not None else None,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._in_flight.pop((key, graph_version), None)
+
+        in_flight.set_result(answer)
+
+    def get_or_compute(self, question, graph_version, compute, settings=()):
+        """
+        Get the cached answer for a question, or compute it once even if many callers ask at the same time.
+
+        Args:
+            question (str): The user's question.
+            graph_version (str): The current graph version stamp.
+            compute (callable): Called with no arguments to produce the answer on a miss.
+            settings (tuple): Anything else the answer depends on, must be hashable.
+
+        Returns:
+            str: The answer.
+        """
+        key, answer, in_flight, owner = self._claim(question, graph_version, settings)
+        if in_flight is None:
+            return answer
+        if not owner:
+            return in_flight.result()
+
+        try:
+            embedding = None
+            answer = None
+            if self.similarity_threshold is not None:
+                embedding = self.embed_fn(question)
+                answer = self._lookup_similar(embedding, graph_version, settings)
+
+            computed = answer is None
+            if computed:
+                answer = compute()
+        except Exception as e:
+            self._fail(key, graph_version, in_flight, e)
+            raise
+
+        self._finish(key, graph_version, in_flight, answer, embedding, computed)
+        return answer
+
+    async def aget_or_compute(self, question, graph_version, compute, settings=()):
+        """
+        Async version of get_or_compute, sharing the same entries and in flight computations.
+
+        Args:
+            question (str): The user's question.
+            graph_version (str): The current graph version stamp.
+            compute (callable): Called with no arguments on a miss, returns an awaitable answer.
+            settings (tuple): Anything else the answer depends on, must be hashable.
+
+        Returns:
+            str: The answer.
+        """
+        key, answer, in_flight, owner = self._claim(question, graph_version, settings)
+        if in_flight is None:
+            return answer
+        if not owner:
+            #Wait without blocking the event loop, the owner may be a thread or another task
+            return await asyncio.wrap_future(in_flight)
+
+        try:
+            embedding = None
+            answer = None
+            if self.similarity_threshold is not None:
+                embedding = await asyncio.to_thread(self.embed_fn, question)
+                answer = self._lookup_similar(embedding, graph_version, settings)
+
+            computed = answer is None
+            if computed:
+                answer = await compute()
+        except BaseException as e:
+            #Cancelled tasks must release the slot too or later callers would wait forever
+            self._fail(key, graph_version, in_flight, e if isinstance(e, Exception) else RuntimeError("Answer computation was cancelled."))
+            raise
+
+        self._finish(key, graph_version, in_flight, answer, embedding, computed)
+        return answer
+
+    def stream_or_compute(self, question, graph_version, stream, settings=()):
+        """
+        Streaming version of get_or_compute.
+
+        The stream yields (kind, text) events. Only 'token' events make up the answer that is cached,
+        anything else (e.g. 'status') is passed through. A cached or coalesced answer is yielded as a
+        single 'token' event.
+
+        Args:
+            question (str): The user's question.
+            graph_version (str): The current graph version stamp.
+            stream (callable): Called with no arguments on a miss, returns an iterator of (kind, text) events.
+            settings (tuple): Anything else the answer depends on, must be hashable.
+
+        Yields:
+            tuple: (kind, text) events.
+        """
+        key, answer, in_flight, owner = self._claim(question, graph_version, settings)
+        if in_flight is None:
+            yield ("token", answer)
+            return
+        if not owner:
+            yield ("token", in_flight.result())
+            return
+
+        tokens = []
+        embedding = None
+        try:
+            if self.similarity_threshold is not None:
+                embedding = self.embed_fn(question)
+                answer = self._lookup_similar(embedding, graph_version, settings)
+
+            if answer is not None:
+                tokens.append(answer)
+                yield ("token", answer)
+            else:
+                for kind, text in stream():
+                    if kind == "token":
+                        tokens.append(text)
+                    yield (kind, text)
+        except BaseException as e:
+            #Also covers the consumer closing the stream early
+            self._fail(key, graph_version, in_flight, e if isinstance(e, Exception) else RuntimeError("Answer stream was closed."))
+            raise
+
+        self._finish(key, graph_version, in_flight, "".join(tokens), embedding, answer is None)
+
+    async def astream_or_compute(self, question, graph_version, stream, settings=()):
+        """
+        Async version of stream_or_compute.
+
+        Args:
+            question (str): The user's question.
+            graph_version (str): The current graph version stamp.
+            stream (callable): Called with no arguments on a miss, returns an async iterator of (kind, text) events.
+            settings (tuple): Anything else the answer depends on, must be hashable.
+
+        Yields:
+            tuple: (kind, text) events.
+        """
+        key, answer, in_flight, owner = self._claim(question, graph_version, settings)
+        if in_flight is None:
+            yield ("token", answer)
+            return
+        if not owner:
+            yield ("token", await asyncio.wrap_future(in_flight))
+            return
+
+        tokens = []
+        embedding = None
+        try:
+            if self.similarity_threshold is not None:
+                embedding = await asyncio.to_thread(self.embed_fn, question)
+                answer = self._lookup_similar(embedding, graph_version, settings)
+
+            if answer is not None:
+                tokens.append(answer)
+                yield ("token", answer)
+            else:
+                async for kind, text in stream():
+                    if kind == "token":
+                        tokens.append(text)
+                    yield (kind, text)
+        except BaseException as e:
+            self._fail(key, graph_version, in_flight, e if isinstance(e, Exception) else RuntimeError("Answer stream was closed."))
+            raise
+
+        self._finish(key, graph_version, in_flight, "".join(tokens), embedding, answer is None)
+
+    def clear(self):
+        """
+        Drop every cached answer.
+        """
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,266 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from edoc.kg_construction.bulk_load import CodebaseGraph
+from edoc.kg_construction.build_tools.projects import project_id_for_directory
+from edoc.kg_construction.build_tools.progress import IngestionProgress, IngestionCancelled, INGESTION_STAGES
+from edoc.chatbot_components.serving import project_write_lock, INGEST_CONCURRENCY
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+FINISHED_STATES = ("succeeded", "failed", "cancelled")
+
+#Counters shown to users, in order, with their labels
+_COUNTER_LABELS = {
+    "files_walked": "files walked",
+    "files_chunked": "files chunked",
+    "chunks_summarized": "chunks summarized",
+    "files_summarized": "files summarized",
+    "directories_summarized": "directories summarized",
+    "embeddings_written": "embeddings written",
+    "batch_requests_submitted": "batch requests submitted",
+    "batch_results_applied": "batch results applied",
+    "nodes_deleted": "nodes deleted",
+    "nodes_imported": "nodes imported",
+    "relationships_imported": "relationships imported",
+}
+
+class IngestionJob:
+    def __init__(self, description, fetch_source, project_id=None, reload=False):
+        """
+        One graph build, run in the background by IngestionJobManager.
+
+        Args:
+            description (str): What is being ingested, shown to users.
+            fetch_source (callable): Returns the directory to ingest (e.g. extracts a zip or clones a repo), or None if it failed.
+            project_id (str, optional): The project to build. Defaults to the fetched directory's name.
+            reload (bool): Delete the project's existing nodes before building. Default is False.
+        """
+        self.job_id = uuid.uuid4().hex[:12]
+        self.description = description
+        self.fetch_source = fetch_source
+        self.project_id = project_id
+        self.reload = reload
+
+        self.progress = IngestionProgress()
+        self.state = "queued"
+        self.message = "Waiting for a free ingestion worker."
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+
+    @property
+    def cancel_requested(self):
+        return self.progress.cancel_event.is_set()
+
+    def snapshot(self):
+        """
+        A copy of the job's state and progress, safe to read from any thread.
+
+        Returns:
+            dict: job_id, description, project_id, state, message, timestamps, and the progress snapshot.
+        """
+        return {
+            "job_id": self.job_id,
+            "description": self.description,
+            "project_id": self.project_id,
+            "state": self.state,
+            "message": self.message,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": self.progress.snapshot(),
+        }
+
+class IngestionJobManager:
+    def __init__(self, max_workers=INGEST_CONCURRENCY, max_finished_jobs=50):
+        """
+        Run graph builds on background workers so no request waits on them.
+
+        Jobs are queued on a pool of max_workers threads, and each build also holds the graph
+        write lock while it writes, so a delete cannot run under it. Callers get a job id back
+        at once and poll the job's snapshot for progress.
+
+        Args:
+            max_workers (int): Builds running at once. Defaults to EDOC_INGEST_CONCURRENCY.
+            max_finished_jobs (int): Finished jobs kept for polling before the oldest are forgotten. Default is 50.
+        """
+        self.max_finished_jobs = max_finished_jobs
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="edoc-ingest")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+
+    def submit(self, description, fetch_source, project_id=None, reload=False):
+        """
+        Queue a graph build.
+
+        Args:
+            description (str): What is being ingested, shown to users.
+            fetch_source (callable): Returns the directory to ingest, or None if it could not be fetched.
+            project_id (str, optional): The project to build. Defaults to the fetched directory's name.
+            reload (bool): Delete the project's existing nodes before building. Default is False.
+
+        Returns:
+            IngestionJob: The queued job.
+        """
+        job = IngestionJob(description, fetch_source, project_id=project_id, reload=reload)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._forget_finished_jobs()
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def _forget_finished_jobs(self):
+        """
+        Drop the oldest finished jobs past max_finished_jobs. Caller holds the lock.
+        """
+        finished = [job_id for job_id, job in self._jobs.items() if job.state in FINISHED_STATES]
+        for job_id in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self._jobs[job_id]
+
+    def _finish(self, job, state, message):
+        job.state = state
+        job.message = message
+        job.finished = time.time()
+        job.progress.finish()
+
+    def _run(self, job: IngestionJob):
+        """
+        Fetch the source and build the graph, recording how the job ended.
+        """
+        if job.cancel_requested:
+            self._finish(job, "cancelled", "Cancelled before it started.")
+            return
+
+        job.state = "running"
+        job.started = time.time()
+
+        try:
+            job.message = "Fetching source."
+            job.progress.start_stage("fetch")
+            root_directory = job.fetch_source()
+            if root_directory is None:
+                self._finish(job, "failed", "Could not fetch the source, nothing was ingested.")
+                return
+
+            job.project_id = job.project_id or project_id_for_directory(root_directory)
+
+            #Wait for a running build or delete of the same project to finish, but keep listening for a cancel.
+            #Builds of other projects run alongside.
+            job.message = f"Waiting for another write to project [{job.project_id}] to finish."
+            write_lock = project_write_lock(job.project_id)
+            while not write_lock.acquire(timeout=1):
+                job.progress.check_cancelled()
+
+            try:
+                job.message = "Building graph."
+                graph = CodebaseGraph(root_directory=root_directory, project_id=job.project_id)
+                graph.create_graph(progress=job.progress, reload=job.reload)
+            finally:
+                write_lock.release()
+
+            self._finish(job, "succeeded", f"Graph created successfully for project [{job.project_id}].")
+        except IngestionCancelled:
+            self._finish(job, "cancelled", "Cancelled. Work done so far was kept, ingesting again carries on from there.")
+        except Exception as e:
+            print(f"An error occurred while ingesting [{job.description}]: {e}")
+            self._finish(job, "failed", f"An error occurred: {e}")
+
+    def get(self, job_id):
+        """
+        Get a job by id.
+
+        Returns:
+            IngestionJob: The job, or None if it is unknown or was forgotten.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        """
+        Snapshots of every known job, oldest first.
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.snapshot() for job in jobs]
+
+    def cancel(self, job_id):
+        """
+        Ask a job to stop. A queued job never starts, a running one stops at its next unit of work.
+
+        Args:
+            job_id (str): The job to cancel.
+
+        Returns:
+            bool: True if the job was still queued or running.
+        """
+        job = self.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return False
+
+        job.progress.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self._finish(job, "cancelled", "Cancelled before it started.")
+        else:
+            job.message = "Cancelling."
+        return True
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_ingestion_manager():
+    """
+    Get the process wide IngestionJobManager, creating it on first use.
+
+    Returns:
+        IngestionJobManager: The shared manager.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = IngestionJobManager()
+    return _manager
+
+def _format_seconds(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+def describe_job(snapshot):
+    """
+    Render a job snapshot as a few lines of text for the UI.
+
+    Args:
+        snapshot (dict): From IngestionJob.snapshot.
+
+    Returns:
+        str: The job's state, current stage with progress and ETA, counters, and elapsed time.
+    """
+    progress = snapshot["progress"]
+    lines = [f"Job {snapshot['job_id']} ({snapshot['description']}): {snapshot['state']}. {snapshot['message']}"]
+
+    if progress["stage"] is not None:
+        stage_number = list(INGESTION_STAGES).index(progress["stage"]) + 1
+        stage_line = f"Stage {stage_number}/{len(INGESTION_STAGES)}: {progress['stage_label']}"
+        if progress["stage_total"] is not None:
+            stage_line += f", {progress['stage_done']}/{progress['stage_total']}"
+        if progress["stage_eta_seconds"] is not None:
+            stage_line += f", about {_format_seconds(progress['stage_eta_seconds'])} left in this stage"
+        lines.append(stage_line)
+
+    counters = [f"{progress['counters'][name]} {label}" for name, label in _COUNTER_LABELS.items() if progress["counters"].get(name)]
+    if counters:
+        lines.append(", ".join(counters).capitalize())
+
+    end = snapshot["finished"] or time.time()
+    if snapshot["started"] is not None:
+        lines.append(f"Elapsed {_format_seconds(end - snapshot['started'])}")
+
+    return "\n".join(lines)
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+
+#Chat answers running at once across every user, each holds LLM and graph connections
+CHAT_CONCURRENCY = int(os.getenv("EDOC_CHAT_CONCURRENCY", "8"))
+#Chat answers one user (browser session) may have running at once, the rest of their messages wait
+CHAT_PER_USER_CONCURRENCY = int(os.getenv("EDOC_CHAT_PER_USER_CONCURRENCY", "1"))
+#Chat requests Gradio hands to the handler at once. Higher than CHAT_CONCURRENCY so waiting requests
+#reach the fair limiter below instead of queuing first come first served in Gradio
+CHAT_ADMISSION_LIMIT = int(os.getenv("EDOC_CHAT_ADMISSION_LIMIT", str(CHAT_CONCURRENCY * 8)))
+#Graph builds running at once on the ingestion workers, they are long and write heavy
+INGEST_CONCURRENCY = int(os.getenv("EDOC_INGEST_CONCURRENCY", "1"))
+#Requests Gradio queues before turning new ones away
+QUEUE_MAX_SIZE = int(os.getenv("EDOC_QUEUE_MAX_SIZE", "256"))
+
+class FairLimiter:
+    def __init__(self, total_limit=CHAT_CONCURRENCY, per_user_limit=CHAT_PER_USER_CONCURRENCY):
+        """
+        Bound concurrent work overall and per user, so one busy user cannot take every slot.
+
+        A request first waits for one of its user's slots, then for a shared slot. Shared slots are
+        handed out first come first served, and each user has at most per_user_limit requests
+        waiting for them, so under load the shared slots rotate between users.
+
+        Args:
+            total_limit (int): Most requests running at once. Defaults to EDOC_CHAT_CONCURRENCY.
+            per_user_limit (int): Most requests one user may have running at once. Defaults to EDOC_CHAT_PER_USER_CONCURRENCY.
+        """
+        self.total_limit = total_limit
+        self.per_user_limit = per_user_limit
+
+        #Created on first use so they belong to the event loop serving requests
+        self._total = None
+        self._users = {}
+
+        self.active = 0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        """
+        Hold one slot for the user while the block runs.
+
+        Args:
+            user_id (str): Identifies the user, e.g. the Gradio session hash.
+        """
+        if self._total is None:
+            self._total = asyncio.Semaphore(self.total_limit)
+
+        user = self._users.get(user_id)
+        if user is None:
+            user = {"semaphore": asyncio.Semaphore(self.per_user_limit), "holders": 0}
+            self._users[user_id] = user
+        user["holders"] += 1
+
+        self.waiting += 1
+        started = False
+        try:
+            async with user["semaphore"]:
+                async with self._total:
+                    self.waiting -= 1
+                    started = True
+                    self.active += 1
+                    try:
+                        yield
+                    finally:
+                        self.active -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+            user["holders"] -= 1
+            #Forget idle users so the table does not grow with every session ever seen
+            if user["holders"] == 0:
+                self._users.pop(user_id, None)
+
+chat_limiter = FairLimiter()
+
+#Only one job may write to a project at a time, e.g. a delete must not run under an ingestion of it.
+#Writes to different projects run side by side.
+_project_write_locks = {}
+_project_write_locks_lock = threading.Lock()
+
+def project_write_lock(project_id):
+    """
+    Get the lock guarding writes (ingestion, deletion) to one project, creating it on first use.
+
+    Args:
+        project_id (str): The project written to.
+
+    Returns:
+        threading.Lock: The project's lock.
+    """
+    with _project_write_locks_lock:
+        return _project_write_locks.setdefault(project_id, threading.Lock())
@@ -1,26 +1,61 @@
+import asyncio
 import openai
 import gradio as gr
 import os
 import zipfile
+import threading
 
 from git import Repo, GitCommandError
 
 from edoc.gpt_helpers.gpt_basics import get_embedding
-from edoc.rag_components.responder import BuildResponse
-from edoc.kg_construction.bulk_load import CodebaseGraph
+from edoc.rag_components.responder import get_responder
 from edoc.gpt_helpers.connect import OpenAiConfig
 from edoc.gpt_helpers.connect import connect_to_neo4j
+from edoc.gpt_helpers.graph_version import get_graph_version
+from edoc.chatbot_components.answer_cache import AnswerCache
+from edoc.rag_components.vector_registry import get_vector_registry
+from edoc.gpt_helpers.stand_ins import uses_stand_in_models
+from edoc.chatbot_components.serving import chat_limiter, project_write_lock
+from edoc.chatbot_components.ingestion_jobs import get_ingestion_manager, describe_job
+from edoc.kg_construction.build_tools.projects import list_projects, delete_project
+from edoc.kg_construction.build_tools.progress import IngestionProgress
 
 #Check if the key is in env file
 #Force a component for setting key if not
 api_key_set = False
 OPENAI_API_KEY = OpenAiConfig.get_openai_api_key()
-if OPENAI_API_KEY is not None:
+if OPENAI_API_KEY is not None or uses_stand_in_models():
     api_key_set=True
+_api_key_lock = threading.Lock()
 
-
+#Shared by every handler. Reads are safe from any thread (each query takes its own driver session),
+#writes (ingestion, deletion) hold their project's project_write_lock so only one runs per project at a time
 kg = connect_to_neo4j()
 
+#Finished answers, served until the graph version changes. Set EDOC_ANSWER_CACHE_SIMILARITY
+#(e.g. 0.95) to also reuse answers for differently worded questions with close embeddings.
+_similarity_threshold = os.getenv("EDOC_ANSWER_CACHE_SIMILARITY")
+answer_cache = AnswerCache(
+    similarity_threshold=float(_similarity_threshold) if _similarity_threshold else None,
+    embed_fn=lambda question: get_vector_registry().embeddings.embed_query(question)
+)
+
+#Show a "Retrieved N files / M chunks" line while the answer is being prepared
+SHOW_RETRIEVAL_STATUS = os.getenv("EDOC_SHOW_RETRIEVAL_STATUS", "true").lower() not in ("0", "false", "no")
+
+def warm_up_responder():
+    """
+    Build and warm the shared responder so the first message does not pay for connection setup.
+    Skipped until an OpenAI API key is set, the responder is then built on the first message.
+    """
+    if not api_key_set:
+        return
+
+    try:
+        get_responder(model="gpt-4o-mini").warm_up()
+    except Exception as e:
+        print(f"Could not warm up the responder: {e}")
+
 def set_openai_api_key(api_key):
     """
     Set the OpenAI API key dynamically.
@@ -35,48 +70,163 @@ def set_openai_api_key(api_key):
         str: A success message if the key is valid, or an error message if the key is invalid.
     """
     global api_key_set
-    try:
-        # Set the new API key
-        OpenAiConfig.set_openai_api_key(api_key)
+    with _api_key_lock:
+        try:
+            # Set the new API key
+            OpenAiConfig.set_openai_api_key(api_key)
+
+            get_embedding("Test text for embedding call")
+            
+            api_key_set = True
+            return "API key set successfully!"
+        except openai.AuthenticationError:
+            return "Invalid API key. Please provide a valid OpenAI API key."
+        except Exception as e:
+            return f"An error occurred while testing the API key: {e}"
 
-        get_embedding("Test text for embedding call")
-        
-        api_key_set = True
-        return "API key set successfully!"
-    except openai.AuthenticationError:
-        return "Invalid API key. Please provide a valid OpenAI API key."
+def project_choices(include_all=True):
+    """
+    The projects in the graph as dropdown choices.
+
+    Args:
+        include_all (bool): Start with an 'All projects' choice (value ''). Default is True.
+
+    Returns:
+        list: (label, project_id) tuples.
+    """
+    choices = [("All projects", "")] if include_all else []
+    try:
+        choices.extend((f"{project['project_id']} ({project['files']} files)", project["project_id"]) for project in list_projects(kg))
     except Exception as e:
-        return f"An error occurred while testing the API key: {e}"
+        print(f"An error occurred while listing projects: {e}")
+    return choices
 
-def response(message, history):
+def _render_stream(events):
+    """
+    Turn (kind, text) answer events into the full messages Gradio expects from a generator.
+    The status line shows until the first answer token arrives.
+    """
+    answer = ""
+    for kind, text in events:
+        if kind == "status":
+            if SHOW_RETRIEVAL_STATUS and not answer:
+                yield f"_{text}, writing answer..._"
+        else:
+            answer += text
+            yield answer
+
+def response(message, history, mode="combine", project_id=""):
     """
     Generate a chatbot response based on user input and chat history.
 
     This function uses a pre-built responder model to get a response based on the user's
-    question, using a knowledge graph for context. It returns an error message if the 
-    OpenAI API key has not been set.
+    question, using a knowledge graph for context. The answer is streamed as it is written,
+    after a status line while retrieval runs. Answers are cached per graph version and
+    identical questions asked at the same time are only answered once. It returns an error 
+    message if the OpenAI API key has not been set.
 
     Args:
         message (str): The user's question.
         history (list): The chat history up to this point.
+        mode (str): 'combine' or 'single_pass', see BuildResponse.get_full_response. Default is 'combine'.
+        project_id (str): Only answer from this project, '' answers from every project.
 
-    Returns:
-        str: The chatbot's response or an error message.
+    Yields:
+        str: The chatbot's response so far, or an error message.
     """
     if not api_key_set:
-        return "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot."
+        yield "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot."
+        return
 
-    responder = BuildResponse(model="gpt-4o-mini")
+    top_k = 2
+    next_chunk_limit = 1
+    project_id = project_id or None
+
+    if SHOW_RETRIEVAL_STATUS:
+        yield "_Retrieving context..._"
+
+    def stream_response():
+        responder = get_responder(model="gpt-4o-mini")
+        return responder.stream_full_response(
+            question=message,
+            top_k=top_k,
+            next_chunk_limit=next_chunk_limit,
+            mode=mode,
+            project_id=project_id
+        )
 
     try:
-        response = responder.get_full_response(
+        events = answer_cache.stream_or_compute(
             question=message,
-            top_k=2,
-            next_chunk_limit=1
+            graph_version=get_graph_version(kg),
+            stream=stream_response,
+            settings=(top_k, next_chunk_limit, mode, project_id)
         )
-        return response
+        for partial_response in _render_stream(events):
+            yield partial_response
     except Exception as e:
-        return f"An error occurred while processing your request: {e}."
+        yield f"An error occurred while processing your request: {e}."
+
+async def aresponse(message, history, mode="combine", project_id="", request: gr.Request = None):
+    """
+    Async version of response, used by the chat interface so one worker can serve many users.
+
+    Retrieval runs on the async Neo4j driver and OpenAI client, and waiting on a cached or
+    in flight answer does not hold a thread.
+
+    Args:
+        message (str): The user's question.
+        history (list): The chat history up to this point.
+        mode (str): 'combine' or 'single_pass', see BuildResponse.get_full_response. Default is 'combine'.
+        project_id (str): Only answer from this project, '' answers from every project.
+        request (gr.Request, optional): Injected by Gradio, its session identifies the user for fair scheduling.
+
+    Yields:
+        str: The chatbot's response so far, or an error message.
+    """
+    if not api_key_set:
+        yield "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot."
+        return
+
+    top_k = 2
+    next_chunk_limit = 1
+    user_id = getattr(request, "session_hash", None) or "anonymous"
+    project_id = project_id or None
+
+    if SHOW_RETRIEVAL_STATUS:
+        yield "_Retrieving context..._"
+
+    async def stream_response():
+        #Only answers that are computed take a slot, cached and coalesced answers skip the limiter
+        async with chat_limiter.slot(user_id):
+            #Handing out the responder may run a health check, keep it off the event loop
+            responder = await asyncio.to_thread(get_responder, "gpt-4o-mini")
+            async for event in responder.astream_full_response(
+                question=message,
+                top_k=top_k,
+                next_chunk_limit=next_chunk_limit,
+                mode=mode,
+                project_id=project_id
+            ):
+                yield event
+
+    try:
+        events = answer_cache.astream_or_compute(
+            question=message,
+            graph_version=await asyncio.to_thread(get_graph_version, kg),
+            stream=stream_response,
+            settings=(top_k, next_chunk_limit, mode, project_id)
+        )
+        answer = ""
+        async for kind, text in events:
+            if kind == "status":
+                if SHOW_RETRIEVAL_STATUS and not answer:
+                    yield f"_{text}, writing answer..._"
+            else:
+                answer += text
+                yield answer
+    except Exception as e:
+        yield f"An error occurred while processing your request: {e}."
 
 def get_project_root_from_temp_location(zip_file):
     """
@@ -113,31 +263,30 @@ def get_project_root_from_temp_location(zip_file):
     
     return extracted_project_root
     
-def create_graph_from_zip(zip_file, progress=gr.Progress(track_tqdm=True)):
+def create_graph_from_zip(zip_file):
     """
-    Create a knowledge graph from a ZIP file.
+    Start a background job that creates a knowledge graph from a ZIP file.
 
-    This function extracts the ZIP file, processes the codebase, and generates 
-    a knowledge graph. If the API key is not set, an error is returned.
+    The job extracts the ZIP file, processes the codebase, and generates a knowledge graph,
+    poll it with ingestion_status. If the API key is not set, an error is returned.
 
     Args:
         zip_file (file): The ZIP file containing the codebase.
-        progress (gr.Progress, optional): Gradio's progress tracker.
 
     Returns:
-        str: Success message or an error message.
+        tuple: A status message, and the job id (None if no job was started).
     """
     if not api_key_set:
-        return "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot."
+        return "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot.", None
 
-    root_dir = get_project_root_from_temp_location(zip_file)
-    if root_dir is not None:
-        codebase_graph = CodebaseGraph(root_directory=root_dir)
-        codebase_graph.create_graph()
+    def fetch_source():
+        root_dir = get_project_root_from_temp_location(zip_file)
+        if root_dir is None:
+            print("Could not successfully read file from zip. Ensure the ZIP file contains a single root directory (top-level folder) that shares the ZIP's name.")
+        return root_dir
 
-        return "Successfully created graph from directory."
-    
-    return "Could not successfully read file from zip. \nEnsure the ZIP file contains a single root directory (top-level folder) that shares the ZIP's name. All other files, folders, and subdirectories are then placed inside that root directory."
+    job = get_ingestion_manager().submit(os.path.basename(zip_file.name), fetch_source)
+    return describe_job(job.snapshot()), job.job_id
 
 def get_project_root_from_github(repo_url, git_token=None, use_branch=None):
     """
@@ -188,55 +337,113 @@ def get_project_root_from_github(repo_url, git_token=None, use_branch=None):
     
     return project_dir
 
-def create_graph_from_git(git_url, git_token=None, use_branch=None, progress=gr.Progress(track_tqdm=True)):
+def create_graph_from_git(git_url, git_token=None, use_branch=None):
     """
-    Create a knowledge graph from a GitHub repository.
+    Start a background job that creates a knowledge graph from a GitHub repository.
 
-    This function clones a GitHub repository, processes the codebase, and generates 
-    a knowledge graph. If the API key is not set, an error is returned.
+    The job clones the GitHub repository, processes the codebase, and generates a knowledge graph,
+    poll it with ingestion_status. If the API key is not set, an error is returned.
 
     Args:
         git_url (str): The URL of the GitHub repository.
         git_token (str, optional): GitHub Personal Access Token for private repos.
         use_branch (str): The branch to clone (default is 'main').
-        progress (gr.Progress, optional): Gradio's progress tracker.
 
     Returns:
-        str: Success message or an error message.
+        tuple: A status message, and the job id (None if no job was started).
     """
     if not api_key_set:
-        return "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot."
+        return "Error: Please provide an OpenAI API key in `Manage` dropdown before using the chatbot.", None
 
-    root_dir = get_project_root_from_github(git_url, git_token, use_branch)
-    if root_dir is not None:
-        codebase_graph = CodebaseGraph(root_directory=root_dir)
-        codebase_graph.create_graph()
+    job = get_ingestion_manager().submit(git_url, lambda: get_project_root_from_github(git_url, git_token, use_branch))
+    return describe_job(job.snapshot()), job.job_id
 
-        return "Successfully created graph from Git project."
-    
-    return "Could not successfully clone Git, did not extract to graph."
+def ingestion_status(job_id):
+    """
+    Describe an ingestion job's progress, cheap enough to poll every few seconds.
+
+    Args:
+        job_id (str): The job to describe.
+
+    Returns:
+        str: The job's progress, or gr.skip() to leave the status box alone when there is no job.
+    """
+    if not job_id:
+        return gr.skip()
+
+    job = get_ingestion_manager().get(job_id)
+    if job is None:
+        return f"Job {job_id} is no longer tracked."
+    return describe_job(job.snapshot())
+
+def cancel_ingestion(job_id):
+    """
+    Cancel an ingestion job.
+
+    Args:
+        job_id (str): The job to cancel.
+
+    Returns:
+        str: What happened.
+    """
+    if not job_id:
+        return "No ingestion job to cancel."
+
+    if get_ingestion_manager().cancel(job_id):
+        return ingestion_status(job_id)
+    return f"Job {job_id} has already finished."
 
 # Function to delete graph data
 
-def delete_graph_data(keyword):
+def delete_graph_data(keyword, project_id):
     """
-    Delete all nodes and relationships from the knowledge graph.
+    Delete one project's nodes and relationships from the knowledge graph, if the correct keyword is provided.
 
-    This function clears the entire knowledge graph by running a `MATCH (n) DETACH DELETE n`
-    Cypher query if the correct keyword is provided.
+    The delete runs in bounded transactions (see delete_project) on a background thread, so
+    other projects are untouched and a large project never needs one huge transaction. Progress
+    is yielded about once a second while it runs.
 
     Args:
         keyword (str): The keyword to trigger the deletion. Must be 'Delete'.
+        project_id (str): The project to delete.
 
-    Returns:
-        str: Success message or an error message.
+    Yields:
+        str: Progress messages, then a success message or an error message.
     """
     magic_keyword = "Delete"
-    if keyword == magic_keyword:  # Example dangerous keyword
+    if keyword != magic_keyword:  # Example dangerous keyword
+        yield f"Incorrect keyword! Action not performed. To delete KG data enter '{magic_keyword}'"
+        return
+
+    if not project_id:
+        yield "Choose a project to delete."
+        return
+
+    write_lock = project_write_lock(project_id)
+    if not write_lock.acquire(blocking=False):
+        yield f"Another ingestion or deletion of project [{project_id}] is running, try again when it finishes."
+        return
+
+    progress = IngestionProgress()
+    outcome = {}
+
+    def delete():
         try:
-            kg.query("MATCH (n) DETACH DELETE n")  
-            return "Graph data deleted successfully!"
+            outcome["deleted"] = delete_project(kg, project_id, progress=progress)
         except Exception as e:
-            return f"An error occurred: {e}"
+            outcome["error"] = e
+        finally:
+            write_lock.release()
+
+    thread = threading.Thread(target=delete, name="edoc-delete", daemon=True)
+    thread.start()
+    while thread.is_alive():
+        thread.join(timeout=1)
+        snapshot = progress.snapshot()
+        if snapshot["stage_total"] is not None:
+            yield f"Deleting project [{project_id}]: {snapshot['stage_done']}/{snapshot['stage_total']} nodes deleted"
+
+    if "error" in outcome:
+        yield f"An error occurred: {outcome['error']}"
     else:
-        return f"Incorrect keyword! Action not performed. To delete KG data enter '{magic_keyword}'"
\ No newline at end of file
+        yield f"Project [{project_id}] deleted successfully, {outcome['deleted']} nodes removed."
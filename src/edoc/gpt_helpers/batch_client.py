@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import shutil
+from pathlib import Path
+
+from openai import OpenAI
+
+from edoc.gpt_helpers.connect import OpenAiConfig
+from edoc.gpt_helpers.rate_limiter import openai_client_kwargs
+from edoc.gpt_helpers.stand_ins import (
+    uses_stand_in_models,
+    stand_in_completion,
+    stand_in_embedding,
+    stand_in_code_entities,
+    stand_in_usage,
+)
+
+#Clients for OpenAI's Batch API (requests uploaded as a JSON lines file, answered within a day at half
+#the price) and a file based stand in with the same interface. Select the stand in with
+#EDOC_BATCH_BACKEND=local, it is also used whenever EDOC_MODEL_BACKEND=local.
+
+BATCH_COMPLETION_WINDOW = "24h"
+#Batch states after which nothing more will happen
+FINISHED_BATCH_STATES = ("completed", "failed", "expired", "cancelled")
+#Where the stand in keeps its batches, and how long one takes to finish
+LOCAL_BATCH_DIR = os.getenv("EDOC_LOCAL_BATCH_DIR", ".edoc_batches")
+LOCAL_BATCH_LATENCY = float(os.getenv("EDOC_LOCAL_BATCH_LATENCY", "0"))
+
+def uses_local_batches():
+    """
+    Check if batch jobs should go to the file based stand in (EDOC_BATCH_BACKEND=local or EDOC_MODEL_BACKEND=local).
+    """
+    return os.getenv("EDOC_BATCH_BACKEND", "openai").lower() == "local" or uses_stand_in_models()
+
+class OpenAIBatchClient:
+    def __init__(self, api_key=None):
+        """
+        Submit and poll batch jobs on OpenAI's Batch API.
+
+        Args:
+            api_key (str, optional): Defaults to the configured OpenAI key.
+        """
+        self.client = OpenAI(api_key=api_key or OpenAiConfig.get_openai_api_key(), **openai_client_kwargs())
+
+    def submit(self, input_path, endpoint, metadata=None):
+        """
+        Upload a JSON lines file of requests and start a batch on it.
+
+        Args:
+            input_path (str): The requests, one {"custom_id", "method", "url", "body"} object per line.
+            endpoint (str): The endpoint every request goes to, e.g. '/v1/chat/completions'.
+            metadata (dict, optional): Stored with the batch.
+
+        Returns:
+            str: The batch id.
+        """
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=endpoint,
+            completion_window=BATCH_COMPLETION_WINDOW,
+            metadata=metadata,
+        )
+        return batch.id
+
+    def retrieve(self, batch_id):
+        """
+        Get the state of a batch.
+
+        Returns:
+            dict: status, output_file_id, error_file_id and request_counts (total, completed, failed).
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "request_counts": {
+                "total": counts.total if counts else 0,
+                "completed": counts.completed if counts else 0,
+                "failed": counts.failed if counts else 0,
+            },
+        }
+
+    def read_file(self, file_id):
+        """
+        Download an output or error file.
+
+        Returns:
+            str: The file's JSON lines.
+        """
+        return self.client.files.content(file_id).text
+
+    def cancel(self, batch_id):
+        self.client.batches.cancel(batch_id)
+
+class LocalBatchClient:
+    def __init__(self, directory=LOCAL_BATCH_DIR, latency=LOCAL_BATCH_LATENCY):
+        """
+        File based stand in for OpenAIBatchClient, answered by the local stand in models.
+
+        Each batch is a directory holding its input, a batch.json with its state, and once done
+        an output.jsonl in OpenAI's output format. State lives on disk, so a batch submitted by one
+        process can be polled by the next, like a real one.
+
+        Args:
+            directory (str): Where batches are kept. Defaults to EDOC_LOCAL_BATCH_DIR.
+            latency (float): Seconds after submission before a batch is answered. Defaults to EDOC_LOCAL_BATCH_LATENCY.
+        """
+        self.directory = Path(directory)
+        self.latency = latency
+
+    def _state_path(self, batch_id):
+        return self.directory / batch_id / "batch.json"
+
+    def _read_state(self, batch_id):
+        with open(self._state_path(batch_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_state(self, batch_id, state):
+        with open(self._state_path(batch_id), "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+    def submit(self, input_path, endpoint, metadata=None):
+        batch_id = f"batch_local_{uuid.uuid4().hex[:16]}"
+        (self.directory / batch_id).mkdir(parents=True)
+        shutil.copyfile(input_path, self.directory / batch_id / "input.jsonl")
+
+        self._write_state(batch_id, {
+            "status": "in_progress",
+            "endpoint": endpoint,
+            "metadata": metadata,
+            "submitted": time.time(),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        })
+        return batch_id
+
+    def _answer(self, body, endpoint):
+        """
+        The response body the stand in models give for one request.
+        """
+        if endpoint.endswith("/embeddings"):
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            tokens = sum(len(str(text)) for text in inputs) // 4
+            return {
+                "object": "list",
+                "model": body.get("model"),
+                "data": [{"object": "embedding", "index": i, "embedding": stand_in_embedding(str(text))} for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+
+        prompt_text = "\n".join(str(message.get("content", "")) for message in body["messages"])
+        if body.get("response_format", {}).get("type") in ("json_object", "json_schema"):
+            #Structured requests are entity extractions, read the code out of the user message
+            user_text = "\n".join(str(message.get("content", "")) for message in body["messages"] if message.get("role") == "user")
+            answer = json.dumps(stand_in_code_entities(user_text))
+        else:
+            answer = stand_in_completion(prompt_text)
+
+        usage = stand_in_usage(prompt_text, answer)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"], "total_tokens": usage["total_tokens"]},
+        }
+
+    def _run(self, batch_id, state):
+        """
+        Answer every request of a batch and write the output file.
+        """
+        batch_directory = self.directory / batch_id
+        completed = 0
+        failed = 0
+
+        with open(batch_directory / "input.jsonl", "r", encoding="utf-8") as input_file, \
+                open(batch_directory / "output.jsonl", "w", encoding="utf-8") as output_file:
+            for line in input_file:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self._answer(request["body"], state["endpoint"])}
+                    error = None
+                    completed += 1
+                except Exception as e:
+                    response = None
+                    error = {"code": "stand_in_error", "message": str(e)}
+                    failed += 1
+                output_file.write(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                    "custom_id": request["custom_id"],
+                    "response": response,
+                    "error": error,
+                }) + "\n")
+
+        state.update({
+            "status": "completed",
+            "output_file_id": f"{batch_id}/output.jsonl",
+            "request_counts": {"total": completed + failed, "completed": completed, "failed": failed},
+        })
+        self._write_state(batch_id, state)
+
+    def retrieve(self, batch_id):
+        state = self._read_state(batch_id)
+        if state["status"] == "in_progress" and time.time() - state["submitted"] >= self.latency:
+            self._run(batch_id, state)
+        return {key: state[key] for key in ("status", "output_file_id", "error_file_id", "request_counts")}
+
+    def read_file(self, file_id):
+        with open(self.directory / file_id, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def cancel(self, batch_id):
+        state = self._read_state(batch_id)
+        if state["status"] not in FINISHED_BATCH_STATES:
+            state["status"] = "cancelled"
+            self._write_state(batch_id, state)
+
+def get_batch_client():
+    """
+    Get the batch client for the configured backend.
+
+    Returns:
+        OpenAIBatchClient | LocalBatchClient: The client.
+    """
+    if uses_local_batches():
+        return LocalBatchClient()
+    return OpenAIBatchClient()
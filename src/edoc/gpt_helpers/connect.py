@@ -1,5 +1,8 @@
 from langchain_community.graphs import Neo4jGraph
+from neo4j import AsyncGraphDatabase
 import os
+from edoc.gpt_helpers.stand_ins import uses_stand_in_graph, StandInGraph, StandInAsyncDriver
+from edoc.monitoring.tracing import tracing_enabled, TracedGraph
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,6 +14,7 @@ def connect_to_neo4j() -> Neo4jGraph:
     This function connects to a Neo4j graph database using the provided URI.
     By default, it connects to the local Neo4j instance at "bolt://localhost:7687".
     The function loads the username and password from environment variables using the dotenv package.
+    If tracing is on the graph is wrapped so every query is recorded as a 'cypher' span.
 
     Returns:
         Neo4jGraph: An instance of the Neo4jGraph connected to the specified database.
@@ -18,6 +22,10 @@ def connect_to_neo4j() -> Neo4jGraph:
     Raises:
         ValueError: If the username or password environment variables are not set.
     """
+    #Empty local graph for load tests, see stand_ins
+    if uses_stand_in_graph():
+        graph = StandInGraph()
+        return TracedGraph(graph) if tracing_enabled() else graph
 
     username = os.getenv("NEO4J_USERNAME")
     password = os.getenv("NEO4J_PASSWORD")
@@ -28,7 +36,32 @@ def connect_to_neo4j() -> Neo4jGraph:
         raise ValueError("NEO4J_USERNAME and NEO4J_PASSWORD environment variables must be set.")
 
     graph = Neo4jGraph(url=uri, username=username, password=password)
-    return graph
+    return TracedGraph(graph) if tracing_enabled() else graph
+
+def connect_to_neo4j_async():
+    """
+    Create an async Neo4j driver for the same database as connect_to_neo4j.
+
+    The driver must be created and used inside one running event loop.
+
+    Returns:
+        AsyncDriver: An async driver connected to the database.
+
+    Raises:
+        ValueError: If the username or password environment variables are not set.
+    """
+    if uses_stand_in_graph():
+        return StandInAsyncDriver()
+
+    username = os.getenv("NEO4J_USERNAME")
+    password = os.getenv("NEO4J_PASSWORD")
+
+    uri = os.getenv("NEO4J_URL", "bolt://localhost:7687")
+
+    if not username or not password:
+        raise ValueError("NEO4J_USERNAME and NEO4J_PASSWORD environment variables must be set.")
+
+    return AsyncGraphDatabase.driver(uri, auth=(username, password))
 
 class OpenAiConfig:
     _api_key = None
@@ -1,8 +1,19 @@
 from dotenv import load_dotenv
 import os
 from openai import OpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 
 from edoc.gpt_helpers.connect import OpenAiConfig
+from edoc.gpt_helpers.stand_ins import (
+    uses_stand_in_models,
+    stand_in_completion,
+    stand_in_embedding,
+    stand_in_usage,
+    StandInChatModel,
+    StandInEmbeddings,
+)
+from edoc.monitoring.tracing import span, payload_size, tracing_enabled, TracedEmbeddings, TracingCallbackHandler
+from edoc.gpt_helpers.rate_limiter import openai_client_kwargs, langchain_openai_kwargs
 
 OPENAI_API_KEY = OpenAiConfig.get_openai_api_key()
 
@@ -17,9 +28,23 @@ def create_chat_completion(messages, model='gpt-4o-mini'):
     Returns:
         str: The content of the response from the OpenAI API.
     """
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(messages=messages, model=model)
-    return response.choices[0].message.content
+    with span("llm.chat", "llm", model=model) as current:
+        if uses_stand_in_models():
+            prompt_text = "\n".join(str(message.get("content", "")) for message in messages)
+            answer = stand_in_completion(prompt_text)
+            usage = stand_in_usage(prompt_text, answer)
+            current.add_tokens(tokens_in=usage["input_tokens"], tokens_out=usage["output_tokens"])
+            current.add_bytes(bytes_in=payload_size(prompt_text), bytes_out=payload_size(answer))
+            return answer
+
+        client = OpenAI(api_key=OPENAI_API_KEY, **openai_client_kwargs())
+        response = client.chat.completions.create(messages=messages, model=model)
+        answer = response.choices[0].message.content
+
+        if response.usage is not None:
+            current.add_tokens(tokens_in=response.usage.prompt_tokens, tokens_out=response.usage.completion_tokens)
+        current.add_bytes(bytes_in=payload_size(messages), bytes_out=payload_size(answer))
+        return answer
 
 def get_embedding(text, model="text-embedding-3-small"):
     """
@@ -32,6 +57,64 @@ def get_embedding(text, model="text-embedding-3-small"):
     Returns:
         list: A list of floats representing the embedding vector of the input text.
     """
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    text = text.replace("\n", " ")
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
\ No newline at end of file
+    with span("embedding.create", "embedding", model=model) as current:
+        current.add_bytes(bytes_in=payload_size(text))
+
+        if uses_stand_in_models():
+            current.add_tokens(tokens_in=len(text) // 4)
+            return stand_in_embedding(text)
+
+        client = OpenAI(api_key=OPENAI_API_KEY, **openai_client_kwargs())
+        text = text.replace("\n", " ")
+        response = client.embeddings.create(input=[text], model=model)
+
+        if response.usage is not None:
+            current.add_tokens(tokens_in=response.usage.prompt_tokens)
+        return response.data[0].embedding
+
+def get_chat_model(model='gpt-4o-mini', temperature=0):
+    """
+    Create the langchain chat model for a model name, the local stand in if EDOC_MODEL_BACKEND=local.
+    If tracing is on every call is recorded as an 'llm' span.
+
+    Args:
+        model (str): The OpenAI model to use. Default is 'gpt-4o-mini'.
+        temperature (float): Sampling temperature. Default is 0.
+
+    Returns:
+        BaseChatModel: The chat model.
+    """
+    callbacks = [TracingCallbackHandler(model=model)] if tracing_enabled() else None
+
+    if uses_stand_in_models():
+        return StandInChatModel(model_name=model, callbacks=callbacks)
+
+    return ChatOpenAI(
+        temperature=temperature,
+        model=model,
+        api_key=OpenAiConfig.get_openai_api_key(),
+        callbacks=callbacks,
+        #Streamed answers only report token usage when asked to
+        stream_usage=callbacks is not None,
+        **langchain_openai_kwargs()
+    )
+
+def get_embedding_model(model="text-embedding-3-small"):
+    """
+    Create the langchain embeddings client for a model name, the local stand in if EDOC_MODEL_BACKEND=local.
+    If tracing is on every call is recorded as an 'embedding' span.
+
+    Args:
+        model (str): The OpenAI model to use. Default is 'text-embedding-3-small'.
+
+    Returns:
+        Embeddings: The embeddings client.
+    """
+    if uses_stand_in_models():
+        embeddings = StandInEmbeddings()
+    else:
+        embeddings = OpenAIEmbeddings(model=model, api_key=OpenAiConfig.get_openai_api_key(), **langchain_openai_kwargs())
+
+    if tracing_enabled():
+        return TracedEmbeddings(embeddings, model=model)
+    return embeddings
\ No newline at end of file
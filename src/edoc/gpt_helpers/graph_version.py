@@ -0,0 +1,72 @@
+import os
+
+from langchain_community.graphs import Neo4jGraph
+
+#The version lives on a single meta node. It is a random uuid rather than a counter
+#so a full wipe (which also removes the meta node) can never hand out an old version again
+GRAPH_VERSION_KEY = "graph_version"
+
+def get_graph_version(kg: Neo4jGraph):
+    """
+    Read the current version stamp of the knowledge graph.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+
+    Returns:
+        str: The current version stamp, or None if the graph has never been stamped.
+    """
+    result = kg.query(
+        """
+        OPTIONAL MATCH (meta:EdocMeta {key: $key})
+        RETURN meta.version AS version
+        """,
+        {"key": GRAPH_VERSION_KEY}
+    )
+
+    if not result:
+        return None
+
+    return result[0].get("version")
+
+def bump_graph_version(kg: Neo4jGraph):
+    """
+    Stamp the knowledge graph with a new version.
+
+    Anything cached against the graph (vector stores, answers, name matchers) compares
+    against this stamp, so it must be called after every ingestion or deletion.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+
+    Returns:
+        str: The new version stamp.
+    """
+    result = kg.query(
+        """
+        MERGE (meta:EdocMeta {key: $key})
+        SET meta.version = randomUUID(), meta.updated = datetime()
+        RETURN meta.version AS version
+        """,
+        {"key": GRAPH_VERSION_KEY}
+    )
+
+    #Graphs that do not persist anything (the stand in) return no row
+    if not result:
+        return None
+
+    return result[0]["version"]
+
+def get_database_key(kg: Neo4jGraph):
+    """
+    Identify the database a kg object points at, for keying per database caches.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+
+    Returns:
+        tuple: The (url, database name) pair.
+    """
+    url = os.getenv("NEO4J_URL", "bolt://localhost:7687")
+    database = getattr(kg, "_database", None) or "neo4j"
+    return (url, database)
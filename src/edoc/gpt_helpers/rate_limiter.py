@@ -0,0 +1,581 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import httpx
+
+#One scheduler in front of every OpenAI request the process makes (gpt_basics, the langchain chat
+#models and embeddings, the async retriever). It lives in the HTTP transport, so every client shares
+#the same per model budgets whatever library made the call. Turn it off with EDOC_RATE_LIMITER=false.
+
+#Budgets used until the first response reports the real ones, None means unknown (not limited)
+DEFAULT_RPM_LIMIT = int(os.getenv("EDOC_OPENAI_RPM_LIMIT", "0")) or None
+DEFAULT_TPM_LIMIT = int(os.getenv("EDOC_OPENAI_TPM_LIMIT", "0")) or None
+#Requests in flight per model, the limit moves between 1 and the max (additive increase, multiplicative decrease)
+INITIAL_CONCURRENCY = int(os.getenv("EDOC_OPENAI_INITIAL_CONCURRENCY", "4"))
+MAX_CONCURRENCY = int(os.getenv("EDOC_OPENAI_MAX_CONCURRENCY", "32"))
+#Share of every budget bulk (ingestion) traffic leaves free for chat, while chat has been seen in the last CHAT_ACTIVE_SECONDS
+CHAT_RESERVE = float(os.getenv("EDOC_OPENAI_CHAT_RESERVE", "0.2"))
+CHAT_ACTIVE_SECONDS = 30.0
+#Retries after a 429, 5xx or connection error, and the backoff between them
+MAX_RETRIES = int(os.getenv("EDOC_OPENAI_MAX_RETRIES", "6"))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+#Completion tokens assumed when a chat request does not set max_tokens, OpenAI counts them against TPM up front
+DEFAULT_COMPLETION_TOKENS = 512
+
+PRIORITIES = {"chat": 0, "bulk": 1}
+#API paths that cost rate limit budget, everything else passes straight through
+_LIMITED_PATHS = ("/chat/completions", "/completions", "/embeddings")
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+_priority = contextvars.ContextVar("edoc_request_priority", default="chat")
+
+def rate_limiter_enabled():
+    return os.getenv("EDOC_RATE_LIMITER", "true").lower() not in ("0", "false", "no")
+
+@contextmanager
+def request_priority(priority):
+    """
+    Run the block's OpenAI requests at the given priority.
+
+    Args:
+        priority (str): 'chat' (served first) or 'bulk' (ingestion, yields to chat).
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority [{priority}], use one of {tuple(PRIORITIES)}.")
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def current_priority():
+    return _priority.get()
+
+def parse_reset_duration(value):
+    """
+    Parse OpenAI's reset header format ('20ms', '1s', '6m0s', '1h2m3.5s') into seconds.
+
+    Returns:
+        float: Seconds, or None if the value cannot be parsed.
+    """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def retry_after_seconds(headers):
+    """
+    How long the server asked us to wait, from retry-after-ms or retry-after.
+
+    Returns:
+        float: Seconds, or None if the server did not say.
+    """
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return None
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Exponential backoff with full jitter, never shorter than what the server asked for.
+
+    Args:
+        attempt (int): Retries so far, 0 for the first.
+        retry_after (float, optional): Seconds the server asked us to wait.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def estimate_request_cost(body):
+    """
+    Model and tokens a request will count against the budgets, estimated at four characters a token.
+
+    Args:
+        body (bytes): The JSON request body.
+
+    Returns:
+        tuple: (model, tokens). The model is 'unknown' if the body cannot be read.
+    """
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        return "unknown", 0
+
+    model = payload.get("model", "unknown")
+
+    if "messages" in payload:
+        prompt_characters = sum(len(str(message.get("content") or "")) for message in payload["messages"])
+        completion_tokens = payload.get("max_completion_tokens") or payload.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        return model, prompt_characters // 4 + completion_tokens
+
+    inputs = payload.get("input", payload.get("prompt", ""))
+    if isinstance(inputs, list):
+        characters = sum(len(str(item)) for item in inputs)
+    else:
+        characters = len(str(inputs))
+    return model, characters // 4
+
+class TokenBucket:
+    def __init__(self, capacity=None, period_seconds=60.0):
+        """
+        A budget that refills continuously, capacity units per period.
+
+        Args:
+            capacity (int, optional): Units per period, None while the limit is unknown (never waits).
+            period_seconds (float): The period the capacity covers. Default is one minute.
+        """
+        self.capacity = capacity
+        self.period_seconds = period_seconds
+        self.level = float(capacity) if capacity else 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity:
+            self.level = min(float(self.capacity), self.level + (now - self._updated) * self.capacity / self.period_seconds)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until amount units can be taken.
+        """
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        #A request larger than the whole bucket would wait forever, let it drain the bucket instead
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) * self.period_seconds / self.capacity
+
+    def take(self, amount, now):
+        self._refill(now)
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+    def observe(self, limit, remaining, now):
+        """
+        Adopt the limit and remaining budget a response reported. The server's count wins when it is lower.
+        """
+        if limit and not self.capacity:
+            #First sight of the limit, start from what the server says is left
+            self.capacity = limit
+            self.level = float(remaining if remaining is not None else limit)
+            self._updated = now
+            return
+        if limit:
+            self.capacity = limit
+        self._refill(now)
+        if remaining is not None and self.capacity:
+            self.level = min(self.level, float(remaining))
+
+    def empty(self, now):
+        self._refill(now)
+        self.level = 0.0
+
+class _ModelBudget:
+    def __init__(self):
+        self.requests = TokenBucket(DEFAULT_RPM_LIMIT)
+        self.tokens = TokenBucket(DEFAULT_TPM_LIMIT)
+        self.concurrency = float(min(INITIAL_CONCURRENCY, MAX_CONCURRENCY))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.last_chat = None
+        self.waiters = []
+        self.stats = {"requests": 0, "rate_limited": 0, "errors": 0, "wait_seconds": {priority: 0.0 for priority in PRIORITIES}}
+
+class RequestTicket:
+    """
+    Held by one admitted request until the scheduler is told how it went.
+    """
+    def __init__(self, model, tokens, priority, started):
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.started = started
+
+class RateLimitScheduler:
+    def __init__(self, chat_reserve=CHAT_RESERVE, max_concurrency=MAX_CONCURRENCY):
+        """
+        Admit requests per model against requests per minute, tokens per minute and a concurrency limit.
+
+        Budgets start from EDOC_OPENAI_RPM_LIMIT / EDOC_OPENAI_TPM_LIMIT (unlimited if unset) and follow
+        the x-ratelimit-* headers of every response. The concurrency limit grows by about one per
+        round of successful requests and halves on a 429, so it settles just under what the account
+        sustains. Waiting requests are served by priority, then in arrival order. While chat is active,
+        bulk requests are charged as if they were 1 / (1 - chat_reserve) requests and get that much less
+        of the concurrency limit, so ingestion leaves chat_reserve of every budget free for chat.
+
+        Args:
+            chat_reserve (float): Share of each budget bulk requests may not use. Defaults to EDOC_OPENAI_CHAT_RESERVE.
+            max_concurrency (int): Most requests in flight per model. Defaults to EDOC_OPENAI_MAX_CONCURRENCY.
+        """
+        self.chat_reserve = chat_reserve
+        self.max_concurrency = max_concurrency
+
+        self._condition = threading.Condition()
+        self._budgets = {}
+        self._sequence = 0
+
+    def _budget(self, model):
+        budget = self._budgets.get(model)
+        if budget is None:
+            budget = _ModelBudget()
+            self._budgets[model] = budget
+        return budget
+
+    def _enqueue(self, model, priority, now):
+        budget = self._budget(model)
+        if priority == "chat":
+            budget.last_chat = now
+        self._sequence += 1
+        entry = (PRIORITIES[priority], self._sequence)
+        budget.waiters.append(entry)
+        return budget, entry
+
+    def _try_admit(self, budget, entry, tokens, priority, now):
+        """
+        Admit the waiter if it is first in line and every budget allows it. Caller holds the lock.
+
+        Returns:
+            float: 0 if admitted, else seconds worth waiting before trying again (None to wait for a release).
+        """
+        if min(budget.waiters) != entry:
+            return None
+        if now < budget.blocked_until:
+            return budget.blocked_until - now
+
+        reserve = 0.0
+        if priority == "bulk" and budget.last_chat is not None and now - budget.last_chat < CHAT_ACTIVE_SECONDS:
+            reserve = self.chat_reserve
+        concurrency_limit = max(1, int(budget.concurrency * (1 - reserve)))
+        if budget.in_flight >= concurrency_limit:
+            return None
+
+        cost = 1 / (1 - reserve)
+        wait = max(budget.requests.wait_time(cost, now), budget.tokens.wait_time(tokens * cost, now))
+        if wait > 0:
+            return wait
+
+        budget.waiters.remove(entry)
+        budget.requests.take(cost, now)
+        budget.tokens.take(tokens * cost, now)
+        budget.in_flight += 1
+        budget.stats["requests"] += 1
+        return 0.0
+
+    def _leave_queue(self, budget, entry):
+        if entry in budget.waiters:
+            budget.waiters.remove(entry)
+            self._condition.notify_all()
+
+    def acquire(self, model, tokens, priority=None):
+        """
+        Block until the request may be sent.
+
+        Args:
+            model (str): The model the request is for, each has its own budgets.
+            tokens (int): Estimated tokens, see estimate_request_cost.
+            priority (str, optional): 'chat' or 'bulk'. Defaults to the current request_priority.
+
+        Returns:
+            RequestTicket: Pass it to release once the response is in.
+        """
+        priority = priority or current_priority()
+        start = time.monotonic()
+        with self._condition:
+            budget, entry = self._enqueue(model, priority, start)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._try_admit(budget, entry, tokens, priority, now)
+                    if wait == 0:
+                        budget.stats["wait_seconds"][priority] += now - start
+                        #The next in line may fit too
+                        self._condition.notify_all()
+                        return RequestTicket(model, tokens, priority, now)
+                    self._condition.wait(timeout=min(wait, 1.0) if wait is not None else 1.0)
+            except BaseException:
+                self._leave_queue(budget, entry)
+                raise
+
+    async def aacquire(self, model, tokens, priority=None):
+        """
+        Async version of acquire, waits on the event loop instead of blocking a thread.
+        """
+        priority = priority or current_priority()
+        start = time.monotonic()
+        with self._condition:
+            budget, entry = self._enqueue(model, priority, start)
+        try:
+            while True:
+                with self._condition:
+                    now = time.monotonic()
+                    wait = self._try_admit(budget, entry, tokens, priority, now)
+                    if wait == 0:
+                        budget.stats["wait_seconds"][priority] += now - start
+                        self._condition.notify_all()
+                        return RequestTicket(model, tokens, priority, now)
+                #Released slots only notify threads, so poll a little faster than the sync path wakes
+                await asyncio.sleep(min(wait, 0.25) if wait is not None else 0.02)
+        except BaseException:
+            with self._condition:
+                self._leave_queue(budget, entry)
+            raise
+
+    def release(self, ticket: RequestTicket, headers=None, rate_limited=False, failed=False):
+        """
+        Record how an admitted request went and adapt the budgets.
+
+        Args:
+            ticket (RequestTicket): From acquire.
+            headers (Mapping, optional): The response headers, read for x-ratelimit-* and retry-after.
+            rate_limited (bool): The response was a 429.
+            failed (bool): The request failed some other way (5xx, connection error).
+        """
+        headers = headers or {}
+        with self._condition:
+            now = time.monotonic()
+            budget = self._budget(ticket.model)
+            budget.in_flight -= 1
+
+            self._observe_headers(budget, headers, now)
+
+            if rate_limited:
+                budget.stats["rate_limited"] += 1
+                #Several requests in flight see the same 429, only halve once per round
+                if ticket.started >= budget.last_decrease:
+                    budget.concurrency = max(1.0, budget.concurrency / 2)
+                    budget.last_decrease = now
+                retry_after = retry_after_seconds(headers)
+                if retry_after is not None:
+                    budget.blocked_until = max(budget.blocked_until, now + retry_after)
+                if "x-ratelimit-remaining-tokens" not in headers and "x-ratelimit-remaining-requests" not in headers:
+                    budget.tokens.empty(now)
+            elif failed:
+                budget.stats["errors"] += 1
+            else:
+                budget.concurrency = min(float(self.max_concurrency), budget.concurrency + 1 / budget.concurrency)
+
+            self._condition.notify_all()
+
+    def _observe_headers(self, budget, headers, now):
+        def number(name):
+            value = headers.get(name)
+            try:
+                return int(float(value)) if value is not None else None
+            except ValueError:
+                return None
+
+        if "x-ratelimit-limit-requests" in headers or "x-ratelimit-remaining-requests" in headers:
+            budget.requests.observe(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"), now)
+        if "x-ratelimit-limit-tokens" in headers or "x-ratelimit-remaining-tokens" in headers:
+            budget.tokens.observe(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"), now)
+
+    def stats(self):
+        """
+        Per model counters and current limits.
+
+        Returns:
+            dict: model to requests, rate_limited, errors, wait_seconds per priority, concurrency, in_flight and the known RPM/TPM limits.
+        """
+        with self._condition:
+            return {
+                model: {
+                    **budget.stats,
+                    "wait_seconds": dict(budget.stats["wait_seconds"]),
+                    "concurrency": round(budget.concurrency, 2),
+                    "in_flight": budget.in_flight,
+                    "rpm_limit": budget.requests.capacity,
+                    "tpm_limit": budget.tokens.capacity,
+                }
+                for model, budget in self._budgets.items()
+            }
+
+def _should_retry(response):
+    if response.status_code == 429:
+        #Out of quota is not going to clear up by waiting
+        return b"insufficient_quota" not in response.content
+    return response.status_code >= 500
+
+class RateLimitedTransport(httpx.BaseTransport):
+    def __init__(self, scheduler: RateLimitScheduler = None, transport: httpx.BaseTransport = None, max_retries=MAX_RETRIES):
+        """
+        httpx transport that sends OpenAI requests through the scheduler and retries 429s, 5xx and
+        connection errors with jittered exponential backoff.
+
+        Args:
+            scheduler (RateLimitScheduler, optional): Defaults to the process wide scheduler.
+            transport (httpx.BaseTransport, optional): The transport that sends requests. Defaults to httpx.HTTPTransport.
+            max_retries (int): Retries per request. Defaults to EDOC_OPENAI_MAX_RETRIES.
+        """
+        self.scheduler = scheduler or get_scheduler()
+        self.transport = transport or httpx.HTTPTransport()
+        self.max_retries = max_retries
+
+    def handle_request(self, request):
+        if not request.url.path.endswith(_LIMITED_PATHS):
+            return self.transport.handle_request(request)
+
+        model, tokens = estimate_request_cost(request.read())
+        attempt = 0
+        while True:
+            ticket = self.scheduler.acquire(model, tokens)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError:
+                self.scheduler.release(ticket, failed=True)
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            rate_limited = response.status_code == 429
+            self.scheduler.release(ticket, response.headers, rate_limited=rate_limited, failed=response.status_code >= 500)
+
+            if response.status_code < 400 or attempt >= self.max_retries:
+                return response
+
+            response.read()
+            if not _should_retry(response):
+                return response
+            response.close()
+            time.sleep(backoff_delay(attempt, retry_after_seconds(response.headers)))
+            attempt += 1
+
+    def close(self):
+        self.transport.close()
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, scheduler: RateLimitScheduler = None, transport: httpx.AsyncBaseTransport = None, max_retries=MAX_RETRIES):
+        """
+        Async version of RateLimitedTransport, shares the same scheduler as the sync clients.
+        """
+        self.scheduler = scheduler or get_scheduler()
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self.max_retries = max_retries
+
+    async def handle_async_request(self, request):
+        if not request.url.path.endswith(_LIMITED_PATHS):
+            return await self.transport.handle_async_request(request)
+
+        model, tokens = estimate_request_cost(await request.aread())
+        attempt = 0
+        while True:
+            ticket = await self.scheduler.aacquire(model, tokens)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError:
+                self.scheduler.release(ticket, failed=True)
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            rate_limited = response.status_code == 429
+            self.scheduler.release(ticket, response.headers, rate_limited=rate_limited, failed=response.status_code >= 500)
+
+            if response.status_code < 400 or attempt >= self.max_retries:
+                return response
+
+            await response.aread()
+            if not _should_retry(response):
+                return response
+            await response.aclose()
+            await asyncio.sleep(backoff_delay(attempt, retry_after_seconds(response.headers)))
+            attempt += 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+_scheduler = None
+_http_client = None
+_lock = threading.Lock()
+
+def get_scheduler():
+    """
+    Get the process wide RateLimitScheduler, creating it on first use.
+    """
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = RateLimitScheduler()
+    return _scheduler
+
+def get_http_client():
+    """
+    Get the shared sync httpx client for OpenAI, routed through the scheduler.
+    """
+    global _http_client
+    scheduler = get_scheduler()
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(transport=RateLimitedTransport(scheduler), timeout=httpx.Timeout(600.0, connect=5.0))
+    return _http_client
+
+def openai_client_kwargs(use_async=False):
+    """
+    Keyword arguments that route an OpenAI client (or langchain_openai model) through the scheduler.
+
+    The client's own retries are turned off, the transport retries instead so every retry is
+    scheduled too. Async clients get their own httpx client, connections belong to one event loop.
+
+    Args:
+        use_async (bool): For an async client (AsyncOpenAI). Default is False.
+
+    Returns:
+        dict: http_client and max_retries, or nothing if EDOC_RATE_LIMITER=false.
+    """
+    if not rate_limiter_enabled():
+        return {}
+
+    if use_async:
+        http_client = httpx.AsyncClient(transport=AsyncRateLimitedTransport(get_scheduler()), timeout=httpx.Timeout(600.0, connect=5.0))
+    else:
+        http_client = get_http_client()
+    return {"http_client": http_client, "max_retries": 0}
+
+def langchain_openai_kwargs():
+    """
+    Keyword arguments that route a langchain_openai model (ChatOpenAI, OpenAIEmbeddings) through the scheduler
+    for both its sync and async calls.
+
+    Returns:
+        dict: http_client, http_async_client and max_retries, or nothing if EDOC_RATE_LIMITER=false.
+    """
+    if not rate_limiter_enabled():
+        return {}
+
+    return {
+        "http_client": get_http_client(),
+        "http_async_client": openai_client_kwargs(use_async=True)["http_client"],
+        "max_retries": 0,
+    }
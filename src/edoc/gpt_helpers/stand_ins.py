@@ -0,0 +1,246 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+#Local stand ins for OpenAI and Neo4j so the app can be load tested and benchmarked without
+#network access or API spend. Select them with EDOC_MODEL_BACKEND=local and EDOC_GRAPH_BACKEND=local.
+
+#Seconds before a stand in chat model starts answering, and between streamed tokens
+STAND_IN_CHAT_LATENCY = float(os.getenv("EDOC_STAND_IN_CHAT_LATENCY", "0.5"))
+STAND_IN_TOKEN_DELAY = float(os.getenv("EDOC_STAND_IN_TOKEN_DELAY", "0.01"))
+#Seconds per stand in embedding call
+STAND_IN_EMBED_LATENCY = float(os.getenv("EDOC_STAND_IN_EMBED_LATENCY", "0.05"))
+#Same size as text-embedding-3-small so exported indexes have the real shape
+STAND_IN_EMBEDDING_DIMENSIONS = 1536
+
+_WORDS = re.compile(r"\w+")
+
+def uses_stand_in_models():
+    """
+    Check if LLM and embedding calls should go to the local stand ins (EDOC_MODEL_BACKEND=local).
+    """
+    return os.getenv("EDOC_MODEL_BACKEND", "openai").lower() == "local"
+
+def uses_stand_in_graph():
+    """
+    Check if graph connections should go to the local stand in (EDOC_GRAPH_BACKEND=local).
+    """
+    return os.getenv("EDOC_GRAPH_BACKEND", "neo4j").lower() == "local"
+
+def stand_in_embedding(text, dimensions=STAND_IN_EMBEDDING_DIMENSIONS):
+    """
+    Deterministic bag of words embedding: each word hashes to a dimension and sign.
+    Texts sharing words land close together, so similarity search still behaves sensibly.
+
+    Args:
+        text (str): The text to embed.
+        dimensions (int): The embedding size.
+
+    Returns:
+        list: A unit length embedding.
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in _WORDS.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dimensions] += 1.0 if (value >> 63) else -1.0
+
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        norm = 1.0
+    return (vector / norm).tolist()
+
+def stand_in_completion(prompt_text):
+    """
+    Deterministic answer text for a prompt, short and recognizable in logs.
+
+    Args:
+        prompt_text (str): The full prompt.
+
+    Returns:
+        str: The answer.
+    """
+    digest = hashlib.blake2b(prompt_text.encode("utf-8"), digest_size=4).hexdigest()
+    words = len(_WORDS.findall(prompt_text))
+    return f"Stand-in answer {digest}: the prompt had {words} words. This text stands in for a model response."
+
+def stand_in_usage(prompt_text, answer):
+    """
+    Token usage for a stand in call, estimated at four characters a token like the real tokenizer's average.
+
+    Args:
+        prompt_text (str): The full prompt.
+        answer (str): The answer.
+
+    Returns:
+        dict: input_tokens, output_tokens and total_tokens, as in langchain's usage_metadata.
+    """
+    input_tokens = len(prompt_text) // 4
+    output_tokens = len(answer) // 4
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+_PYTHON_IMPORT = re.compile(r"\b(?:from\s+([\w.]+)\s+)?import\s+([\w., ]+)")
+_PYTHON_DEF = re.compile(r"^\s*(?:async\s+)?def\s+(\w+)\s*\(([^)]*)\)", re.MULTILINE)
+_PYTHON_CLASS = re.compile(r"^\s*class\s+(\w+)\s*(?:\(([^)]*)\))?", re.MULTILINE)
+
+def _stand_in_parameters(text):
+    names = [part.split(":")[0].split("=")[0].strip(" *") for part in (text or "").split(",")]
+    return [{"name": name, "type": "unknown"} for name in names if name and name not in ("self", "cls")]
+
+def stand_in_code_entities(code_text):
+    """
+    Pick imports, functions and classes out of Python-like code with regular expressions,
+    in the shape extract_code_entities returns. Stands in for the structured output call.
+
+    Args:
+        code_text (str): The code.
+
+    Returns:
+        dict: imports, functions and classes as in CodeEntities.
+    """
+    imports = []
+    for module, names in _PYTHON_IMPORT.findall(code_text):
+        entities = [name.split(" as ")[0].strip() for name in names.split(",") if name.strip()]
+        if module:
+            imports.append({"module": module, "entities": entities})
+        else:
+            imports.extend({"module": name, "entities": []} for name in entities)
+
+    functions = [
+        {"name": name, "parameters": _stand_in_parameters(parameters), "return_type": None}
+        for name, parameters in _PYTHON_DEF.findall(code_text)
+    ]
+    classes = [
+        {"name": name, "parameters": _stand_in_parameters(bases)}
+        for name, bases in _PYTHON_CLASS.findall(code_text)
+    ]
+    return {"imports": imports, "functions": functions, "classes": classes}
+
+class StandInEmbeddings(Embeddings):
+    def __init__(self, latency=None):
+        """
+        Embeddings interface backed by stand_in_embedding.
+
+        Args:
+            latency (float, optional): Seconds per call. Defaults to EDOC_STAND_IN_EMBED_LATENCY.
+        """
+        self.latency = STAND_IN_EMBED_LATENCY if latency is None else latency
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [stand_in_embedding(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return stand_in_embedding(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        return [stand_in_embedding(text) for text in texts]
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return stand_in_embedding(text)
+
+class StandInChatModel(BaseChatModel):
+    """
+    Chat model that answers with stand_in_completion after a fixed delay, streaming word by word.
+    """
+    model_name: str = "stand-in"
+    latency: float = STAND_IN_CHAT_LATENCY
+    token_delay: float = STAND_IN_TOKEN_DELAY
+
+    @property
+    def _llm_type(self):
+        return "edoc-stand-in"
+
+    @staticmethod
+    def _prompt_text(messages):
+        return "\n".join(str(message.content) for message in messages)
+
+    def _tokens(self, messages):
+        answer = stand_in_completion(self._prompt_text(messages))
+        return [word + " " for word in answer.split(" ")]
+
+    def _result(self, messages):
+        prompt_text = self._prompt_text(messages)
+        answer = stand_in_completion(prompt_text)
+        message = AIMessage(content=answer, usage_metadata=stand_in_usage(prompt_text, answer))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, messages):
+        prompt_text = self._prompt_text(messages)
+        tokens = self._tokens(messages)
+        for i, token in enumerate(tokens):
+            #Usage rides on the last chunk, like OpenAI's stream_options include_usage
+            usage = stand_in_usage(prompt_text, stand_in_completion(prompt_text)) if i == len(tokens) - 1 else None
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency + self.token_delay * len(self._tokens(messages)))
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency + self.token_delay * len(self._tokens(messages)))
+        return self._result(messages)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for chunk in self._chunks(messages):
+            time.sleep(self.token_delay)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for chunk in self._chunks(messages):
+            await asyncio.sleep(self.token_delay)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+class StandInGraph:
+    def __init__(self, database="stand-in"):
+        """
+        Neo4jGraph look alike with an empty graph: every query succeeds and returns no rows.
+        Enough to run the chat path end to end, retrieval just finds nothing.
+
+        Args:
+            database (str): Name reported for per database caches.
+        """
+        self._database = database
+        self.queries = 0
+
+    def query(self, query, params=None):
+        self.queries += 1
+        return []
+
+    def refresh_schema(self):
+        pass
+
+class StandInAsyncDriver:
+    """
+    AsyncDriver look alike for StandInGraph, every query returns no records.
+    """
+    async def execute_query(self, query, parameters=None, **kwargs):
+        return [], None, None
+
+    async def close(self):
+        pass
+
+class StandInVectorStore:
+    """
+    Neo4jVector look alike for StandInGraph, every search returns nothing.
+    """
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return []
@@ -0,0 +1,485 @@
+import os
+import json
+import time
+from pathlib import Path
+
+from edoc.gpt_helpers.batch_client import get_batch_client, FINISHED_BATCH_STATES
+from edoc.kg_construction.build_tools.graph_builder import GraphBuilder, collect_chunk_entities
+from edoc.kg_construction.build_tools.utils import (
+    file_chunk_summary_prompt,
+    CodeEntities,
+    CODE_ENTITIES_SYSTEM_PROMPT,
+    CODE_ENTITIES_HUMAN_PROMPT,
+)
+from edoc.kg_construction.summary_tools.utils import chunk_summaries_prompt, files_and_subdirs_prompt
+from edoc.kg_construction.summary_tools.summary_manager import SummaryManager
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.kg_construction.build_tools.projects import DEFAULT_PROJECT_ID, chunk_file_path
+from edoc.monitoring.tracing import span, traced
+
+#Where request files are written before upload, how often running batches are polled,
+#and the most requests per batch file (OpenAI allows 50,000)
+BATCH_DIR = os.getenv("EDOC_BATCH_DIR", "edoc_batches")
+BATCH_POLL_SECONDS = float(os.getenv("EDOC_BATCH_POLL_SECONDS", "60"))
+MAX_REQUESTS_PER_BATCH = int(os.getenv("EDOC_BATCH_MAX_REQUESTS", "50000"))
+
+CHAT_MODEL = 'gpt-4o-mini'
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHAT_ENDPOINT = "/v1/chat/completions"
+EMBEDDINGS_ENDPOINT = "/v1/embeddings"
+
+#Rows written per query when applying results
+_APPLY_BATCH_SIZE = 500
+
+#Results that are written straight onto a node property, by request kind
+_APPLY_QUERIES = {
+    "chunk_summary": "UNWIND $rows AS row MATCH (n:Chunk {id: row.key, project_id: $project_id}) SET n.summary = row.value",
+    "chunk_embedding": "UNWIND $rows AS row MATCH (n:Chunk {id: row.key, project_id: $project_id}) SET n.chunk_embedding = row.value",
+    "chunk_summary_embedding": "UNWIND $rows AS row MATCH (n:Chunk {id: row.key, project_id: $project_id}) SET n.summary_embedding = row.value",
+    "file_summary": "UNWIND $rows AS row MATCH (n:File {path: row.key, project_id: $project_id}) SET n.summary = row.value",
+    "directory_summary": "UNWIND $rows AS row MATCH (n:Directory {path: row.key, project_id: $project_id}) SET n.summary = row.value",
+    "file_embedding": "UNWIND $rows AS row MATCH (n:File {path: row.key, project_id: $project_id}) SET n.summary_embedding = row.value",
+    "directory_embedding": "UNWIND $rows AS row MATCH (n:Directory {path: row.key, project_id: $project_id}) SET n.summary_embedding = row.value",
+}
+
+BATCH_STATE_KEY = "batch_ingest"
+
+def make_custom_id(kind, key):
+    """
+    The custom_id of a batch request, the request kind and the chunk id or node path it is for.
+    """
+    return f"{kind}:{key}"
+
+def parse_custom_id(custom_id):
+    """
+    Split a custom_id from make_custom_id.
+
+    Returns:
+        tuple: (kind, key).
+    """
+    kind, key = custom_id.split(":", 1)
+    return kind, key
+
+def get_batch_ingest_state(kg, project_id=DEFAULT_PROJECT_ID):
+    """
+    Read whether a project is waiting on batch results.
+
+    Args:
+        kg (Neo4jGraph): graph object to complete cypher queries
+        project_id (str): The project to check. Defaults to EDOC_PROJECT_ID.
+
+    Returns:
+        str: 'pending' or 'complete', or None if the project was never built in batch mode.
+    """
+    result = kg.query("""
+        OPTIONAL MATCH (meta:EdocMeta {key: $key, project_id: $project_id})
+        RETURN meta.state AS state
+    """, {"key": BATCH_STATE_KEY, "project_id": project_id})
+
+    if not result:
+        return None
+    return result[0].get("state")
+
+class BatchGraphBuilder:
+    def __init__(
+            self,
+            kg,
+            client=None,
+            work_dir=BATCH_DIR,
+            poll_seconds=BATCH_POLL_SECONDS,
+            max_requests_per_batch=MAX_REQUESTS_PER_BATCH,
+            graph_builder: GraphBuilder = None,
+            summary_manager: SummaryManager = None
+    ):
+        """
+        Fill in a chunked graph's summaries, entities and embeddings through batch jobs instead of live calls.
+
+        Work is done in rounds. Each round collects every request whose inputs are ready (chunk
+        summaries, entities and embeddings first, then file summaries, then directories bottom up,
+        then summary embeddings), writes them to JSON lines files, submits one batch per file,
+        polls until they finish and writes the results onto the graph by custom_id.
+
+        Until the last round is applied the graph is 'pending': nodes are missing their summaries
+        or embeddings, and the submitted batches are recorded as EdocBatch nodes. A run that is
+        stopped (cancelled, crashed, machine restarted) picks up the recorded batches on the next
+        run instead of paying for them again.
+
+        Args:
+            kg (Neo4jGraph): graph object to complete cypher queries
+            client (OpenAIBatchClient | LocalBatchClient, optional): Defaults to get_batch_client().
+            work_dir (str): Where request files are written. Defaults to EDOC_BATCH_DIR.
+            poll_seconds (float): Seconds between polls of running batches. Defaults to EDOC_BATCH_POLL_SECONDS.
+            max_requests_per_batch (int): Requests per batch file. Defaults to EDOC_BATCH_MAX_REQUESTS.
+            graph_builder (GraphBuilder, optional): Used to store entities, its project_id picks the project
+                to fill in. Created from kg (for EDOC_PROJECT_ID) if None.
+            summary_manager (SummaryManager, optional): Used for files without chunks. Created from kg if None.
+        """
+        self.kg = kg
+        self.client = client or get_batch_client()
+        self.work_dir = Path(work_dir)
+        self.poll_seconds = poll_seconds
+        self.max_requests_per_batch = max_requests_per_batch
+        self.graph_builder = graph_builder or GraphBuilder(kg)
+        self.summary_manager = summary_manager or SummaryManager(kg, project_id=self.graph_builder.project_id)
+        self.project_id = self.graph_builder.project_id
+
+    def _chat_request(self, kind, key, messages, **body):
+        return {
+            "custom_id": make_custom_id(kind, key),
+            "method": "POST",
+            "url": CHAT_ENDPOINT,
+            "body": {"model": CHAT_MODEL, "messages": messages, **body},
+        }
+
+    def _embedding_request(self, kind, key, text):
+        return {
+            "custom_id": make_custom_id(kind, key),
+            "method": "POST",
+            "url": EMBEDDINGS_ENDPOINT,
+            "body": {"model": EMBEDDING_MODEL, "input": text.replace("\n", " ")},
+        }
+
+    def _chunk_requests(self):
+        result = self.kg.query("""
+            MATCH (chunk:Chunk {project_id: $project_id})
+            WHERE chunk.summary IS NULL OR chunk.chunk_embedding IS NULL OR chunk.summary_embedding IS NULL
+                OR chunk.entities_pending = true
+            RETURN chunk.id AS chunk_id, chunk.file_path AS file_path, chunk.raw_code AS raw_code,
+                chunk.summary AS summary, chunk.chunk_embedding IS NULL AS needs_chunk_embedding,
+                chunk.summary_embedding IS NULL AS needs_summary_embedding,
+                coalesce(chunk.entities_pending, false) AS needs_entities
+        """, {'project_id': self.project_id})
+
+        requests = []
+        for record in result:
+            chunk_id = record['chunk_id']
+            if record['summary'] is None:
+                requests.append(self._chat_request(
+                    "chunk_summary", chunk_id, file_chunk_summary_prompt(record['raw_code'], record['file_path'])
+                ))
+            elif record['needs_summary_embedding']:
+                requests.append(self._embedding_request("chunk_summary_embedding", chunk_id, record['summary']))
+
+            if record['needs_chunk_embedding']:
+                requests.append(self._embedding_request("chunk_embedding", chunk_id, record['raw_code']))
+
+            if record['needs_entities']:
+                requests.append(self._chat_request(
+                    "chunk_entities",
+                    chunk_id,
+                    [
+                        {"role": "system", "content": CODE_ENTITIES_SYSTEM_PROMPT},
+                        {"role": "user", "content": CODE_ENTITIES_HUMAN_PROMPT.format(code_snippet=record['raw_code'])},
+                    ],
+                    response_format={
+                        "type": "json_schema",
+                        "json_schema": {"name": "CodeEntities", "schema": CodeEntities.model_json_schema()},
+                    },
+                ))
+        return requests
+
+    def _file_requests(self):
+        """
+        Requests for files whose chunks are all summarized. Files without chunks get their summary written at once.
+        """
+        result = self.kg.query("""
+            MATCH (file:File {project_id: $project_id})
+            WHERE file.summary IS NULL AND NOT EXISTS {
+                MATCH (file)-[:CONTAINS]->(pending:Chunk) WHERE pending.summary IS NULL
+            }
+            OPTIONAL MATCH (file)-[:CONTAINS]->(chunk:Chunk)
+            WITH file, chunk ORDER BY chunk.id ASC
+            RETURN file.path AS file_path, collect(chunk.summary) AS chunk_summaries
+        """, {'project_id': self.project_id})
+
+        requests = []
+        for record in result:
+            if not record['chunk_summaries']:
+                self.kg.query("""
+                    MATCH (file:File {path: $file_path, project_id: $project_id})
+                    SET file.summary = $file_summary
+                """, {
+                    'file_path': record['file_path'],
+                    'project_id': self.project_id,
+                    'file_summary': self.summary_manager.summary_for_file_without_chunks(record['file_path'])
+                })
+                continue
+
+            requests.append(self._chat_request(
+                "file_summary",
+                record['file_path'],
+                chunk_summaries_prompt({'file_path': record['file_path'], 'chunk_summaries': record['chunk_summaries']})
+            ))
+        return requests
+
+    def _directory_requests(self):
+        """
+        Requests for directories whose files and subdirectories are all summarized.
+        """
+        result = self.kg.query("""
+            MATCH (dir:Directory {project_id: $project_id})
+            WHERE dir.summary IS NULL AND NOT EXISTS {
+                MATCH (dir)-[:CONTAINS]->(child) WHERE (child:File OR child:Directory) AND child.summary IS NULL
+            }
+            OPTIONAL MATCH (dir)-[:CONTAINS]->(file:File)
+            WITH dir, collect(file) AS files
+            OPTIONAL MATCH (dir)-[:CONTAINS]->(subdir:Directory)
+            WITH dir, files, collect(subdir) AS subdirs
+            RETURN dir.path AS dir_path,
+                [file IN files | file.name] AS file_names, [file IN files | file.summary] AS file_summaries,
+                [subdir IN subdirs | subdir.name] AS subdir_names, [subdir IN subdirs | subdir.summary] AS subdir_summaries
+        """, {'project_id': self.project_id})
+
+        requests = []
+        for record in result:
+            file_data = None
+            if record['file_summaries']:
+                file_data = {
+                    'dir_path': record['dir_path'],
+                    'file_summaries': record['file_summaries'],
+                    'file_names': record['file_names']
+                }
+
+            subdir_data = None
+            if record['subdir_summaries']:
+                subdir_data = {
+                    'dir_path': record['dir_path'],
+                    'subdir_summaries': record['subdir_summaries'],
+                    'subdir_names': record['subdir_names']
+                }
+
+            requests.append(self._chat_request(
+                "directory_summary", record['dir_path'], files_and_subdirs_prompt(file_data=file_data, subdir_data=subdir_data)
+            ))
+        return requests
+
+    def _summary_embedding_requests(self):
+        result = self.kg.query("""
+            MATCH (n {project_id: $project_id})
+            WHERE n.summary IS NOT NULL AND n.summary_embedding IS NULL AND (n:File OR n:Directory)
+            RETURN labels(n) AS node_type, n.path AS node_path, n.summary AS summary
+        """, {'project_id': self.project_id})
+
+        kinds = {"File": "file_embedding", "Directory": "directory_embedding"}
+        return [
+            self._embedding_request(kinds[record['node_type'][0]], record['node_path'], record['summary'])
+            for record in result
+            if record['node_type'][0] in kinds
+        ]
+
+    def collect_requests(self, skip=None):
+        """
+        Every request whose inputs are ready.
+
+        Args:
+            skip (set, optional): custom_ids to leave out, e.g. ones that already failed this run.
+
+        Returns:
+            list: Batch request lines ({"custom_id", "method", "url", "body"}).
+        """
+        skip = skip or set()
+        requests = self._chunk_requests() + self._file_requests() + self._directory_requests() + self._summary_embedding_requests()
+        return [request for request in requests if request["custom_id"] not in skip]
+
+    def write_request_files(self, requests):
+        """
+        Write requests to JSON lines files, one endpoint per file and at most max_requests_per_batch lines each.
+
+        Returns:
+            list: (path, endpoint, request count) per file.
+        """
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+
+        by_endpoint = {}
+        for request in requests:
+            by_endpoint.setdefault(request["url"], []).append(request)
+
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        files = []
+        for endpoint, endpoint_requests in by_endpoint.items():
+            endpoint_name = endpoint.rsplit("/", 1)[-1]
+            for part, start in enumerate(range(0, len(endpoint_requests), self.max_requests_per_batch)):
+                part_requests = endpoint_requests[start:start + self.max_requests_per_batch]
+                path = self.work_dir / f"{stamp}_{endpoint_name}_{part:03d}.jsonl"
+                with open(path, "w", encoding="utf-8") as f:
+                    for request in part_requests:
+                        f.write(json.dumps(request) + "\n")
+                files.append((str(path), endpoint, len(part_requests)))
+        return files
+
+    def _submit(self, path, endpoint, count):
+        batch_id = self.client.submit(path, endpoint, metadata={"source": "edoc", "input_file": os.path.basename(path), "project_id": self.project_id})
+        self.kg.query("""
+            MERGE (batch:EdocBatch {id: $batch_id})
+            SET batch.endpoint = $endpoint, batch.input_path = $input_path, batch.requests = $requests,
+                batch.state = 'submitted', batch.submitted = datetime(), batch.project_id = $project_id
+        """, {'batch_id': batch_id, 'endpoint': endpoint, 'input_path': path, 'requests': count, 'project_id': self.project_id})
+        print(f"Submitted batch {batch_id} with {count} requests to {endpoint}")
+        return batch_id
+
+    def _outstanding_batches(self):
+        result = self.kg.query("""
+            MATCH (batch:EdocBatch {state: 'submitted', project_id: $project_id})
+            RETURN batch.id AS batch_id
+            ORDER BY batch.submitted ASC
+        """, {'project_id': self.project_id})
+        return [record['batch_id'] for record in result]
+
+    def _set_state(self, state):
+        self.kg.query("""
+            MERGE (meta:EdocMeta {key: $key, project_id: $project_id})
+            SET meta.state = $state, meta.updated = datetime()
+        """, {"key": BATCH_STATE_KEY, "state": state, "project_id": self.project_id})
+
+    def _write_rows(self, query, rows):
+        for start in range(0, len(rows), _APPLY_BATCH_SIZE):
+            self.kg.query(query, {"rows": rows[start:start + _APPLY_BATCH_SIZE], "project_id": self.project_id})
+
+    def apply_results(self, output_text, failed):
+        """
+        Write the results of a batch output file onto the graph by custom_id.
+
+        Args:
+            output_text (str): The output (or error) file's JSON lines.
+            failed (set): custom_ids that did not produce a usable result are added to it.
+
+        Returns:
+            int: Results applied.
+        """
+        rows_by_kind = {}
+        entities_by_file = {}
+        entity_chunk_ids = []
+
+        for line in output_text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            custom_id = result["custom_id"]
+            response = result.get("response") or {}
+
+            if result.get("error") or response.get("status_code") != 200:
+                print(f"Batch request [{custom_id}] failed: {result.get('error') or response.get('body')}")
+                failed.add(custom_id)
+                continue
+
+            kind, key = parse_custom_id(custom_id)
+            body = response["body"]
+
+            if kind == "chunk_entities":
+                try:
+                    chunk_entities = CodeEntities.model_validate_json(body["choices"][0]["message"]["content"]).model_dump()
+                except Exception as e:
+                    print(f"An error occurred while reading the entities of Chunk [{key}]: {e}")
+                    failed.add(custom_id)
+                    continue
+                file_path = chunk_file_path(self.project_id, key)
+                collect_chunk_entities(chunk_entities, *entities_by_file.setdefault(file_path, ({}, {}, {})))
+                entity_chunk_ids.append(key)
+            elif kind in _APPLY_QUERIES:
+                if body.get("object") == "list":
+                    value = body["data"][0]["embedding"]
+                else:
+                    value = body["choices"][0]["message"]["content"]
+                rows_by_kind.setdefault(kind, []).append({"key": key, "value": value})
+            else:
+                print(f"Unknown batch request kind [{kind}] in [{custom_id}], skipped.")
+                failed.add(custom_id)
+
+        for kind, rows in rows_by_kind.items():
+            self._write_rows(_APPLY_QUERIES[kind], rows)
+
+        for file_path, (unique_imports, unique_functions, unique_classes) in entities_by_file.items():
+            self.graph_builder.store_file_entities(file_path, unique_imports, unique_functions, unique_classes)
+        self._write_rows("UNWIND $rows AS chunk_id MATCH (chunk:Chunk {id: chunk_id, project_id: $project_id}) REMOVE chunk.entities_pending", entity_chunk_ids)
+
+        return sum(len(rows) for rows in rows_by_kind.values()) + len(entity_chunk_ids)
+
+    def _wait_and_apply(self, batch_ids, progress: IngestionProgress, failed):
+        """
+        Poll the batches until each finishes and apply its output as soon as it does.
+
+        Returns:
+            int: Results applied across the batches.
+        """
+        applied = 0
+        waiting = list(batch_ids)
+
+        while waiting:
+            for batch_id in list(waiting):
+                info = self.client.retrieve(batch_id)
+                if info["status"] not in FINISHED_BATCH_STATES:
+                    continue
+
+                #Expired and cancelled batches still return what they finished
+                with span("batch.apply", batch_id=batch_id, status=info["status"]):
+                    batch_applied = 0
+                    if info["output_file_id"]:
+                        batch_applied = self.apply_results(self.client.read_file(info["output_file_id"]), failed)
+                    if info["error_file_id"]:
+                        self.apply_results(self.client.read_file(info["error_file_id"]), failed)
+
+                self.kg.query("""
+                    MATCH (batch:EdocBatch {id: $batch_id})
+                    SET batch.state = $state, batch.finished = datetime(), batch.applied = $applied
+                """, {'batch_id': batch_id, 'state': info["status"], 'applied': batch_applied})
+
+                print(f"Batch {batch_id} {info['status']}, {batch_applied} results applied")
+                progress.count(batch_results_applied=batch_applied)
+                applied += batch_applied
+                waiting.remove(batch_id)
+
+            if waiting:
+                #Wakes early on a cancel, the batches stay recorded and are picked up by the next run
+                progress.cancel_event.wait(self.poll_seconds)
+                progress.check_cancelled()
+
+        return applied
+
+    @traced("BatchGraphBuilder.run")
+    def run(self, progress: IngestionProgress = None):
+        """
+        Submit, poll and apply rounds of batches until nothing is left to request.
+
+        Args:
+            progress (IngestionProgress, optional): Counts batch requests submitted and results applied,
+                and stops polling if cancelled (submitted batches are resumed by the next run).
+
+        Returns:
+            dict: rounds, requests submitted, results applied, failed custom_ids, and the graph's batch state.
+
+        Raises:
+            IngestionCancelled: If the progress' cancel event was set while waiting on a batch.
+        """
+        progress = progress or IngestionProgress()
+        progress.start_stage("batch")
+
+        self._set_state("pending")
+        failed = set()
+        rounds = 0
+        submitted = 0
+        applied = 0
+        round_applied = None
+
+        while True:
+            with span("batch.round", round=rounds):
+                #Batches left running by an earlier run are finished before anything new is requested
+                batch_ids = self._outstanding_batches()
+                if not batch_ids:
+                    requests = self.collect_requests(skip=failed)
+                    if not requests:
+                        break
+                    batch_ids = [self._submit(path, endpoint, count) for path, endpoint, count in self.write_request_files(requests)]
+                    submitted += len(requests)
+                    progress.count(batch_requests_submitted=len(requests))
+
+                round_applied = self._wait_and_apply(batch_ids, progress, failed)
+                applied += round_applied
+                rounds += 1
+
+            if round_applied == 0:
+                print("No batch results could be applied this round, stopping. Run again to retry the pending requests.")
+                break
+
+        state = "pending" if failed or round_applied == 0 else "complete"
+        self._set_state(state)
+        return {"rounds": rounds, "submitted": submitted, "applied": applied, "failed": sorted(failed), "state": state}
@@ -1,15 +1,54 @@
 from tqdm import tqdm
 import json
 from edoc.kg_construction.build_tools.utils import get_text_splitter
-from edoc.kg_construction.build_tools.utils import should_skip_file_or_dir, read_file_contents, summarize_file_chunk, extract_code_entities
+from edoc.kg_construction.build_tools.utils import should_skip_file_or_dir, iter_file_chunks, summarize_file_chunk, extract_code_entities
 from edoc.gpt_helpers.gpt_basics import get_embedding
+from edoc.monitoring.tracing import span, traced
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.kg_construction.build_tools.projects import DEFAULT_PROJECT_ID, PROJECT_LABELS, project_chunk_id
+
+#Pending chunks written per query by chunk_files
+CHUNK_WRITE_BATCH_SIZE = 100
+
+def collect_chunk_entities(chunk_entities, unique_imports, unique_functions, unique_classes):
+    """
+    Fold one chunk's extracted entities into the per file collections, the first definition of a name wins.
+
+    Args:
+        chunk_entities (dict): From extract_code_entities (a CodeEntities dump).
+        unique_imports (dict): Module name to the set of imported entities, updated in place.
+        unique_functions (dict): Function name to its parameters and return type, updated in place.
+        unique_classes (dict): Class name to its parameters, updated in place.
+    """
+    for imp in chunk_entities['imports']:
+        module_name = imp['module']
+        if module_name not in unique_imports:
+            unique_imports[module_name] = set(imp['entities'])
+        else:
+            unique_imports[module_name].update(imp['entities'])
+
+    for func in chunk_entities['functions']:
+        func_name = func['name']
+        if func_name not in unique_functions:
+            unique_functions[func_name] = {
+                'parameters': json.dumps([{'name': param['name'], 'type': param['type']} for param in func['parameters']]),
+                'return_type': func['return_type']
+            }
+
+    for cls in chunk_entities['classes']:
+        cls_name = cls['name']
+        if cls_name not in unique_classes:
+            unique_classes[cls_name] = {
+                'parameters': json.dumps([{'name': param['name'], 'type': param['type']} for param in cls['parameters']])
+            }
 
 class GraphBuilder:
     def __init__(
             self, 
             kg,
             chunk_size=3500,
-            chunk_overlap=50
+            chunk_overlap=50,
+            project_id=DEFAULT_PROJECT_ID
     ):
         """
         Initialize the CodebaseGraph with a connection to Neo4j.
@@ -18,145 +57,272 @@ class GraphBuilder:
             kg (Neo4jGraph): graph object to complete cypher queries
             chunk_size (int): size of chunk to use (by number of tokens)
             chunk_overlap (int): number of chunks to overlap when splitting
+            project_id (str): Only files of this project are processed, and every node written is tagged with it.
+                Defaults to EDOC_PROJECT_ID.
         """
         self.kg = kg
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.project_id = project_id
 
-    def enrich_graph(self):
-        """
-        Enriches the knowledge graph by processing files, creating and linking code chunks, and extracting unique code entities.
+    def _files_to_chunk(self):
         """
+        Paths of the project's files that have not been fully chunked yet.
 
-        # Query to find files without chunk nodes
-        query = """
-        MATCH (file:File)
-        WHERE NOT (file)-[:CONTAINS]->()
+        A file is marked chunked = false before its first chunk is written and true once its
+        chunks, entities and NEXT links all are, so a file a build stopped in the middle of is
+        chunked again from the start. Files of graphs built before the flag existed count as
+        chunked if they have any chunk nodes.
+        """
+        result = self.kg.query("""
+        MATCH (file:File {project_id: $project_id})
+        WHERE file.chunked = false OR (file.chunked IS NULL AND NOT (file)-[:CONTAINS]->(:Chunk))
         RETURN file.path AS file_path
+        """, {'project_id': self.project_id})
+        return [record['file_path'] for record in result]
+
+    def _mark_file_chunked(self, file, chunked):
         """
+        Set a file's chunked flag, see _files_to_chunk.
+        """
+        self.kg.query("""
+        MATCH (file:File {path: $file_path, project_id: $project_id})
+        SET file.chunked = $chunked
+        """, {'file_path': file, 'project_id': self.project_id, 'chunked': chunked})
 
-        result = self.kg.query(query)
-        file_paths = [record['file_path'] for record in result]
+    @traced("GraphBuilder.enrich_graph")
+    def enrich_graph(self, progress: IngestionProgress = None):
+        """
+        Enriches the knowledge graph by processing files, creating and linking code chunks, and extracting unique code entities.
 
-        for file in tqdm(file_paths, desc='Creating chunks from files'):
-            file_contents = read_file_contents(file)
+        Args:
+            progress (IngestionProgress, optional): Counts files chunked, chunks summarized and embeddings written,
+                and stops between chunks if cancelled. Files already chunked are skipped on the next run, the file
+                it stopped in is chunked again.
+        """
+        progress = progress or IngestionProgress()
 
-            if file_contents is not None:
-                text_splitter, splitter_language = get_text_splitter(file, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        file_paths = self._files_to_chunk()
+        progress.start_stage("chunk", total=len(file_paths))
 
-                chunks = text_splitter.split_text(file_contents)
+        for file in tqdm(file_paths, desc='Creating chunks from files'):
+            with span("GraphBuilder.chunk_file", file_path=file) as file_span:
+                text_splitter, splitter_language = get_text_splitter(file, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
 
                 unique_imports = {}
                 unique_functions = {}
                 unique_classes = {}
 
-                for idx, chunk in enumerate(chunks):
-                    chunk_id = f"{file}_chunk_{idx:06d}"
-                    chunk_summary = summarize_file_chunk(chunk_text=chunk, file_name=file)
-                    summary_embedding = get_embedding(chunk_summary)
-                    chunk_embedding = get_embedding(chunk)
-
-                    # Create the chunk node and link it to the file
-                    self.kg.query("""
-                        MERGE (chunk:Chunk {id: $chunk_id})
-                        SET chunk.raw_code = $raw_code, 
-                            chunk.summary = $summary, 
-                            chunk.summary_embedding = $summary_embedding, 
-                            chunk.chunk_embedding = $chunk_embedding,
-                            chunk.chunk_splitter_used = $splitter_language
-                        WITH chunk
-                        MATCH (file:File {path: $file_path})
-                        MERGE (file)-[:CONTAINS]->(chunk)
-                    """, {
-                        'chunk_id': chunk_id,
-                        'raw_code': chunk,
-                        'summary': chunk_summary,
-                        'summary_embedding': summary_embedding,
-                        'chunk_embedding': chunk_embedding,
-                        'file_path': file,
-                        'splitter_language': splitter_language
-                    })
-
-                    try:
-                        chunk_entities = extract_code_entities(chunk)
-                    except Exception as e:
-                        print(f"An error occurred while extracting entities (import, func, class) in a chunk for Chunk [{chunk_id}]: {e} \n Passed extracting entities")
-                        continue
-
-                    for imp in chunk_entities['imports']:
-                        module_name = imp['module']
-                        if module_name not in unique_imports:
-                            unique_imports[module_name] = set(imp['entities'])
-                        else:
-                            unique_imports[module_name].update(imp['entities'])
-
-                    for func in chunk_entities['functions']:
-                        func_name = func['name']
-                        if func_name not in unique_functions:
-                            unique_functions[func_name] = {
-                                'parameters': json.dumps([{'name': param['name'], 'type': param['type']} for param in func['parameters']]),
-                                'return_type': func['return_type']
-                            }
-
-                    for cls in chunk_entities['classes']:
-                        cls_name = cls['name']
-                        if cls_name not in unique_classes:
-                            unique_classes[cls_name] = {
-                                'parameters': json.dumps([{'name': param['name'], 'type': param['type']} for param in cls['parameters']])
-                            }
-
-                # Store unique entities in the graph
-
-                for name, entities in unique_imports.items():
-                    self.kg.query("""
-                        MERGE (import:Import {name: $name, file_path: $file_path})
-                        SET import.entities = $entities
-                        WITH import
-                        MATCH (file:File {path: $file_path})
-                        MERGE (file)-[:CALLS]->(import)
-                    """, {
-                        'name': name,
-                        'entities': list(entities),
-                        'file_path': file
-                    })
-
-                for name, func in unique_functions.items():
-                    self.kg.query("""
-                        MERGE (function:Function {name: $name, file_path: $file_path})
-                        SET function.parameters = $parameters, function.return_type = $return_type
-                        WITH function
-                        MATCH (file:File {path: $file_path})
-                        MERGE (file)-[:DEFINES]->(function)
-                    """, {
-                        'name': name,
-                        'parameters': func['parameters'],
-                        'return_type': func['return_type'],
-                        'file_path': file
-                    })
-
-                for name, cls in unique_classes.items():
-                    self.kg.query("""
-                        MERGE (class:Class {name: $name, file_path: $file_path})
-                        SET class.parameters = $parameters
-                        WITH class
-                        MATCH (file:File {path: $file_path})
-                        MERGE (file)-[:DEFINES]->(class)
-                    """, {
-                        'name': name,
-                        'parameters': cls['parameters'],
-                        'file_path': file
-                    })
-
-                # Link all chunks in sequence using APOC's `NEXT` relationship
-                self.kg.query("""
-                    MATCH (file:File {path: $file_path})-[:CONTAINS]->(chunk:Chunk)
-                    WITH chunk ORDER BY chunk.id ASC
-                    WITH collect(chunk) AS chunks
-                    CALL apoc.nodes.link(chunks, 'NEXT')
-                    RETURN count(*)
-                """, {
-                    'file_path': file
-                })
+                self._mark_file_chunked(file, False)
+
+                #Chunks are summarized and written as the file is read, it is never held whole
+                chunk_count = 0
+                try:
+                    for idx, (start_index, chunk) in enumerate(iter_file_chunks(file, text_splitter, self.chunk_size)):
+                        chunk_count += 1
+                        file_span.add_bytes(bytes_in=len(chunk))
+                        chunk_id = project_chunk_id(self.project_id, file, idx)
+                        chunk_summary = summarize_file_chunk(chunk_text=chunk, file_name=file)
+                        summary_embedding = get_embedding(chunk_summary)
+                        chunk_embedding = get_embedding(chunk)
+                        progress.count(chunks_summarized=1, embeddings_written=2)
+
+                        # Create the chunk node and link it to the file
+                        self.kg.query("""
+                            MERGE (chunk:Chunk {id: $chunk_id, project_id: $project_id})
+                            SET chunk.raw_code = $raw_code, 
+                                chunk.file_path = $file_path,
+                                chunk.ordinal = $ordinal,
+                                chunk.start_index = $start_index,
+                                chunk.summary = $summary, 
+                                chunk.summary_embedding = $summary_embedding, 
+                                chunk.chunk_embedding = $chunk_embedding,
+                                chunk.chunk_splitter_used = $splitter_language
+                            WITH chunk
+                            MATCH (file:File {path: $file_path, project_id: $project_id})
+                            MERGE (file)-[:CONTAINS]->(chunk)
+                        """, {
+                            'chunk_id': chunk_id,
+                            'ordinal': idx,
+                            'start_index': start_index,
+                            'raw_code': chunk,
+                            'summary': chunk_summary,
+                            'summary_embedding': summary_embedding,
+                            'chunk_embedding': chunk_embedding,
+                            'file_path': file,
+                            'splitter_language': splitter_language,
+                            'project_id': self.project_id
+                        })
+
+                        try:
+                            chunk_entities = extract_code_entities(chunk)
+                        except Exception as e:
+                            print(f"An error occurred while extracting entities (import, func, class) in a chunk for Chunk [{chunk_id}]: {e} \n Passed extracting entities")
+                            continue
+
+                        collect_chunk_entities(chunk_entities, unique_imports, unique_functions, unique_classes)
+                except (OSError, UnicodeDecodeError) as e:
+                    #Left out like a file that could not be read at all, nothing of it is kept
+                    print(f"An error occurred while reading the file [{file}]: {e}")
+                    self._remove_file_chunks(file)
+                    progress.advance()
+                    continue
+
+                file_span.set(chunks=chunk_count)
+
+                if chunk_count:
+                    # Store unique entities in the graph
+                    self.store_file_entities(file, unique_imports, unique_functions, unique_classes)
+                    self._link_chunks(file)
+
+                self._mark_file_chunked(file, True)
+                progress.advance(files_chunked=1)
+
+    def store_file_entities(self, file, unique_imports, unique_functions, unique_classes):
+        """
+        Write a file's imports, functions and classes and link them to the file.
+
+        Imported entities are added to what the Import node already holds, so entities
+        from chunks stored at different times (batch ingestion) add up.
+
+        Args:
+            file (str): The path of the file the entities came from.
+            unique_imports (dict): Module name to the set of imported entities.
+            unique_functions (dict): Function name to its parameters and return type.
+            unique_classes (dict): Class name to its parameters.
+        """
+        for name, entities in unique_imports.items():
+            self.kg.query("""
+                MERGE (import:Import {name: $name, file_path: $file_path, project_id: $project_id})
+                SET import.entities = apoc.coll.toSet(coalesce(import.entities, []) + $entities)
+                WITH import
+                MATCH (file:File {path: $file_path, project_id: $project_id})
+                MERGE (file)-[:CALLS]->(import)
+            """, {
+                'name': name,
+                'entities': list(entities),
+                'file_path': file,
+                'project_id': self.project_id
+            })
+
+        for name, func in unique_functions.items():
+            self.kg.query("""
+                MERGE (function:Function {name: $name, file_path: $file_path, project_id: $project_id})
+                SET function.parameters = $parameters, function.return_type = $return_type
+                WITH function
+                MATCH (file:File {path: $file_path, project_id: $project_id})
+                MERGE (file)-[:DEFINES]->(function)
+            """, {
+                'name': name,
+                'parameters': func['parameters'],
+                'return_type': func['return_type'],
+                'file_path': file,
+                'project_id': self.project_id
+            })
+
+        for name, cls in unique_classes.items():
+            self.kg.query("""
+                MERGE (class:Class {name: $name, file_path: $file_path, project_id: $project_id})
+                SET class.parameters = $parameters
+                WITH class
+                MATCH (file:File {path: $file_path, project_id: $project_id})
+                MERGE (file)-[:DEFINES]->(class)
+            """, {
+                'name': name,
+                'parameters': cls['parameters'],
+                'file_path': file,
+                'project_id': self.project_id
+            })
+
+    def _remove_file_chunks(self, file):
+        """
+        Delete the chunks already written for a file that could not be read to the end.
+        """
+        self.kg.query("""
+            MATCH (file:File {path: $file_path, project_id: $project_id})-[:CONTAINS]->(chunk:Chunk)
+            DETACH DELETE chunk
+        """, {'file_path': file, 'project_id': self.project_id})
+
+    def _link_chunks(self, file):
+        """
+        Link all chunks of a file in sequence using APOC's `NEXT` relationship.
+        """
+        self.kg.query("""
+            MATCH (file:File {path: $file_path, project_id: $project_id})-[:CONTAINS]->(chunk:Chunk)
+            WITH chunk ORDER BY chunk.id ASC
+            WITH collect(chunk) AS chunks
+            CALL apoc.nodes.link(chunks, 'NEXT')
+            RETURN count(*)
+        """, {
+            'file_path': file,
+            'project_id': self.project_id
+        })
+
+    @traced("GraphBuilder.chunk_files")
+    def chunk_files(self, progress: IngestionProgress = None):
+        """
+        Split files without chunk nodes into chunks and store them without any model calls.
+
+        Used by batch ingestion: the chunks are left pending (no summary or embeddings, and
+        entities_pending set) for BatchGraphBuilder to fill in from batch results.
+
+        Args:
+            progress (IngestionProgress, optional): Counts files chunked and stops between files if cancelled.
+        """
+        progress = progress or IngestionProgress()
+
+        file_paths = self._files_to_chunk()
+        progress.start_stage("chunk", total=len(file_paths))
+
+        for file in tqdm(file_paths, desc='Creating chunks from files'):
+            text_splitter, splitter_language = get_text_splitter(file, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+            self._mark_file_chunked(file, False)
+
+            #Written a batch at a time as the file is read, neither the file nor all its chunks are held at once
+            batch = []
+            chunk_count = 0
+            try:
+                for idx, (start_index, chunk) in enumerate(iter_file_chunks(file, text_splitter, self.chunk_size)):
+                    batch.append({'chunk_id': project_chunk_id(self.project_id, file, idx), 'ordinal': idx, 'start_index': start_index, 'raw_code': chunk})
+                    chunk_count += 1
+                    if len(batch) >= CHUNK_WRITE_BATCH_SIZE:
+                        self._write_pending_chunks(file, batch, splitter_language)
+                        batch = []
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"An error occurred while reading the file [{file}]: {e}")
+                self._remove_file_chunks(file)
+                progress.advance()
+                continue
+            if batch:
+                self._write_pending_chunks(file, batch, splitter_language)
+
+            if chunk_count:
+                self._link_chunks(file)
+
+            self._mark_file_chunked(file, True)
+            progress.advance(files_chunked=1)
+
+    def _write_pending_chunks(self, file, chunks, splitter_language):
+        """
+        Store chunks without summaries or embeddings, marked entities_pending, and link them to their file.
+        """
+        self.kg.query("""
+            MATCH (file:File {path: $file_path, project_id: $project_id})
+            UNWIND $chunks AS row
+            MERGE (chunk:Chunk {id: row.chunk_id, project_id: $project_id})
+            SET chunk.raw_code = row.raw_code,
+                chunk.file_path = $file_path,
+                chunk.ordinal = row.ordinal,
+                chunk.start_index = row.start_index,
+                chunk.chunk_splitter_used = $splitter_language,
+                chunk.entities_pending = true
+            MERGE (file)-[:CONTAINS]->(chunk)
+        """, {
+            'chunks': chunks,
+            'file_path': file,
+            'splitter_language': splitter_language,
+            'project_id': self.project_id
+        })
 
     def _create_vector_index(self, label, property_name="summary_embeddings", index_name=None, dimensions=1536):
         """
@@ -188,6 +354,7 @@ class GraphBuilder:
         except Exception as e:
             print(f"An error occurred while creating the vector index: {e}")
 
+    @traced("GraphBuilder.create_all_vector_indexes")
     def create_all_vector_indexes(self):
         """
         Create vector indexes for chunks, files, and directories. The indexes are separated for chunks and summaries.
@@ -198,4 +365,104 @@ class GraphBuilder:
 
         # Create index for files and directories
         self._create_vector_index(label="File", property_name="summary_embedding", index_name="fileSummaryVectorIndex")
-        self._create_vector_index(label="Directory", property_name="summary_embedding", index_name="dirSummaryVectorIndex")
\ No newline at end of file
+        self._create_vector_index(label="Directory", property_name="summary_embedding", index_name="dirSummaryVectorIndex")
+
+    def _create_range_index(self, label, property_names, index_name):
+        """
+        Create a range index for the specified label and properties if it does not already exist.
+
+        Args:
+            label (str): The label of the nodes (e.g., 'File', 'Directory', 'Chunk').
+            property_names (list): The properties to index, more than one makes a composite index.
+            index_name (str): The name of the index.
+        """
+        properties = ", ".join(f"n.{property_name}" for property_name in property_names)
+
+        query = f"""
+        CREATE INDEX {index_name} IF NOT EXISTS
+        FOR (n:{label})
+        ON ({properties})
+        """
+        try:
+            self.kg.query(query)
+            print(f"Range index {index_name} for label {label} created successfully.")
+        except Exception as e:
+            print(f"An error occurred while creating the range index: {e}")
+
+    def _create_fulltext_index(self, labels, property_names, index_name):
+        """
+        Create a fulltext index over the given labels and properties if it does not already exist.
+
+        Args:
+            labels (list): The labels of the nodes to index (e.g., ['Function', 'Class']).
+            property_names (list): The text properties to index.
+            index_name (str): The name of the index.
+        """
+        label_expression = "|".join(labels)
+        properties = ", ".join(f"n.{property_name}" for property_name in property_names)
+
+        query = f"""
+        CREATE FULLTEXT INDEX {index_name} IF NOT EXISTS
+        FOR (n:{label_expression})
+        ON EACH [{properties}]
+        """
+        try:
+            self.kg.query(query)
+            print(f"Fulltext index {index_name} for labels {label_expression} created successfully.")
+        except Exception as e:
+            print(f"An error occurred while creating the fulltext index: {e}")
+
+    @traced("GraphBuilder.create_all_lookup_indexes")
+    def create_all_lookup_indexes(self):
+        """
+        Create the range indexes the retrievers use to look nodes up by key instead of scanning.
+        """
+        self._create_range_index(label="File", property_names=["name"], index_name="fileNameIndex")
+        self._create_range_index(label="File", property_names=["path"], index_name="filePathIndex")
+        self._create_range_index(label="Directory", property_names=["name"], index_name="dirNameIndex")
+        self._create_range_index(label="Directory", property_names=["path"], index_name="dirPathIndex")
+        self._create_range_index(label="Chunk", property_names=["id"], index_name="chunkIdIndex")
+        self._create_range_index(label="Chunk", property_names=["file_path", "ordinal"], index_name="chunkOrdinalIndex")
+
+        # Code entities, exact lookups per label plus one fulltext index for prefix and fuzzy lookups
+        self._create_range_index(label="Function", property_names=["name"], index_name="functionNameIndex")
+        self._create_range_index(label="Class", property_names=["name"], index_name="classNameIndex")
+        self._create_range_index(label="Import", property_names=["name"], index_name="importNameIndex")
+        self._create_fulltext_index(labels=["Function", "Class", "Import"], property_names=["name"], index_name="codeEntityNameIndex")
+
+        # Lexical leg of hybrid retrieval, fused with the vector indexes at query time
+        self._create_fulltext_index(labels=["Chunk"], property_names=["raw_code"], index_name="chunkRawFulltextIndex")
+        self._create_fulltext_index(labels=["Chunk"], property_names=["summary"], index_name="chunkSummaryFulltextIndex")
+        self._create_fulltext_index(labels=["File"], property_names=["summary"], index_name="fileSummaryFulltextIndex")
+
+        # Project scoped retrieval filters and per project deletes
+        for label in PROJECT_LABELS:
+            self._create_range_index(label=label, property_names=["project_id"], index_name=f"{label[0].lower()}{label[1:]}ProjectIndex")
+
+    @traced("GraphBuilder.backfill_chunk_ordinals")
+    def backfill_chunk_ordinals(self):
+        """
+        Set file_path and ordinal on chunks from graphs built before they were stored.
+
+        The ordinal is the zero padded index at the end of the chunk id (`<project>:<file>_chunk_000042`).
+        """
+        self.kg.query("""
+            MATCH (file:File)-[:CONTAINS]->(chunk:Chunk)
+            WHERE chunk.ordinal IS NULL
+            SET chunk.file_path = file.path,
+                chunk.ordinal = toInteger(last(split(chunk.id, '_chunk_')))
+        """)
+
+    @traced("GraphBuilder.backfill_project_ids")
+    def backfill_project_ids(self):
+        """
+        Tag the chunks and code entities of the project's files with the project.
+
+        Covers graphs built before nodes carried a project_id, and files that older builds moved to
+        this project when the same directory was ingested under a new project id.
+        """
+        self.kg.query("""
+            MATCH (file:File {project_id: $project_id})-[:CONTAINS|CALLS|DEFINES]->(n)
+            WHERE n.project_id IS NULL OR n.project_id <> $project_id
+            SET n.project_id = $project_id
+        """, {'project_id': self.project_id})
@@ -0,0 +1,122 @@
+import time
+import threading
+
+#Stages of a graph build in the order they run, with the label shown to users
+INGESTION_STAGES = {
+    "fetch": "Fetching source",
+    "delete": "Deleting the project's old nodes",
+    "import": "Importing a graph snapshot",
+    "walk": "Walking directories and files",
+    "chunk": "Chunking, summarizing and embedding files",
+    "batch": "Waiting on batch jobs",
+    "summarize_files": "Summarizing files",
+    "summarize_directories": "Summarizing directories",
+    "embed": "Embedding file and directory summaries",
+    "index": "Creating indexes",
+}
+
+class IngestionCancelled(Exception):
+    """
+    Raised inside a graph build once its job has been cancelled.
+    """
+
+class IngestionProgress:
+    def __init__(self, cancel_event: threading.Event = None):
+        """
+        Track how far a graph build has got, stage by stage, and carry its cancellation flag.
+
+        The build calls start_stage, advance and count as it works and the UI reads snapshot
+        from another thread. Every call checks the cancel event, so a cancelled build stops at
+        the next file, chunk or node instead of running to the end.
+
+        Args:
+            cancel_event (threading.Event, optional): Set to cancel the build.
+        """
+        self.cancel_event = cancel_event or threading.Event()
+
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._stage = None
+        self._stage_started = None
+        self._stage_done = 0
+        self._stage_total = None
+        self._finished_stages = []
+        self._counters = {}
+
+    def check_cancelled(self):
+        """
+        Raise IngestionCancelled if the build has been cancelled.
+        """
+        if self.cancel_event.is_set():
+            raise IngestionCancelled("Ingestion cancelled.")
+
+    def start_stage(self, stage, total=None):
+        """
+        Finish the current stage and start the next one.
+
+        Args:
+            stage (str): A key of INGESTION_STAGES.
+            total (int, optional): Units of work in the stage, None if unknown up front.
+        """
+        self.check_cancelled()
+        now = time.time()
+        with self._lock:
+            if self._stage is not None:
+                self._finished_stages.append({"stage": self._stage, "seconds": now - self._stage_started, "done": self._stage_done})
+            self._stage = stage
+            self._stage_started = now
+            self._stage_done = 0
+            self._stage_total = total
+
+    def advance(self, n=1, **counters):
+        """
+        Mark n units of the current stage done, and bump any named counters.
+        """
+        self.check_cancelled()
+        with self._lock:
+            self._stage_done += n
+            for name, value in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def count(self, **counters):
+        """
+        Bump named counters (e.g. chunks_summarized=1) without moving the stage along.
+        """
+        self.advance(0, **counters)
+
+    def finish(self):
+        """
+        Close the last stage.
+        """
+        now = time.time()
+        with self._lock:
+            if self._stage is not None:
+                self._finished_stages.append({"stage": self._stage, "seconds": now - self._stage_started, "done": self._stage_done})
+                self._stage = None
+
+    def snapshot(self):
+        """
+        A copy of the progress so far, safe to read from any thread.
+
+        Returns:
+            dict: The current stage with done and total units and its ETA in seconds (None until
+                one unit is done or if the total is unknown), the finished stages with their durations,
+                the counters, and the elapsed seconds.
+        """
+        now = time.time()
+        with self._lock:
+            eta = None
+            if self._stage is not None and self._stage_total is not None and self._stage_done > 0:
+                rate = (now - self._stage_started) / self._stage_done
+                eta = rate * max(self._stage_total - self._stage_done, 0)
+
+            return {
+                "stage": self._stage,
+                "stage_label": INGESTION_STAGES.get(self._stage, self._stage),
+                "stage_done": self._stage_done,
+                "stage_total": self._stage_total,
+                "stage_eta_seconds": eta,
+                "finished_stages": list(self._finished_stages),
+                "counters": dict(self._counters),
+                "elapsed_seconds": now - self._started,
+            }
@@ -0,0 +1,141 @@
+import os
+import re
+
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.gpt_helpers.graph_version import bump_graph_version
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.monitoring.tracing import traced
+
+#Every node a build writes carries a project_id, so several codebases can share one database
+#and each can be searched, removed or reloaded on its own.
+DEFAULT_PROJECT_ID = os.getenv("EDOC_PROJECT_ID", "default")
+
+#Labels tagged with a project_id, in the order a delete removes them (most numerous first)
+PROJECT_LABELS = ["Chunk", "Function", "Class", "Import", "File", "Directory", "EdocBatch", "EdocMeta"]
+
+#Nodes deleted per transaction, and per round between progress updates and cancel checks
+DELETE_BATCH_SIZE = int(os.getenv("EDOC_DELETE_BATCH_SIZE", "10000"))
+DELETE_BATCHES_PER_ROUND = 10
+
+_UNSAFE_PROJECT_CHARACTERS = re.compile(r"[^0-9A-Za-z_.-]+")
+
+def project_id_for_directory(root_directory):
+    """
+    The project id a directory is ingested under when none is given, its cleaned up folder name.
+
+    Args:
+        root_directory (str): The directory being ingested.
+
+    Returns:
+        str: e.g. 'my-repo' for '/data/edocSourceData/My Repo'.
+    """
+    name = os.path.basename(os.path.normpath(str(root_directory)))
+    project_id = _UNSAFE_PROJECT_CHARACTERS.sub("-", name).strip("-").lower()
+    return project_id or DEFAULT_PROJECT_ID
+
+def project_chunk_id_prefix(project_id):
+    """
+    What every chunk id of a project starts with.
+    """
+    return f"{project_id}:"
+
+def project_chunk_id(project_id, file_path, ordinal):
+    """
+    The id of a file's chunk, led by the project so the same path in two projects never shares a chunk.
+
+    Returns:
+        str: e.g. 'my-repo:/data/my-repo/main.py_chunk_000042'.
+    """
+    return f"{project_chunk_id_prefix(project_id)}{file_path}_chunk_{ordinal:06d}"
+
+def chunk_file_path(project_id, chunk_id):
+    """
+    The path of the file a chunk id from project_chunk_id belongs to.
+    """
+    return chunk_id.removeprefix(project_chunk_id_prefix(project_id)).rsplit("_chunk_", 1)[0]
+
+def list_projects(kg: Neo4jGraph):
+    """
+    The projects in the graph and how many files each holds.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+
+    Returns:
+        list: Dicts with project_id and files, ordered by project_id.
+    """
+    result = kg.query("""
+        MATCH (file:File)
+        WHERE file.project_id IS NOT NULL
+        RETURN file.project_id AS project_id, count(*) AS files
+        ORDER BY project_id ASC
+    """)
+    return [{"project_id": record["project_id"], "files": record["files"]} for record in result]
+
+def count_project_nodes(kg: Neo4jGraph, project_id):
+    """
+    Count a project's nodes, one project_id index seek per label.
+
+    Returns:
+        int: The number of nodes tagged with the project.
+    """
+    subqueries = "\nUNION ALL\n".join(
+        f"MATCH (n:{label} {{project_id: $project_id}}) RETURN count(n) AS count"
+        for label in PROJECT_LABELS
+    )
+    result = kg.query(f"CALL {{\n{subqueries}\n}}\nRETURN sum(count) AS count", {"project_id": project_id})
+    return result[0]["count"] if result else 0
+
+@traced("delete_project")
+def delete_project(kg: Neo4jGraph, project_id, batch_size=DELETE_BATCH_SIZE, progress: IngestionProgress = None):
+    """
+    Delete every node of one project, in bounded transactions, leaving other projects alone.
+
+    Each round matches a slice of the project's nodes and detaches and deletes them with
+    `CALL { ... } IN TRANSACTIONS`, committing every batch_size nodes, so the delete never holds
+    the whole project in one transaction however large it is. Progress is reported and the
+    cancel flag checked between rounds; a cancelled delete can simply be run again.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too. Its queries run as auto commit transactions,
+            which `IN TRANSACTIONS` needs.
+        project_id (str): The project to delete.
+        batch_size (int): Nodes deleted per transaction. Defaults to EDOC_DELETE_BATCH_SIZE.
+        progress (IngestionProgress, optional): Gets a 'delete' stage counting nodes_deleted.
+
+    Returns:
+        int: The number of nodes deleted.
+
+    Raises:
+        IngestionCancelled: If the progress' cancel event was set between rounds.
+    """
+    progress = progress or IngestionProgress()
+    progress.start_stage("delete", total=count_project_nodes(kg, project_id))
+
+    deleted = 0
+    for label in PROJECT_LABELS:
+        while True:
+            result = kg.query(f"""
+                MATCH (n:{label} {{project_id: $project_id}})
+                WITH n LIMIT $round_size
+                CALL {{
+                    WITH n
+                    DETACH DELETE n
+                }} IN TRANSACTIONS OF $batch_size ROWS
+                RETURN count(*) AS deleted
+            """, {
+                "project_id": project_id,
+                "round_size": batch_size * DELETE_BATCHES_PER_ROUND,
+                "batch_size": batch_size,
+            })
+            round_deleted = result[0]["deleted"] if result else 0
+            if not round_deleted:
+                break
+            deleted += round_deleted
+            progress.advance(round_deleted, nodes_deleted=round_deleted)
+
+    #Cached stores, matchers and answers compare against the version
+    bump_graph_version(kg)
+    print(f"Deleted {deleted} nodes of project [{project_id}]")
+    return deleted
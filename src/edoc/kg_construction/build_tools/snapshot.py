@@ -0,0 +1,383 @@
+import os
+import json
+import gzip
+from datetime import datetime
+from itertools import islice
+
+import numpy as np
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.gpt_helpers.graph_version import bump_graph_version
+from edoc.kg_construction.build_tools.graph_builder import GraphBuilder
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.kg_construction.build_tools.projects import project_chunk_id_prefix
+from edoc.rag_components.vector_registry import VECTOR_INDEX_SPECS
+from edoc.monitoring.tracing import span, traced
+
+#A snapshot is a directory holding one project's code graph, everything the summaries and embeddings
+#cost to make, so a new environment can be stood up without a single model call:
+#   manifest.json                       format, project, counts and the columns of each label
+#   <Label>.jsonl.gz                    the label's properties, a line per export page holding one list per property (columnar)
+#   <Label>.<property>.npy              the label's embeddings as one contiguous float32 matrix
+#   <Label>.<property>.rows.npy         the row of each embedding, nodes missing one are left out
+#   relationships.npz                   per relationship type and labels, (start row, end row) int32 pairs
+
+#Bumped when the files change, older snapshots are refused rather than half imported
+SNAPSHOT_FORMAT = 2
+
+#Labels in a snapshot, in import order so a relationship's ends exist before it, and the
+#properties each is merged on (the same keys the builders merge on)
+SNAPSHOT_NODE_KEYS = {
+    "Directory": ["name", "path", "project_id"],
+    "File": ["name", "path", "project_id"],
+    "Chunk": ["id", "project_id"],
+    "Function": ["name", "file_path", "project_id"],
+    "Class": ["name", "file_path", "project_id"],
+    "Import": ["name", "file_path", "project_id"],
+}
+SNAPSHOT_RELATIONSHIP_TYPES = ["CONTAINS", "NEXT", "DEFINES", "CALLS"]
+
+#Properties each label is exported in order of, unique within a project and led by a property with
+#a range index (create_all_lookup_indexes), so every page is an index seek from where the last one ended
+SNAPSHOT_PAGE_KEYS = {
+    "Directory": ["path"],
+    "File": ["path"],
+    "Chunk": ["id"],
+    "Function": ["name", "file_path"],
+    "Class": ["name", "file_path"],
+    "Import": ["name", "file_path"],
+}
+
+#Properties stored as float32 matrices rather than columns, every embedding a vector index covers
+EMBEDDING_PROPERTIES = {}
+for _spec in VECTOR_INDEX_SPECS.values():
+    EMBEDDING_PROPERTIES.setdefault(_spec["node_label"], []).append(_spec["embedding_property"])
+
+#Nodes read per round trip while exporting, and nodes or relationships written per UNWIND while importing
+SNAPSHOT_EXPORT_BATCH_SIZE = 2000
+SNAPSHOT_IMPORT_BATCH_SIZE = int(os.getenv("EDOC_SNAPSHOT_BATCH_SIZE", "2000"))
+
+def _export_page_query(label, first_page):
+    """
+    Build the query reading one page of a label, ordered by its page keys and starting after $after.
+    """
+    keys = SNAPSHOT_PAGE_KEYS[label]
+    order = ", ".join(f"n.{key}" for key in keys)
+
+    if first_page:
+        where = ""
+    elif len(keys) == 1:
+        where = f"WHERE n.{keys[0]} > $after[0]"
+    else:
+        #The range on the leading key is what the index seeks on, the rest breaks ties within it
+        where = f"WHERE n.{keys[0]} >= $after[0] AND (n.{keys[0]} > $after[0] OR n.{keys[1]} > $after[1])"
+
+    #Embeddings come back apart from the other properties, they go to the label's matrices
+    return f"""
+        MATCH (n:{label} {{project_id: $project_id}})
+        {where}
+        WITH n ORDER BY {order} LIMIT $limit
+        RETURN elementId(n) AS element_id, [{order}] AS page_key,
+               [key IN keys(n) WHERE NOT key IN $embedding_properties | [key, n[key]]] AS properties,
+               [name IN $embedding_properties | n[name]] AS embeddings,
+               [(n)-[r]->(m) WHERE type(r) IN $types AND m.project_id = $project_id | [type(r), elementId(m)]] AS relationships
+    """
+
+def _open_embedding_matrices(kg: Neo4jGraph, directory, label, project_id):
+    """
+    Create the label's embedding matrices on disk, sized from a count of the nodes that have each embedding.
+
+    Returns:
+        dict: Embedding property to [matrix, rows, rows filled so far], the arrays memory mapped .npy files.
+
+    Raises:
+        ValueError: If a label's embeddings do not all have the same dimensions.
+    """
+    matrices = {}
+    for name in EMBEDDING_PROPERTIES.get(label, []):
+        result = kg.query(f"""
+            MATCH (n:{label} {{project_id: $project_id}})
+            WHERE n.{name} IS NOT NULL
+            RETURN count(n) AS count, min(size(n.{name})) AS min_dimensions, max(size(n.{name})) AS max_dimensions
+        """, {"project_id": project_id})
+        count = result[0]["count"] if result else 0
+        if not count:
+            continue
+        if result[0]["min_dimensions"] != result[0]["max_dimensions"]:
+            raise ValueError(f"{label}.{name} holds embeddings of different sizes, they cannot share a matrix")
+
+        matrix = np.lib.format.open_memmap(
+            os.path.join(directory, f"{label}.{name}.npy"), mode="w+", dtype=np.float32,
+            shape=(count, result[0]["max_dimensions"])
+        )
+        rows = np.lib.format.open_memmap(
+            os.path.join(directory, f"{label}.{name}.rows.npy"), mode="w+", dtype=np.int32, shape=(count,)
+        )
+        matrices[name] = [matrix, rows, 0]
+    return matrices
+
+def _export_label(kg: Neo4jGraph, directory, label, project_id, rows_by_element_id, relationships):
+    """
+    Write every node of a label in the project to the snapshot, a page at a time, and collect its
+    outgoing relationships inside the snapshot.
+
+    Only the page being read is held; its properties are appended to the label's JSON lines and its
+    embeddings written into the memory mapped matrices.
+
+    Args:
+        rows_by_element_id (dict): Filled with element id to (label, row) for every node written.
+        relationships (list): Extended with (type, start element id, end element id) for every relationship read.
+
+    Returns:
+        dict: The label's manifest entry.
+
+    Raises:
+        ValueError: If the project changed while it was being exported.
+    """
+    embedding_properties = EMBEDDING_PROPERTIES.get(label, [])
+    matrices = _open_embedding_matrices(kg, directory, label, project_id)
+    columns = set()
+    count = 0
+
+    with gzip.open(os.path.join(directory, f"{label}.jsonl.gz"), "wt", encoding="utf-8") as f:
+        #Keyset pagination on the label's page keys, see SNAPSHOT_PAGE_KEYS
+        after = None
+        while True:
+            result = kg.query(_export_page_query(label, first_page=after is None), {
+                "project_id": project_id,
+                "after": after,
+                "limit": SNAPSHOT_EXPORT_BATCH_SIZE,
+                "types": SNAPSHOT_RELATIONSHIP_TYPES,
+                "embedding_properties": embedding_properties,
+            })
+            if not result:
+                break
+            after = result[-1]["page_key"]
+
+            page = [dict(record["properties"]) for record in result]
+            page_columns = sorted({name for row in page for name in row})
+            columns.update(page_columns)
+            f.write(json.dumps({name: [row.get(name) for row in page] for name in page_columns}) + "\n")
+
+            for offset, record in enumerate(result):
+                row = count + offset
+                rows_by_element_id[record["element_id"]] = (label, row)
+                relationships.extend((relationship_type, record["element_id"], end) for relationship_type, end in record["relationships"])
+
+                for name, embedding in zip(embedding_properties, record["embeddings"]):
+                    if not embedding:
+                        continue
+                    if name not in matrices or matrices[name][2] >= len(matrices[name][1]):
+                        raise ValueError(f"Project [{project_id}] changed while it was being exported, export it again")
+                    matrix, rows, filled = matrices[name]
+                    matrix[filled] = embedding
+                    rows[filled] = row
+                    matrices[name][2] = filled + 1
+
+            count += len(result)
+            if len(result) < SNAPSHOT_EXPORT_BATCH_SIZE:
+                break
+
+    embeddings = {}
+    for name, (matrix, rows, filled) in matrices.items():
+        if filled != len(rows):
+            raise ValueError(f"Project [{project_id}] changed while it was being exported, export it again")
+        matrix.flush()
+        rows.flush()
+        embeddings[name] = {"count": filled, "dimensions": int(matrix.shape[1])}
+
+    return {"count": count, "columns": sorted(columns), "embeddings": embeddings}
+
+@traced("export_snapshot")
+def export_snapshot(kg: Neo4jGraph, project_id, directory):
+    """
+    Export a project's code graph (directories, files, chunks and code entities, with their
+    summaries, embeddings and relationships) to a snapshot directory.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+        project_id (str): The project to export.
+        directory (str): Where to write the snapshot, created if missing. Files of an earlier snapshot are replaced.
+
+    Returns:
+        dict: The snapshot's manifest.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    rows_by_element_id = {}
+    relationships = []
+    nodes = {}
+    for label in SNAPSHOT_NODE_KEYS:
+        with span("export_snapshot.label", label=label) as label_span:
+            nodes[label] = _export_label(kg, directory, label, project_id, rows_by_element_id, relationships)
+            label_span.set(nodes=nodes[label]["count"])
+
+    #Relationships are stored as rows of the labels' tables, grouped by type and end labels
+    grouped = {}
+    for relationship_type, start, end in relationships:
+        if end not in rows_by_element_id:
+            continue
+        start_label, start_row = rows_by_element_id[start]
+        end_label, end_row = rows_by_element_id[end]
+        grouped.setdefault(f"{relationship_type}|{start_label}|{end_label}", []).append((start_row, end_row))
+
+    np.savez(
+        os.path.join(directory, "relationships.npz"),
+        **{name: np.asarray(pairs, dtype=np.int32) for name, pairs in grouped.items()}
+    )
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "project_id": project_id,
+        "created": datetime.now().isoformat(),
+        "nodes": nodes,
+        "relationships": {name: len(pairs) for name, pairs in grouped.items()},
+    }
+    with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Exported project [{project_id}] to {directory}: {sum(entry['count'] for entry in nodes.values())} nodes, "
+          f"{sum(manifest['relationships'].values())} relationships")
+    return manifest
+
+def read_snapshot_manifest(directory):
+    """
+    Read a snapshot's manifest.
+
+    Raises:
+        ValueError: If the directory holds no snapshot, or one in a format this version cannot read.
+    """
+    manifest_path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"No graph snapshot found in {directory}")
+
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Snapshot format {manifest.get('format')} is not supported, expected {SNAPSHOT_FORMAT}")
+    return manifest
+
+def _iter_label_rows(directory, label, entry, project_id, exported_project_id):
+    """
+    Rebuild a label's property dicts one at a time from its column pages and embedding matrices.
+
+    Rows are tagged with project_id, and chunk ids led by the exported project are led by it instead.
+
+    The matrices are memory mapped and each embedding is turned into a list only when its row
+    is reached, so no more than the import batch being built is ever held.
+    """
+    embeddings = {}
+    for name in entry["embeddings"]:
+        matrix = np.load(os.path.join(directory, f"{label}.{name}.npy"), mmap_mode="r")
+        #Row of the label to row of the matrix, -1 for nodes without this embedding
+        matrix_rows = np.full(entry["count"], -1, dtype=np.int64)
+        matrix_rows[np.load(os.path.join(directory, f"{label}.{name}.rows.npy"), mmap_mode="r")] = np.arange(len(matrix))
+        embeddings[name] = (matrix, matrix_rows)
+
+    exported_prefix = project_chunk_id_prefix(exported_project_id)
+    row_number = 0
+    with gzip.open(os.path.join(directory, f"{label}.jsonl.gz"), "rt", encoding="utf-8") as f:
+        for line in f:
+            page = json.loads(line)
+            page_size = len(next(iter(page.values()), []))
+            for offset in range(page_size):
+                row = {name: values[offset] for name, values in page.items() if values[offset] is not None}
+                for name, (matrix, matrix_rows) in embeddings.items():
+                    if matrix_rows[row_number] >= 0:
+                        row[name] = matrix[matrix_rows[row_number]].tolist()
+                row["project_id"] = project_id
+                if label == "Chunk" and project_id != exported_project_id and row["id"].startswith(exported_prefix):
+                    row["id"] = project_chunk_id_prefix(project_id) + row["id"][len(exported_prefix):]
+                yield row
+                row_number += 1
+
+def _merge_pattern(variable, label, key_source):
+    keys = ", ".join(f"{name}: {key_source}.{name}" for name in SNAPSHOT_NODE_KEYS[label])
+    return f"({variable}:{label} {{{keys}}})"
+
+@traced("import_snapshot")
+def import_snapshot(kg: Neo4jGraph, directory, project_id=None, batch_size=SNAPSHOT_IMPORT_BATCH_SIZE, progress: IngestionProgress = None):
+    """
+    Load a snapshot written by export_snapshot into the graph, without any model calls.
+
+    Nodes and relationships are merged on the builders' keys in UNWIND batches, so importing
+    into a graph that already holds some of them, or running a cancelled import again, is safe.
+    Those keys include the project, so importing under a new name copies the project even into
+    the graph it was exported from; chunk ids are renamed with it.
+    The lookup indexes are created first so each merge is an index seek, the vector indexes
+    after, and they fill from the imported embeddings.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+        directory (str): The snapshot directory.
+        project_id (str, optional): The project to import under. Defaults to the project the snapshot was exported from.
+        batch_size (int): Nodes or relationships per transaction. Defaults to EDOC_SNAPSHOT_BATCH_SIZE.
+        progress (IngestionProgress, optional): Gets an 'import' stage counting nodes_imported and relationships_imported.
+
+    Returns:
+        str: The project imported.
+
+    Raises:
+        ValueError: If the directory holds no readable snapshot.
+        IngestionCancelled: If the progress' cancel event was set between batches.
+    """
+    manifest = read_snapshot_manifest(directory)
+    project_id = project_id or manifest["project_id"]
+    progress = progress or IngestionProgress()
+
+    graph_builder = GraphBuilder(kg, project_id=project_id)
+    graph_builder.create_all_lookup_indexes()
+
+    total = sum(entry["count"] for entry in manifest["nodes"].values()) + sum(manifest["relationships"].values())
+    progress.start_stage("import", total=total)
+
+    #Only the merge keys of every node are kept, for the relationships; the rows are built a batch at a time
+    keys_by_label = {}
+    for label, entry in manifest["nodes"].items():
+        with span("import_snapshot.label", label=label, nodes=entry["count"]):
+            keys = keys_by_label[label] = []
+
+            query = f"""
+                UNWIND $rows AS row
+                MERGE {_merge_pattern("n", label, "row")}
+                SET n += row
+            """
+            rows = _iter_label_rows(directory, label, entry, project_id, manifest["project_id"])
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                keys.extend({name: row.get(name) for name in SNAPSHOT_NODE_KEYS[label]} for row in batch)
+                kg.query(query, {"rows": batch})
+                progress.advance(len(batch), nodes_imported=len(batch))
+
+    with np.load(os.path.join(directory, "relationships.npz")) as relationships:
+        for name in relationships.files:
+            relationship_type, start_label, end_label = name.split("|")
+            pairs = relationships[name]
+
+            with span("import_snapshot.relationships", relationship_type=relationship_type, relationships=len(pairs)):
+                query = f"""
+                    UNWIND $rows AS row
+                    MATCH {_merge_pattern("source", start_label, "row.start")}
+                    MATCH {_merge_pattern("target", end_label, "row.end")}
+                    MERGE (source)-[:{relationship_type}]->(target)
+                """
+                for offset in range(0, len(pairs), batch_size):
+                    batch = [
+                        {"start": keys_by_label[start_label][start_row], "end": keys_by_label[end_label][end_row]}
+                        for start_row, end_row in pairs[offset:offset + batch_size]
+                    ]
+                    kg.query(query, {"rows": batch})
+                    progress.advance(len(batch), relationships_imported=len(batch))
+
+    progress.start_stage("index", total=1)
+    graph_builder.create_all_vector_indexes()
+    progress.advance()
+    progress.finish()
+
+    #Cached stores, matchers and answers compare against the version
+    bump_graph_version(kg)
+    print(f"Imported project [{project_id}] from {directory}: {total} nodes and relationships")
+    return project_id
@@ -1,31 +1,37 @@
 import os
-from edoc.gpt_helpers.gpt_basics import create_chat_completion
+import re
+import json
+from edoc.gpt_helpers.gpt_basics import create_chat_completion, get_chat_model
+from edoc.gpt_helpers.stand_ins import uses_stand_in_models, stand_in_code_entities, stand_in_usage
+from edoc.monitoring.tracing import span
 from pydantic import BaseModel, Field
 from typing import List, Optional
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.text_splitter import Language
 
-from edoc.gpt_helpers.connect import OpenAiConfig
+#Prompts for extract_code_entities, also sent as is by batch ingestion
+CODE_ENTITIES_SYSTEM_PROMPT = (
+    "You are extracting imports, function names, and class names from the given code. "
+    "For imports, provide the module and specific entities being imported. "
+    "For functions and classes, include their parameters and types if available."
+)
+CODE_ENTITIES_HUMAN_PROMPT = "Use the given format to extract information from the following input: {code_snippet}"
 
-OPENAI_API_KEY = OpenAiConfig.get_openai_api_key()
-
-def summarize_file_chunk(chunk_text, file_name, model='gpt-4o-mini'):
+def file_chunk_summary_prompt(chunk_text, file_name):
     """
-    Summarize a chunk of text from a file using OpenAI's language model.
+    Build the chat messages asking for a summary of a chunk of a file.
 
     Args:
         chunk_text (str): The text chunk to summarize.
         file_name (str): The name of the file from which the chunk was extracted.
-        model (str): The OpenAI model to use. Default is 'gpt-4o-mini'.
 
     Returns:
-        str: A brief and clear summary of the chunk.
+        list: The messages for a chat completion.
     """
-    prompt = [
+    return [
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": f"""You are helping to summarize code chunks. 
         Please summarize the given chunk of text from the file `{file_name}`. 
@@ -37,6 +43,20 @@ def summarize_file_chunk(chunk_text, file_name, model='gpt-4o-mini'):
         **Summary**:
         <fill in>"""}
     ]
+
+def summarize_file_chunk(chunk_text, file_name, model='gpt-4o-mini'):
+    """
+    Summarize a chunk of text from a file using OpenAI's language model.
+
+    Args:
+        chunk_text (str): The text chunk to summarize.
+        file_name (str): The name of the file from which the chunk was extracted.
+        model (str): The OpenAI model to use. Default is 'gpt-4o-mini'.
+
+    Returns:
+        str: A brief and clear summary of the chunk.
+    """
+    prompt = file_chunk_summary_prompt(chunk_text, file_name)
     
     return create_chat_completion(messages=prompt, model=model)
 
@@ -95,23 +115,19 @@ def extract_code_entities(code_string, model='gpt-4o-mini'):
     Returns:
         entities: An instance of CodeEntities containing the extracted imports, functions, and classes.
     """
-
-    llm=ChatOpenAI(
-        model_name=model,
-        api_key=OPENAI_API_KEY
-    )
+    if uses_stand_in_models():
+        #The stand in chat model has no structured output, the entities are picked out locally
+        with span("llm.code_entities", "llm", model=model) as current:
+            entities = stand_in_code_entities(code_string)
+            usage = stand_in_usage(code_string, json.dumps(entities))
+            current.add_tokens(tokens_in=usage["input_tokens"], tokens_out=usage["output_tokens"])
+            return entities
+
+    llm = get_chat_model(model=model)
     prompt = ChatPromptTemplate.from_messages(
         [
-            (
-                "system",
-                "You are extracting imports, function names, and class names from the given code. "
-                "For imports, provide the module and specific entities being imported. "
-                "For functions and classes, include their parameters and types if available.",
-            ),
-            (
-                "human",
-                "Use the given format to extract information from the following input: {code_snippet}",
-            ),
+            ("system", CODE_ENTITIES_SYSTEM_PROMPT),
+            ("human", CODE_ENTITIES_HUMAN_PROMPT),
         ]
     )
 
@@ -141,6 +157,227 @@ def read_file_contents(file_path):
         print(f"An error occurred while reading the file [{file_path}]: {e}")
         return None
 
+#Characters read from a file per step of iter_file_chunks, as a multiple of the chunk size. A
+#separator match longer than a block across a block's end is not seen.
+STREAM_BLOCK_CHUNKS = 4
+
+def _read_blocks(file, block_size):
+    while True:
+        block = file.read(block_size)
+        if not block:
+            return
+        yield block
+
+def _separator_pattern(text_splitter, separator):
+    return re.compile(separator if text_splitter._is_separator_regex else re.escape(separator))
+
+def _first_separator(text_splitter, separators, blocks, margin):
+    """
+    The separator RecursiveCharacterTextSplitter._split_text splits a text on, and the ones left for its long pieces.
+
+    The first separator found anywhere in the text, found here a block at a time.
+
+    Args:
+        text_splitter (RecursiveCharacterTextSplitter): The splitter.
+        separators (list): The separators to choose from, in order.
+        blocks (iterable): The text, in blocks.
+        margin (int): Characters of a block searched again with the next, for matches across their boundary.
+
+    Returns:
+        tuple: (separator, remaining separators).
+    """
+    patterns = []
+    for index, separator in enumerate(separators):
+        if separator == "":
+            break
+        patterns.append((index, _separator_pattern(text_splitter, separator)))
+
+    found = set()
+    tail = ""
+    for block in blocks:
+        if not patterns:
+            break
+        text = tail + block
+        for index, pattern in patterns:
+            if pattern.search(text):
+                found.add(index)
+        if found:
+            #Separators after one already found can no longer be the first
+            patterns = [(index, pattern) for index, pattern in patterns if index < min(found)]
+        tail = text[-margin:]
+
+    for index, separator in enumerate(separators):
+        if separator == "":
+            return separator, []
+        if index in found:
+            return separator, separators[index + 1:]
+    return separators[-1], []
+
+def _iter_pieces(text_splitter, separator, blocks, margin, start_index=0):
+    """
+    Split a text on one separator as it is read, into the pieces _split_text_with_regex makes of it whole.
+
+    Only the piece being read and the next block are held.
+
+    Args:
+        text_splitter (RecursiveCharacterTextSplitter): The splitter, for whether and where separators are kept.
+        separator (str): The separator.
+        blocks (iterable): The text, in blocks.
+        margin (int): Matches ending this close to the end of what was read wait for the next block.
+        start_index (int): The offset of the text's first character.
+
+    Yields:
+        tuple: (start_index, piece).
+    """
+    if separator == "":
+        for block in blocks:
+            for character in block:
+                yield start_index, character
+                start_index += 1
+        return
+
+    pattern = _separator_pattern(text_splitter, separator)
+    keep_separator = text_splitter._keep_separator
+
+    #buffer_start is the offset of buffer[0], the piece being read starts at piece_from
+    buffer = ""
+    buffer_start = start_index
+    piece_from = 0
+    search_from = 0
+    blocks = iter(blocks)
+    at_end = False
+
+    while not at_end:
+        block = next(blocks, "")
+        at_end = not block
+        buffer += block
+
+        #A match this close to the end could still change once the next block is read
+        settled = len(buffer) if at_end else len(buffer) - margin
+        for match in pattern.finditer(buffer, search_from):
+            if match.end() > settled:
+                break
+            if keep_separator == "end":
+                piece_to = next_from = match.end()
+            elif keep_separator:
+                piece_to = next_from = match.start()
+            else:
+                piece_to, next_from = match.start(), match.end()
+
+            if piece_to > piece_from:
+                yield buffer_start + piece_from, buffer[piece_from:piece_to]
+            piece_from = next_from
+            search_from = match.end()
+
+        if at_end:
+            if len(buffer) > piece_from:
+                yield buffer_start + piece_from, buffer[piece_from:]
+        else:
+            buffer = buffer[piece_from:]
+            buffer_start += piece_from
+            search_from -= piece_from
+            piece_from = 0
+
+def _join_pieces(text_splitter, pieces, separator):
+    """
+    The chunk _merge_splits joins from pieces, with its offset, or None if it is only whitespace.
+    """
+    text = separator.join(piece for _, piece in pieces)
+    chunk = text.strip() if text_splitter._strip_whitespace else text
+    if chunk == "":
+        return None
+    leading = len(text) - len(text.lstrip()) if text_splitter._strip_whitespace else 0
+    return pieces[0][0] + leading, chunk
+
+def _iter_chunks(text_splitter, pieces, separator, new_separators, margin):
+    """
+    Turn the pieces of a text split on separator into chunks, as RecursiveCharacterTextSplitter._split_text does.
+
+    Short pieces are merged as they arrive, with the splitter's overlap (_merge_splits). A long
+    piece ends the run of short ones and is split on its own with the remaining separators.
+
+    Yields:
+        tuple: (start_index, chunk).
+    """
+    length = text_splitter._length_function
+    limit = text_splitter._chunk_size
+    overlap = text_splitter._chunk_overlap
+    #Kept separators are part of the pieces, the others are put back between them
+    merge_separator = "" if text_splitter._keep_separator else separator
+    separator_len = length(merge_separator)
+
+    #The run of short pieces being merged, and its length with separators
+    current = []
+    total = 0
+
+    for offset, piece in pieces:
+        piece_len = length(piece)
+        if piece_len < limit:
+            #Close the chunk when the piece does not fit, then drop pieces from its start until
+            #what is left is no longer than the overlap and the piece fits
+            if total + piece_len + (separator_len if current else 0) > limit and current:
+                joined = _join_pieces(text_splitter, current, merge_separator)
+                if joined is not None:
+                    yield joined
+                while total > overlap or (total + piece_len + (separator_len if current else 0) > limit and total > 0):
+                    total -= length(current[0][1]) + (separator_len if len(current) > 1 else 0)
+                    current.pop(0)
+            current.append((offset, piece))
+            total += piece_len + (separator_len if len(current) > 1 else 0)
+            continue
+
+        if current:
+            joined = _join_pieces(text_splitter, current, merge_separator)
+            if joined is not None:
+                yield joined
+            current = []
+            total = 0
+
+        if not new_separators:
+            yield offset, piece
+            continue
+
+        piece_separator, piece_new_separators = _first_separator(text_splitter, new_separators, [piece], margin)
+        piece_pieces = _iter_pieces(text_splitter, piece_separator, [piece], margin, start_index=offset)
+        yield from _iter_chunks(text_splitter, piece_pieces, piece_separator, piece_new_separators, margin)
+
+    if current:
+        joined = _join_pieces(text_splitter, current, merge_separator)
+        if joined is not None:
+            yield joined
+
+def iter_file_chunks(file_path, text_splitter, chunk_size, block_chunks=STREAM_BLOCK_CHUNKS):
+    """
+    Split a file into chunks as it is read, the same chunks as reading it whole and calling split_text.
+
+    This is RecursiveCharacterTextSplitter's split run over the file as a stream. The file is read
+    once to find the separator the splitter would split it on first, then again a block at a time
+    and cut on that separator into pieces, which are merged or split further as split_text does.
+    Only the piece being read, the next block and the chunk being merged are held, so memory is
+    bound by the longest top level piece (a class, a function, a paragraph) rather than the file.
+
+    Args:
+        file_path (str): The path to the file to be read.
+        text_splitter (RecursiveCharacterTextSplitter): The splitter from get_text_splitter.
+        chunk_size (int): The splitter's chunk size in characters.
+        block_chunks (int): Chunk sizes of text read per step. Default is STREAM_BLOCK_CHUNKS.
+
+    Yields:
+        tuple: (start_index, chunk), the chunk's character offset in the file and its text.
+
+    Raises:
+        OSError: If the file cannot be opened or read.
+        UnicodeDecodeError: If the file is not valid UTF-8. It is found by the first read, before any chunk is yielded.
+    """
+    block_size = max(chunk_size * block_chunks, 1)
+
+    with open(file_path, 'r', encoding='utf-8') as file:
+        separator, new_separators = _first_separator(text_splitter, text_splitter._separators, _read_blocks(file, block_size), block_size)
+
+    with open(file_path, 'r', encoding='utf-8') as file:
+        pieces = _iter_pieces(text_splitter, separator, _read_blocks(file, block_size), block_size)
+        yield from _iter_chunks(text_splitter, pieces, separator, new_separators, block_size)
+
 def should_skip_file_or_dir(file_path, custom_skip_extensions=None, limit_size=True, size_limit_mb=5):
     """
     Determine if a file should be skipped based on its type or size.
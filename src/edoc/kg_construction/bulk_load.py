@@ -5,19 +5,19 @@ import argparse
 from pathlib import Path
 from edoc.gpt_helpers.connect import connect_to_neo4j
 from edoc.gpt_helpers.connect import OpenAiConfig
+from edoc.gpt_helpers.graph_version import bump_graph_version
 
 from edoc.kg_construction.processing_tools.file_system_processor import FileSystemProcessor
 from edoc.kg_construction.build_tools.graph_builder import GraphBuilder
+from edoc.kg_construction.build_tools.batch_builder import BatchGraphBuilder
 from edoc.kg_construction.summary_tools.summary_manager import SummaryManager
-
-from tqdm import tqdm
-import time
-
-def hacky_progress_step(title, n = 10, time_on_screen=3):
-    for i in tqdm(range(n), desc=title):
-        time.sleep(time_on_screen/n)
-
-    return
+from edoc.rag_components.entity_matcher import get_entity_matcher
+from edoc.monitoring.tracing import span, traced, enable_tracing, get_tracer
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.kg_construction.build_tools.projects import project_id_for_directory, delete_project
+from edoc.kg_construction.build_tools.snapshot import export_snapshot, import_snapshot, read_snapshot_manifest
+from edoc.gpt_helpers.stand_ins import uses_stand_in_graph, uses_stand_in_models
+from edoc.gpt_helpers.rate_limiter import request_priority
 
 class CodebaseGraph:
     def __init__(
@@ -28,7 +28,8 @@ class CodebaseGraph:
             password=None, 
             openai_api_key=None,
             chunk_size=3500,
-            chunk_overlap=50
+            chunk_overlap=50,
+            project_id=None
     ):
         """
         Initialize the CodebaseGraph with a connection to Neo4j.
@@ -41,6 +42,8 @@ class CodebaseGraph:
             openai_api_key (str): Key needed to access OpenAI API
             chunk_size (int): size of chunk to use (by number of tokens)
             chunk_overlap (int): number of chunks to overlap when splitting
+            project_id (str, optional): The project the codebase is stored under, every node is tagged with it
+                so projects can share a database. Defaults to the directory's name.
         """
         load_dotenv()
 
@@ -49,10 +52,10 @@ class CodebaseGraph:
         self.NEO4J_PASSWORD =  password or os.getenv("NEO4J_PASSWORD")
         self.OPENAI_API_KEY = openai_api_key or OpenAiConfig.get_openai_api_key()
 
-        if not self.NEO4J_USER or not self.NEO4J_PASSWORD:
+        if (not self.NEO4J_USER or not self.NEO4J_PASSWORD) and not uses_stand_in_graph():
             raise ValueError("NEO4J_USERNAME and NEO4J_PASSWORD must be provided either as arguments or environment variables.")
         
-        if not self.OPENAI_API_KEY:
+        if not self.OPENAI_API_KEY and not uses_stand_in_models():
             raise ValueError("OPENAI_API_KEY must be provided, set as param or check env file.")
 
         self.kg = connect_to_neo4j()
@@ -60,26 +63,86 @@ class CodebaseGraph:
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
 
-        self.fs_processor = FileSystemProcessor(root_directory)
+        self.project_id = project_id or project_id_for_directory(root_directory)
+
+        self.fs_processor = FileSystemProcessor(root_directory, project_id=self.project_id)
         self.graph_builder = GraphBuilder(
             self.kg, 
             chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap
+            chunk_overlap=self.chunk_overlap,
+            project_id=self.project_id
         )
-        self.summary_manager = SummaryManager(self.kg)
+        self.summary_manager = SummaryManager(self.kg, project_id=self.project_id)
+
+    @traced("CodebaseGraph.create_graph")
+    def create_graph(self, progress: IngestionProgress = None, batch=False, batch_client=None, reload=False):
+        """
+        Build the graph: walk the directory, chunk and summarize files, summarize directories, then index.
 
-    def create_graph(self):
-        hacky_progress_step(title="Initiating graph...", time_on_screen=1)
-        hacky_progress_step(title="Walking directory and created Directory and File nodes...")
-        self.fs_processor.load_dirs_and_files_to_graph(self.kg)
-        self.graph_builder.enrich_graph()
-        self.summary_manager.automate_summarization()
-        self.graph_builder.create_all_vector_indexes()
+        Every stage only picks up work that is missing, so a cancelled or failed build can be run
+        again and carries on where it stopped. Its OpenAI requests run at 'bulk' priority, so chat
+        answers go first when the rate limits are tight.
 
-def main(path=None):
+        In batch mode the files are chunked without model calls and every summary, entity and
+        embedding request goes through OpenAI's Batch API instead (see BatchGraphBuilder). It is
+        slower (up to a day per round) but half the price and free of rate limits. The graph stays
+        pending until the last round is applied; running again in batch mode resumes it.
+
+        Only the project's own nodes are read or written. With reload the project is deleted first
+        (see delete_project) and built from scratch, other projects in the database are untouched.
+
+        Args:
+            progress (IngestionProgress, optional): Receives per stage progress and carries the cancellation flag.
+            batch (bool): Fill the graph in through batch jobs. Default is False.
+            batch_client (OpenAIBatchClient | LocalBatchClient, optional): Batch client to use. Defaults to get_batch_client().
+            reload (bool): Delete the project's existing nodes before building. Default is False.
+
+        Raises:
+            IngestionCancelled: If the progress' cancel event was set during the build.
+        """
+        progress = progress or IngestionProgress()
+
+        try:
+            with request_priority("bulk"):
+                if reload:
+                    delete_project(self.kg, self.project_id, progress=progress)
+                progress.start_stage("walk")
+                with span("FileSystemProcessor.load_dirs_and_files_to_graph"):
+                    self.fs_processor.load_dirs_and_files_to_graph(self.kg, progress=progress)
+                self.graph_builder.backfill_project_ids()
+                if batch:
+                    self.graph_builder.chunk_files(progress=progress)
+                    self.graph_builder.backfill_chunk_ordinals()
+                    BatchGraphBuilder(
+                        self.kg,
+                        client=batch_client,
+                        graph_builder=self.graph_builder,
+                        summary_manager=self.summary_manager
+                    ).run(progress=progress)
+                else:
+                    self.graph_builder.enrich_graph(progress=progress)
+                    self.graph_builder.backfill_chunk_ordinals()
+                    self.summary_manager.automate_summarization(progress=progress)
+
+                progress.start_stage("index", total=2)
+                self.graph_builder.create_all_vector_indexes()
+                progress.advance()
+                self.graph_builder.create_all_lookup_indexes()
+                progress.advance()
+                progress.finish()
+        finally:
+            #Let long lived readers (retriever registry etc.) know the graph changed, a cancelled build still wrote nodes
+            bump_graph_version(self.kg)
+            #Only the new names are added, the rest of the matcher is kept
+            get_entity_matcher(self.kg)
+
+def main(path=None, trace_path=None, batch=False, project_id=None, reload=False, delete=None, export_path=None, import_path=None):
     """
     Main function to initiate the graph creation process.
     It checks for a provide path or a CLI input path to a directory that holds code.
+    Passing a project to delete (--delete-project) removes that project instead, and a snapshot
+    directory to export (--export-snapshot, with --project) or import (--import-snapshot) copies
+    a built project between databases without rerunning any summaries or embeddings.
     """
 
     load_dotenv()
@@ -89,8 +152,57 @@ def main(path=None):
     if not seed_data:
         parser = argparse.ArgumentParser(description='Seed the knowledge graph with data from a specified directory.')
         parser.add_argument('path', type=str, nargs='?', help='The path to the directory to be processed.')
+        parser.add_argument('--trace', type=str, default=None, help='Write a span per stage, LLM call, embedding and query to this JSON lines file.')
+        parser.add_argument('--batch', action='store_true', help='Summarize and embed through the OpenAI Batch API. Run again with --batch to resume a pending build.')
+        parser.add_argument('--project', type=str, default=None, help='Project id to store the codebase under. Defaults to the directory name.')
+        parser.add_argument('--reload', action='store_true', help="Delete the project's existing nodes before building it again.")
+        parser.add_argument('--delete-project', type=str, default=None, help='Delete this project from the graph and exit.')
+        parser.add_argument('--export-snapshot', type=str, default=None, help='Write the --project graph to this snapshot directory and exit.')
+        parser.add_argument('--import-snapshot', type=str, default=None, help='Load the graph in this snapshot directory and exit. --project renames it, --reload deletes the project first.')
         args = parser.parse_args()
         seed_data = args.path
+        trace_path = args.trace
+        batch = args.batch
+        project_id = args.project
+        reload = args.reload
+        delete = args.delete_project
+        export_path = args.export_snapshot
+        import_path = args.import_snapshot
+
+    if trace_path:
+        enable_tracing(jsonl_path=trace_path)
+
+    if delete:
+        try:
+            delete_project(connect_to_neo4j(), delete)
+        except Exception as e:
+            print(f"An error occurred while deleting project [{delete}]: {e}")
+            sys.exit(1)
+        return
+
+    if export_path:
+        if not project_id:
+            print("Error: Exporting a snapshot needs the project to export (--project).")
+            sys.exit(1)
+        try:
+            export_snapshot(connect_to_neo4j(), project_id, export_path)
+        except Exception as e:
+            print(f"An error occurred while exporting project [{project_id}]: {e}")
+            sys.exit(1)
+        return
+
+    if import_path:
+        try:
+            kg = connect_to_neo4j()
+            if reload:
+                delete_project(kg, project_id or read_snapshot_manifest(import_path)["project_id"])
+            imported = import_snapshot(kg, import_path, project_id=project_id)
+            get_entity_matcher(kg)
+            print(f"Graph successfully imported from snapshot: {import_path} (project [{imported}])")
+        except Exception as e:
+            print(f"An error occurred while importing the snapshot: {e}")
+            sys.exit(1)
+        return
 
     if not seed_data:
         print("Error: No seed data directory provided. Provide a path as a CLI argument.")
@@ -104,9 +216,13 @@ def main(path=None):
         sys.exit(1)
 
     try:
-        graph = CodebaseGraph(root_directory=seed_data)
-        graph.create_graph()
-        print(f"Graph successfully created from directory: {seed_data}")
+        graph = CodebaseGraph(root_directory=seed_data, project_id=project_id)
+        graph.create_graph(batch=batch, reload=reload)
+        print(f"Graph successfully created from directory: {seed_data} (project [{graph.project_id}])")
+
+        if get_tracer() is not None:
+            for name, totals in get_tracer().summary().items():
+                print(f"{name}: {totals['count']} calls, {totals['seconds']:.2f}s, {totals['tokens_in']} tokens in, {totals['tokens_out']} tokens out")
     except Exception as e:
         print(f"An error occurred while creating the graph: {e}")
         sys.exit(1)  # Exit with a non-zero status if an error occurs
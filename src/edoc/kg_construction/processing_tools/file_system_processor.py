@@ -2,20 +2,25 @@ import os
 from datetime import datetime
 
 from edoc.kg_construction.build_tools.utils import should_skip_file_or_dir
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.kg_construction.build_tools.projects import project_id_for_directory
 
 class FileSystemProcessor:
     def __init__(
             self, 
-            root_directory 
+            root_directory,
+            project_id=None
     ):
         """
         Initialize the CodebaseGraph with a connection to Neo4j.
 
         Args:
             root_directory (str): The directory to be extracted into knowledge.
+            project_id (str, optional): Tag written on every node. Defaults to the directory's name.
         """
 
         self.root_directory = root_directory
+        self.project_id = project_id or project_id_for_directory(root_directory)
         
     def _get_file_info(self, file_path):
         """
@@ -41,27 +46,60 @@ class FileSystemProcessor:
             "created": created,
         }
 
-    def load_dirs_and_files_to_graph(self, kg):
+    def load_dirs_and_files_to_graph(self, kg, progress: IngestionProgress = None):
         """
         Traverse a directory and create a graph in Neo4j representing the directory structure and file information.
 
         Args:
             kg (Neo4jGraph): graph object to complete cypher queries
+            progress (IngestionProgress, optional): Counts directories and files walked, and stops the walk if cancelled.
         """
         print("Creating file and dir nodes from Walk")
+
+        progress = progress or IngestionProgress()
+
+        #Nodes are merged on their project, so nodes of graphs built before they carried one are adopted first
+        for label in ["Directory", "File"]:
+            kg.query(
+                f"""
+                MATCH (n:{label})
+                WHERE n.path STARTS WITH $root AND n.project_id IS NULL
+                  AND (n.path = $root OR n.path STARTS WITH $root_prefix)
+                SET n.project_id = $project_id
+                """,
+                {
+                    'root':self.root_directory,
+                    'root_prefix':os.path.join(self.root_directory, ''),
+                    'project_id':self.project_id,
+                }
+            )
+
+        #Names of every Directory above a path, root first. os.walk is top down so a
+        #parent is always seen before its children. Stored on the node so retrieval does not
+        #need a variable length CONTAINS traversal.
+        ancestors_by_path = {}
+
         for root, dirs, files in os.walk(self.root_directory):
 
+            progress.advance(dirs_walked=1)
+
             dir_name = os.path.basename(root)
+            root_ancestors = ancestors_by_path.get(root, [])
+            child_ancestors = root_ancestors + [dir_name]
+
             # Create node for the directory
             if not should_skip_file_or_dir(root):
                 kg.query(
                     """
-                    MERGE (dir:Directory {name: $dir_name, path: $path})
+                    MERGE (dir:Directory {name: $dir_name, path: $path, project_id: $project_id})
                     ON CREATE SET dir.created = $created, dir.last_modified = $last_modified
+                    SET dir.ancestors = $ancestors
                     """,
                     {
                         'dir_name':dir_name,
+                        'project_id':self.project_id,
                         'path':root,
+                        'ancestors':root_ancestors,
                         'created':datetime.fromtimestamp(os.stat(root).st_ctime).isoformat(),
                         'last_modified':datetime.fromtimestamp(os.stat(root).st_mtime).isoformat(),
                     }
@@ -70,19 +108,23 @@ class FileSystemProcessor:
             # Create nodes for subdirectories
             for dir_name in dirs:
                 dir_path = os.path.join(root, dir_name)
+                ancestors_by_path[dir_path] = child_ancestors
                 if not should_skip_file_or_dir(dir_path):
                     kg.query(
                         """
-                            MERGE (subdir:Directory {name: $dir_name, path: $subdir_path})
+                            MERGE (subdir:Directory {name: $dir_name, path: $subdir_path, project_id: $project_id})
                             ON CREATE SET subdir.created = $created, subdir.last_modified = $last_modified
+                            SET subdir.ancestors = $ancestors
                             WITH subdir
-                            MATCH (parent:Directory {path: $parent_path})
+                            MATCH (parent:Directory {path: $parent_path, project_id: $project_id})
                             MERGE (parent)-[:CONTAINS]->(subdir)
                         """,
                         {
                             'dir_name':dir_name,
                             'subdir_path':dir_path, 
                             'parent_path':root,
+                            'ancestors':child_ancestors,
+                            'project_id':self.project_id,
                             'created':datetime.fromtimestamp(os.stat(dir_path).st_ctime).isoformat(),
                             'last_modified':datetime.fromtimestamp(os.stat(dir_path).st_mtime).isoformat(),
                         }
@@ -92,13 +134,15 @@ class FileSystemProcessor:
             for file_name in files:
                 file_path = os.path.join(root, file_name)
                 file_info = self._get_file_info(file_path)
+                progress.count(files_walked=1)
                 if not should_skip_file_or_dir(file_path):
                     kg.query(
                         """
-                            MERGE (file:File {name: $file_name, path: $file_path})
+                            MERGE (file:File {name: $file_name, path: $file_path, project_id: $project_id})
                             ON CREATE SET file.type = $type, file.size = $size, file.last_modified = $last_modified, file.created = $created
+                            SET file.ancestors = $ancestors
                             WITH file
-                            MATCH (parent:Directory {path: $parent_path})
+                            MATCH (parent:Directory {path: $parent_path, project_id: $project_id})
                             MERGE (parent)-[:CONTAINS]->(file)
                         """,
                         {
@@ -108,6 +152,8 @@ class FileSystemProcessor:
                             'size':file_info['size'], 
                             'last_modified':file_info['last_modified'], 
                             'created':file_info['created'], 
-                            'parent_path':root
+                            'parent_path':root,
+                            'ancestors':child_ancestors,
+                            'project_id':self.project_id
                         }
                     )
\ No newline at end of file
@@ -1,19 +1,25 @@
 from tqdm import tqdm
 from edoc.kg_construction.summary_tools.utils import summarize_list_of_chunks, summarize_list_of_files_and_subdirs, generate_ascii_structure
 from edoc.gpt_helpers.gpt_basics import get_embedding
+from edoc.monitoring.tracing import span, traced
+from edoc.kg_construction.build_tools.progress import IngestionProgress
+from edoc.kg_construction.build_tools.projects import DEFAULT_PROJECT_ID
 
 class SummaryManager:
     def __init__(
             self, 
             kg,
+            project_id=DEFAULT_PROJECT_ID
     ):
         """
         Initialize the CodebaseGraph with a connection to Neo4j.
 
         Args:
             kg (Neo4jGraph): graph object to complete cypher queries
+            project_id (str): Only nodes of this project are summarized. Defaults to EDOC_PROJECT_ID.
         """
         self.kg = kg
+        self.project_id = project_id
 
     def _find_files_without_summaries(self):
         """
@@ -23,11 +29,11 @@ class SummaryManager:
             List[str]: A list of file paths that do not have summaries.
         """
         query = """
-        MATCH (file:File)
+        MATCH (file:File {project_id: $project_id})
         WHERE file.summary IS NULL
         RETURN file.path AS file_path
         """
-        result = self.kg.query(query)
+        result = self.kg.query(query, {'project_id': self.project_id})
         return [record['file_path'] for record in result]
 
     def _find_directories_without_summaries(self):
@@ -38,11 +44,11 @@ class SummaryManager:
             List[str]: A list of directory paths that do not have summaries.
         """
         query = """
-        MATCH (dir:Directory)
+        MATCH (dir:Directory {project_id: $project_id})
         WHERE dir.summary IS NULL
         RETURN dir.path AS dir_path
         """
-        result = self.kg.query(query)
+        result = self.kg.query(query, {'project_id': self.project_id})
         return [record['dir_path'] for record in result]
     
     def _find_nodes_without_embeddings(self):
@@ -53,14 +59,37 @@ class SummaryManager:
             List[dict]: A list of dictionaries containing the node type ('File' or 'Directory') and the path.
         """
         query = """
-        MATCH (n)
+        MATCH (n {project_id: $project_id})
         WHERE n.summary IS NOT NULL AND n.summary_embedding IS NULL AND (n:File OR n:Directory)
         RETURN labels(n) AS node_type, n.path AS node_path
         """
-        result = self.kg.query(query)
+        result = self.kg.query(query, {'project_id': self.project_id})
         return [{'node_type': record['node_type'][0], 'node_path': record['node_path']} for record in result]
     
     
+    def summary_for_file_without_chunks(self, file_path):
+        """
+        The stand in summary of a file with no chunk summaries, built from its metadata without a model call.
+
+        Args:
+            file_path (str): The path to the file.
+
+        Returns:
+            str: The summary text.
+        """
+        file_metadata_query = """
+        MATCH (file:File {path: $file_path, project_id: $project_id})
+        RETURN file.name AS file_name, file.type AS file_type
+        """
+        metadata_result = self.kg.query(file_metadata_query, {'file_path': file_path, 'project_id': self.project_id})
+        if metadata_result:
+            metadata = metadata_result[0]
+            file_name = metadata.get('file_name', 'Unknown')
+            file_type = metadata.get('file_type', 'Unknown')
+            return f"File '{file_name}' of type '{file_type}' has no chunk summaries."
+        return f"No chunk summaries for file {file_path}"
+
+    @traced("SummaryManager.summarize_file")
     def _summarize_file_from_chunks(self, file_path):
         """
         Summarize a file based on the summaries of its chunks.
@@ -73,27 +102,15 @@ class SummaryManager:
         """
         # Query to get summaries of all chunks associated with the file
         query = """
-        MATCH (file:File {path: $file_path})-[:CONTAINS]->(chunk:Chunk)
+        MATCH (file:File {path: $file_path, project_id: $project_id})-[:CONTAINS]->(chunk:Chunk)
         RETURN chunk.summary AS chunk_summary
         ORDER BY chunk.id ASC
         """
-        result = self.kg.query(query, {'file_path': file_path})
+        result = self.kg.query(query, {'file_path': file_path, 'project_id': self.project_id})
         chunk_summaries = [record['chunk_summary'] for record in result]
 
         if not chunk_summaries:
-            # Fetch file metadata if no chunks are present
-            file_metadata_query = """
-            MATCH (file:File {path: $file_path})
-            RETURN file.name AS file_name, file.type AS file_type
-            """
-            metadata_result = self.kg.query(file_metadata_query, {'file_path': file_path})
-            if metadata_result:
-                metadata = metadata_result[0]
-                file_name = metadata.get('file_name', 'Unknown')
-                file_type = metadata.get('file_type', 'Unknown')
-                file_summary = f"File '{file_name}' of type '{file_type}' has no chunk summaries."
-            else:
-                file_summary = f"No chunk summaries for file {file_path}"
+            file_summary = self.summary_for_file_without_chunks(file_path)
         else:
             # Summarize the list of chunk summaries
             file_summary = summarize_list_of_chunks(
@@ -102,16 +119,18 @@ class SummaryManager:
 
         # Store the file summary in the graph under the "summary" attribute
         self.kg.query("""
-            MATCH (file:File {path: $file_path})
+            MATCH (file:File {path: $file_path, project_id: $project_id})
             SET file.summary = $file_summary
         """, {
             'file_path': file_path,
-            'file_summary': file_summary
+            'file_summary': file_summary,
+            'project_id': self.project_id
         })
 
         return file_summary
 
     
+    @traced("SummaryManager.summarize_directory")
     def _summarize_directory(self, directory_path):
         """
         Summarize a directory based on the summaries of its files and subdirectories.
@@ -124,19 +143,19 @@ class SummaryManager:
         """
         # Query to get summaries of all files directly contained in the directory
         file_query = """
-        MATCH (dir:Directory {path: $directory_path})-[:CONTAINS]->(file:File)
+        MATCH (dir:Directory {path: $directory_path, project_id: $project_id})-[:CONTAINS]->(file:File)
         RETURN file.summary AS file_summary, file.name AS file_name
         """
-        file_result = self.kg.query(file_query, {'directory_path': directory_path})
+        file_result = self.kg.query(file_query, {'directory_path': directory_path, 'project_id': self.project_id})
         file_names = [record['file_name'] for record in file_result]
         file_summaries = [record['file_summary'] for record in file_result]
 
         # Query to get all subdirectories directly contained in the directory
         subdir_query = """
-        MATCH (dir:Directory {path: $directory_path})-[:CONTAINS]->(subdir:Directory)
+        MATCH (dir:Directory {path: $directory_path, project_id: $project_id})-[:CONTAINS]->(subdir:Directory)
         RETURN subdir.path AS subdir_path, subdir.name AS subdir_name
         """
-        subdir_result = self.kg.query(subdir_query, {'directory_path': directory_path})
+        subdir_result = self.kg.query(subdir_query, {'directory_path': directory_path, 'project_id': self.project_id})
         subdir_paths = [record['subdir_path'] for record in subdir_result]
         subdir_names = [record['subdir_name'] for record in subdir_result]
 
@@ -169,54 +188,77 @@ class SummaryManager:
         )
 
         self.kg.query("""
-            MATCH (dir:Directory {path: $directory_path})
+            MATCH (dir:Directory {path: $directory_path, project_id: $project_id})
             SET dir.summary = $directory_summary
         """, {
             'directory_path': directory_path,
-            'directory_summary': directory_summary
+            'directory_summary': directory_summary,
+            'project_id': self.project_id
         })
 
         return directory_summary
 
 
-    def _generate_and_store_embeddings(self):
+    @traced("SummaryManager.generate_and_store_embeddings")
+    def _generate_and_store_embeddings(self, progress: IngestionProgress = None):
         """
         Generate embeddings for files and directories that have summaries but lack embeddings.
+
+        Args:
+            progress (IngestionProgress, optional): Counts embeddings written and stops between nodes if cancelled.
         """
+        progress = progress or IngestionProgress()
+
         nodes_without_embeddings = self._find_nodes_without_embeddings()
+        progress.start_stage("embed", total=len(nodes_without_embeddings))
 
         for node in tqdm(nodes_without_embeddings, desc='Creating File and Directory embeddings'):
             # Retrieve the summary of the node
             query = f"""
-            MATCH (n:{node['node_type']} {{path: $node_path}})
+            MATCH (n:{node['node_type']} {{path: $node_path, project_id: $project_id}})
             RETURN n.summary AS summary
             """
-            result = self.kg.query(query, {'node_path': node['node_path']})
+            result = self.kg.query(query, {'node_path': node['node_path'], 'project_id': self.project_id})
             summary = result[0]['summary']
 
             embedding = get_embedding(summary)
 
             query = f"""
-            MATCH (n:{node['node_type']} {{path: $node_path}})
+            MATCH (n:{node['node_type']} {{path: $node_path, project_id: $project_id}})
             SET n.summary_embedding = $embedding
             """
             self.kg.query(query, {
                 'node_path': node['node_path'],
-                'embedding': embedding
+                'embedding': embedding,
+                'project_id': self.project_id
             })
+            progress.advance(embeddings_written=1)
 
-    def automate_summarization(self):
+    @traced("SummaryManager.automate_summarization")
+    def automate_summarization(self, progress: IngestionProgress = None):
         """
         Automate the summarization process for files and directories in the graph.
+
+        Args:
+            progress (IngestionProgress, optional): Counts files and directories summarized and embeddings written,
+                and stops between nodes if cancelled. Nodes already summarized are skipped on the next run.
         """
+        progress = progress or IngestionProgress()
+
         # Summarize files without summaries
-        files_without_summaries = self._find_files_without_summaries()
-        for file_path in tqdm(files_without_summaries, desc='Summarizing files'):
-            self._summarize_file_from_chunks(file_path)
+        with span("SummaryManager.summarize_files"):
+            files_without_summaries = self._find_files_without_summaries()
+            progress.start_stage("summarize_files", total=len(files_without_summaries))
+            for file_path in tqdm(files_without_summaries, desc='Summarizing files'):
+                self._summarize_file_from_chunks(file_path)
+                progress.advance(files_summarized=1)
 
         # Summarize directories without summaries
-        directories_without_summaries = self._find_directories_without_summaries()
-        for dir_path in tqdm(directories_without_summaries, 'Summarizing directories'):
-            self._summarize_directory(dir_path)
+        with span("SummaryManager.summarize_directories"):
+            directories_without_summaries = self._find_directories_without_summaries()
+            progress.start_stage("summarize_directories", total=len(directories_without_summaries))
+            for dir_path in tqdm(directories_without_summaries, 'Summarizing directories'):
+                self._summarize_directory(dir_path)
+                progress.advance(directories_summarized=1)
 
-        self._generate_and_store_embeddings()
\ No newline at end of file
+        self._generate_and_store_embeddings(progress)
\ No newline at end of file
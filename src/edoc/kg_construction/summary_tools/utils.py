@@ -37,16 +37,15 @@ def generate_ascii_structure(root_directory, model='gpt-4o-mini'):
     
     return ascii_tree
 
-def summarize_list_of_chunks(chunk_data, model='gpt-4o-mini'):
+def chunk_summaries_prompt(chunk_data):
     """
-    Summarize a list of summaries to make global understanding.
+    Build the chat messages asking for a file summary from its chunk summaries.
 
     Args:
-        model (str): The OpenAI model to use. Default is 'gpt-4o-mini'.
         chunk_data (dict): A dictionary of name metadata and list  of chunk summaries
 
     Returns:
-        str: A brief and clear summary of the chunk.
+        list: The messages for a chat completion.
     """
 
     context = "Given context: "
@@ -57,7 +56,7 @@ def summarize_list_of_chunks(chunk_data, model='gpt-4o-mini'):
     
     context += '\n' + chunk_context
 
-    prompt = [
+    return [
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": f"""We are trying to gain understanding around a coding project. A file may have chunks (snippets of the file).
          Can you aggregate and make summaries of a list of summaries from the given context? The goal is to build higher-level summaries of items downstream, 
@@ -72,19 +71,31 @@ def summarize_list_of_chunks(chunk_data, model='gpt-4o-mini'):
          
          {context}"""}
     ]
-    return create_chat_completion(messages=prompt, model=model)
 
-def summarize_list_of_files_and_subdirs(model='gpt-4o-mini', file_data=None, subdir_data=None):
+def summarize_list_of_chunks(chunk_data, model='gpt-4o-mini'):
     """
     Summarize a list of summaries to make global understanding.
 
     Args:
         model (str): The OpenAI model to use. Default is 'gpt-4o-mini'.
+        chunk_data (dict): A dictionary of name metadata and list  of chunk summaries
+
+    Returns:
+        str: A brief and clear summary of the chunk.
+    """
+    prompt = chunk_summaries_prompt(chunk_data)
+    return create_chat_completion(messages=prompt, model=model)
+
+def files_and_subdirs_prompt(file_data=None, subdir_data=None):
+    """
+    Build the chat messages asking for a directory summary from its file and subdirectory summaries.
+
+    Args:
         file_data (dict): A dictionary of name metadata and dict of [file summaries, file names]
         subdir_data (dict): A dictionary of name metadata and dict  of [subdirectory summaries, subdirectory names]
 
     Returns:
-        str: A brief and clear summary of the chunk.
+        list: The messages for a chat completion.
     """
 
     context = "Given context: "
@@ -104,7 +115,7 @@ def summarize_list_of_files_and_subdirs(model='gpt-4o-mini', file_data=None, sub
 
     context += '\n' + subdir_context
 
-    prompt = [
+    return [
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": f"""We are trying to gain understanding around a coding project. A directory may have a mix of files or subdirectories.
          Can you aggregate and make summaries of a list of summaries from the given context? The goal is to build higher-level summaries of items downstream, 
@@ -121,4 +132,18 @@ def summarize_list_of_files_and_subdirs(model='gpt-4o-mini', file_data=None, sub
          
          {context}"""}
     ]
+
+def summarize_list_of_files_and_subdirs(model='gpt-4o-mini', file_data=None, subdir_data=None):
+    """
+    Summarize a list of summaries to make global understanding.
+
+    Args:
+        model (str): The OpenAI model to use. Default is 'gpt-4o-mini'.
+        file_data (dict): A dictionary of name metadata and dict of [file summaries, file names]
+        subdir_data (dict): A dictionary of name metadata and dict  of [subdirectory summaries, subdirectory names]
+
+    Returns:
+        str: A brief and clear summary of the chunk.
+    """
+    prompt = files_and_subdirs_prompt(file_data=file_data, subdir_data=subdir_data)
     return create_chat_completion(messages=prompt, model=model)
\ No newline at end of file
@@ -0,0 +1,651 @@
+import os
+import json
+import time
+import inspect
+import itertools
+import threading
+import functools
+import contextvars
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+#Spans around embedding calls, LLM calls, Cypher queries and pipeline stages.
+#Off unless EDOC_TRACING is set or enable_tracing() is called. While off, span() hands back one shared
+#no-op object and traced() functions call straight through, so the only cost is a global lookup.
+
+#Span kinds, also the 'kind' label on every exported metric
+SPAN_KINDS = ("stage", "llm", "embedding", "cypher", "retrieval")
+
+#Prometheus histogram buckets for span durations, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_span = contextvars.ContextVar("edoc_current_span", default=None)
+_span_ids = itertools.count(1)
+
+def payload_size(value):
+    """
+    Rough size of a payload in bytes: UTF-8 length for text, JSON length for anything else.
+
+    Args:
+        value: The payload.
+
+    Returns:
+        int: The size, 0 for None.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(str(value))
+
+class _NoopSpan:
+    """
+    Stands in for a Span while tracing is off, every method does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add_tokens(self, tokens_in=0, tokens_out=0):
+        pass
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        pass
+
+    def end(self, error=None):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Span:
+    def __init__(self, tracer, name, kind, parent=None, attributes=None):
+        """
+        One timed unit of work. Use it as a context manager to make it the parent of spans
+        started inside the block, or call end() yourself (callbacks, generators).
+
+        Args:
+            tracer (Tracer): Where the finished span is recorded.
+            name (str): What ran, e.g. 'GraphBuilder.enrich_graph' or 'llm.chat'.
+            kind (str): One of SPAN_KINDS.
+            parent (Span, optional): The enclosing span.
+            attributes (dict, optional): Extra details, exported as is.
+        """
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.attributes = attributes or {}
+
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.error = None
+
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self._context_token = None
+
+    def __enter__(self):
+        self._context_token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._context_token is not None:
+            _current_span.reset(self._context_token)
+            self._context_token = None
+        self.end(error=exc)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_tokens(self, tokens_in=0, tokens_out=0):
+        self.tokens_in += tokens_in or 0
+        self.tokens_out += tokens_out or 0
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        self.bytes_in += bytes_in or 0
+        self.bytes_out += bytes_out or 0
+
+    def end(self, error=None):
+        """
+        Stop the clock and record the span, only the first call counts.
+
+        Args:
+            error (Exception, optional): The error the work failed with.
+        """
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.tracer._record(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_seconds": self.duration,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+def _escape_label(value):
+    """
+    Escape a Prometheus label value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Tracer:
+    def __init__(self, max_spans=10000, jsonl_path=None):
+        """
+        Collect finished spans and keep running totals per (kind, name) for metrics.
+
+        Args:
+            max_spans (int): Most recent spans kept in memory for export. Totals cover every span. Default is 10000.
+            jsonl_path (str, optional): File every finished span is appended to as one JSON line.
+        """
+        self.jsonl_path = jsonl_path
+
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self._totals = {}
+
+    def start_span(self, name, kind="stage", parent=None, **attributes):
+        """
+        Start a span under the current one (or the given parent). End it with end() or a with block.
+        """
+        if parent is None:
+            parent = _current_span.get()
+        return Span(self, name, kind, parent=parent, attributes=attributes)
+
+    def _record(self, span):
+        key = (span.kind, span.name)
+        with self._lock:
+            self._spans.append(span)
+
+            totals = self._totals.get(key)
+            if totals is None:
+                totals = {
+                    "count": 0, "errors": 0, "seconds": 0.0,
+                    "tokens_in": 0, "tokens_out": 0, "bytes_in": 0, "bytes_out": 0,
+                    "buckets": [0] * len(DURATION_BUCKETS),
+                }
+                self._totals[key] = totals
+
+            totals["count"] += 1
+            totals["errors"] += span.error is not None
+            totals["seconds"] += span.duration
+            totals["tokens_in"] += span.tokens_in
+            totals["tokens_out"] += span.tokens_out
+            totals["bytes_in"] += span.bytes_in
+            totals["bytes_out"] += span.bytes_out
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if span.duration <= bound:
+                    totals["buckets"][i] += 1
+
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(span.to_dict(), default=str) + "\n")
+                except OSError as e:
+                    print(f"Could not write trace file [{self.jsonl_path}]: {e}")
+
+    def spans(self):
+        """
+        The finished spans still in memory, oldest first, as dicts.
+        """
+        with self._lock:
+            return [span.to_dict() for span in self._spans]
+
+    def summary(self):
+        """
+        Totals per span name.
+
+        Returns:
+            dict: '<kind>:<name>' to count, errors, total and mean seconds, tokens and bytes in and out.
+        """
+        with self._lock:
+            return {
+                f"{kind}:{name}": {
+                    "count": totals["count"],
+                    "errors": totals["errors"],
+                    "seconds": totals["seconds"],
+                    "mean_seconds": totals["seconds"] / totals["count"],
+                    "tokens_in": totals["tokens_in"],
+                    "tokens_out": totals["tokens_out"],
+                    "bytes_in": totals["bytes_in"],
+                    "bytes_out": totals["bytes_out"],
+                }
+                for (kind, name), totals in sorted(self._totals.items())
+            }
+
+    def export_jsonl(self, path):
+        """
+        Write the spans in memory to a JSON lines file.
+
+        Args:
+            path (str): The file to write.
+
+        Returns:
+            int: The number of spans written.
+        """
+        spans = self.spans()
+        with open(path, "w", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span, default=str) + "\n")
+        return len(spans)
+
+    def prometheus_metrics(self):
+        """
+        Render the totals in the Prometheus text exposition format.
+
+        Returns:
+            str: Durations as a histogram, plus token, byte and error counters, labelled by kind and name.
+        """
+        def labels(kind, name, **extra):
+            pairs = {"kind": kind, "name": name, **extra}
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs.items()) + "}"
+
+        with self._lock:
+            items = sorted((key, dict(totals, buckets=list(totals["buckets"]))) for key, totals in self._totals.items())
+
+        lines = [
+            "# HELP edoc_span_duration_seconds Time spent in each traced stage or call.",
+            "# TYPE edoc_span_duration_seconds histogram",
+        ]
+        for (kind, name), totals in items:
+            for bound, count in zip(DURATION_BUCKETS, totals["buckets"]):
+                lines.append(f"edoc_span_duration_seconds_bucket{labels(kind, name, le=bound)} {count}")
+            lines.append(f"edoc_span_duration_seconds_bucket{labels(kind, name, le='+Inf')} {totals['count']}")
+            lines.append(f"edoc_span_duration_seconds_sum{labels(kind, name)} {totals['seconds']}")
+            lines.append(f"edoc_span_duration_seconds_count{labels(kind, name)} {totals['count']}")
+
+        for metric, help_text, fields in (
+            ("edoc_span_tokens_total", "Model tokens sent and received.", ("tokens_in", "tokens_out")),
+            ("edoc_span_bytes_total", "Payload bytes sent and received.", ("bytes_in", "bytes_out")),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (kind, name), totals in items:
+                for field in fields:
+                    direction = field.rsplit("_", 1)[1]
+                    lines.append(f"{metric}{labels(kind, name, direction=direction)} {totals[field]}")
+
+        lines.append("# HELP edoc_span_errors_total Traced stages or calls that raised.")
+        lines.append("# TYPE edoc_span_errors_total counter")
+        for (kind, name), totals in items:
+            lines.append(f"edoc_span_errors_total{labels(kind, name)} {totals['errors']}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Forget every span and total.
+        """
+        with self._lock:
+            self._spans.clear()
+            self._totals = {}
+
+_tracer = Tracer(jsonl_path=os.getenv("EDOC_TRACE_FILE")) if os.getenv("EDOC_TRACING", "").lower() in ("1", "true", "yes") else None
+
+def enable_tracing(jsonl_path=None, max_spans=10000):
+    """
+    Turn tracing on for the process. Chat models, embedding clients and graph connections
+    created before this call stay untraced.
+
+    Args:
+        jsonl_path (str, optional): File every finished span is appended to. Defaults to EDOC_TRACE_FILE.
+        max_spans (int): Most recent spans kept in memory. Default is 10000.
+
+    Returns:
+        Tracer: The active tracer.
+    """
+    global _tracer
+    _tracer = Tracer(max_spans=max_spans, jsonl_path=jsonl_path or os.getenv("EDOC_TRACE_FILE"))
+    return _tracer
+
+def disable_tracing():
+    """
+    Turn tracing off, spans already recorded are dropped.
+    """
+    global _tracer
+    _tracer = None
+
+def tracing_enabled():
+    return _tracer is not None
+
+def get_tracer():
+    """
+    The active Tracer, or None while tracing is off.
+    """
+    return _tracer
+
+def span(name, kind="stage", **attributes):
+    """
+    Start a span for a with block.
+
+    Args:
+        name (str): What runs in the block.
+        kind (str): One of SPAN_KINDS. Default is 'stage'.
+        **attributes: Extra details recorded on the span.
+
+    Returns:
+        Span: The span, or NOOP_SPAN while tracing is off.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start_span(name, kind, **attributes)
+
+def start_span(name, kind="stage", **attributes):
+    """
+    Start a span that is ended by hand, for work that cannot sit in one with block such as generators.
+    It does not become the current span.
+
+    Returns:
+        Span: The span, or NOOP_SPAN while tracing is off.
+    """
+    return span(name, kind, **attributes)
+
+def _traced_iter(current, iterator):
+    """
+    Drive a generator under a span. The span is only current while the generator runs,
+    not while the caller holds a yielded item.
+    """
+    error = None
+    try:
+        while True:
+            context_token = _current_span.set(current)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _current_span.reset(context_token)
+            yield item
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        iterator.close()
+        current.end(error=error)
+
+async def _atraced_iter(current, iterator):
+    """
+    Async version of _traced_iter.
+    """
+    error = None
+    try:
+        while True:
+            context_token = _current_span.set(current)
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _current_span.reset(context_token)
+            yield item
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        await iterator.aclose()
+        current.end(error=error)
+
+def traced(name=None, kind="stage"):
+    """
+    Decorator that runs a function inside a span named after it. Works on plain and async
+    functions, and on generators, where the span lasts until the generator is exhausted or closed.
+
+    Args:
+        name (str, optional): The span name. Defaults to the function's qualified name.
+        kind (str): One of SPAN_KINDS. Default is 'stage'.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.isasyncgenfunction(func) or inspect.isgeneratorfunction(func):
+            wrap_iter = _atraced_iter if inspect.isasyncgenfunction(func) else _traced_iter
+
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if _tracer is None:
+                    return func(*args, **kwargs)
+                return wrap_iter(_tracer.start_span(span_name, kind), func(*args, **kwargs))
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _tracer is None:
+                    return await func(*args, **kwargs)
+                with _tracer.start_span(span_name, kind):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.start_span(span_name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def propagate(func):
+    """
+    Carry the current span into a thread pool task, so its spans keep their parent.
+
+    Args:
+        func (callable): The task.
+
+    Returns:
+        callable: The task bound to a copy of the current context, or the task itself while tracing is off.
+    """
+    if _tracer is None:
+        return func
+    context = contextvars.copy_context()
+    return functools.partial(context.run, func)
+
+def traced_cypher(run_query, query, params=None):
+    """
+    Run a Cypher query inside a 'cypher' span, recording parameter and result sizes.
+
+    Args:
+        run_query (callable): Called as run_query(query, params), returns the records.
+        query (str): The Cypher query.
+        params (dict, optional): The query parameters.
+
+    Returns:
+        The records run_query returned.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return run_query(query, params)
+
+    with tracer.start_span("cypher.query", "cypher", query=_query_label(query)) as current:
+        result = run_query(query, params)
+        current.add_bytes(bytes_in=payload_size(query) + payload_size(params), bytes_out=payload_size(result))
+        current.set(rows=len(result) if hasattr(result, "__len__") else None)
+        return result
+
+async def atraced_cypher(run_query, query, params=None):
+    """
+    Async version of traced_cypher, run_query is awaited.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return await run_query(query, params)
+
+    with tracer.start_span("cypher.query", "cypher", query=_query_label(query)) as current:
+        result = await run_query(query, params)
+        current.add_bytes(bytes_in=payload_size(query) + payload_size(params), bytes_out=payload_size(result))
+        current.set(rows=len(result) if hasattr(result, "__len__") else None)
+        return result
+
+def _query_label(query):
+    """
+    A short, stable label for a query: its first non empty line, squashed.
+    """
+    for line in query.strip().splitlines():
+        line = " ".join(line.split())
+        if line:
+            return line[:80]
+    return ""
+
+class TracedGraph:
+    def __init__(self, graph):
+        """
+        Wrap a graph so every query() runs in a 'cypher' span. Anything else goes to the wrapped graph.
+
+        Args:
+            graph (Neo4jGraph): The graph to wrap.
+        """
+        self._graph = graph
+
+    def query(self, query, params=None):
+        return traced_cypher(self._graph.query, query, params or {})
+
+    def __getattr__(self, attribute):
+        return getattr(self._graph, attribute)
+
+class TracedEmbeddings(Embeddings):
+    def __init__(self, embeddings, model=None):
+        """
+        Wrap a langchain embeddings client so every call runs in an 'embedding' span.
+
+        Args:
+            embeddings (Embeddings): The client to wrap.
+            model (str, optional): Model name recorded on the spans.
+        """
+        self.embeddings = embeddings
+        self.model = model
+
+    def _span(self, name, texts):
+        current = span(name, "embedding", model=self.model, inputs=len(texts))
+        current.add_bytes(bytes_in=sum(payload_size(text) for text in texts))
+        #Embedding endpoints do not return usage through langchain, estimate it
+        current.add_tokens(tokens_in=sum(len(text) for text in texts) // 4)
+        return current
+
+    def embed_documents(self, texts):
+        with self._span("embedding.documents", texts):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self._span("embedding.query", [text]):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        with self._span("embedding.documents", texts):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        with self._span("embedding.query", [text]):
+            return await self.embeddings.aembed_query(text)
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Langchain callback that records each chat model call as an 'llm' span with its token usage.
+    """
+    #Run in the caller's context so spans nest under the current one, even from async chains
+    run_inline = True
+
+    def __init__(self, model=None):
+        self.model = model
+        self._spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        current = start_span("llm.chat", "llm", model=self.model)
+        current.add_bytes(bytes_in=sum(payload_size(str(message.content)) for batch in messages for message in batch))
+        self._spans[run_id] = current
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        current = start_span("llm.completion", "llm", model=self.model)
+        current.add_bytes(bytes_in=sum(payload_size(prompt) for prompt in prompts))
+        self._spans[run_id] = current
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        current = self._spans.pop(run_id, None)
+        if current is None:
+            return
+
+        tokens_in = tokens_out = 0
+        text = ""
+        for generations in response.generations:
+            for generation in generations:
+                text += generation.text
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    tokens_in += usage.get("input_tokens", 0)
+                    tokens_out += usage.get("output_tokens", 0)
+
+        if not tokens_in and not tokens_out:
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            tokens_in = token_usage.get("prompt_tokens", 0)
+            tokens_out = token_usage.get("completion_tokens", 0)
+
+        current.add_tokens(tokens_in=tokens_in, tokens_out=tokens_out)
+        current.add_bytes(bytes_out=payload_size(text))
+        current.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        current = self._spans.pop(run_id, None)
+        if current is not None:
+            current.end(error=error)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        tracer = _tracer
+        body = (tracer.prometheus_metrics() if tracer is not None else "").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=9464, host="0.0.0.0"):
+    """
+    Serve prometheus_metrics() for scraping from a background thread.
+
+    Args:
+        port (int): Port to listen on. Default is 9464.
+        host (str): Interface to bind. Default is every interface.
+
+    Returns:
+        ThreadingHTTPServer: The running server, call shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="edoc-metrics", daemon=True)
+    thread.start()
+    return server
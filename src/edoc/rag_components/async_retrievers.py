@@ -0,0 +1,256 @@
+import asyncio
+
+from openai import AsyncOpenAI
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.gpt_helpers.connect import connect_to_neo4j_async, OpenAiConfig
+from edoc.gpt_helpers.gpt_basics import get_embedding_model
+from edoc.gpt_helpers.stand_ins import uses_stand_in_models
+from edoc.gpt_helpers.rate_limiter import openai_client_kwargs
+from edoc.monitoring.tracing import span, traced, atraced_cypher, payload_size
+from edoc.rag_components.vector_registry import VECTOR_INDEX_SPECS, get_vector_registry
+from edoc.rag_components.entity_matcher import get_entity_matcher
+from edoc.rag_components.local_vector_backend import get_local_vector_backend
+from edoc.rag_components.context_assembler import assemble_context, DEFAULT_CONTEXT_TOKEN_BUDGET
+from edoc.rag_components.query_analysis import (
+    QueryAnalysis,
+    FULLTEXT_INDEX_SPECS,
+    FULLTEXT_SEARCH_QUERY,
+    VECTOR_SEARCH_QUERY,
+    _fulltext_search_params,
+    _vector_search_params,
+)
+from edoc.rag_components.structured_retrievers import (
+    DIR_FILE_LOOKUP_QUERY,
+    CHUNK_NEIGHBORHOOD_QUERY,
+    CODE_ENTITY_LOOKUP_QUERY,
+    _plan_dir_file_lookup,
+    _dir_file_pieces_from_records,
+    _plan_code_lookup,
+    _code_entity_lookup_params,
+    _code_pieces_from_records,
+    indexes_for_sections,
+)
+
+class AsyncRetriever:
+    def __init__(self, kg: Neo4jGraph, embedding_model=None):
+        """
+        Asyncio version of analyze_query and collect_structured_context.
+
+        Every independent round trip (the question embedding, each fulltext and vector search,
+        the file lookup, the chunk neighborhoods and the code entity lookup) is awaited together,
+        so a question costs the embedding call plus two rounds of queries rather than their sum.
+        Queries and rendering are shared with structured_retrievers, so both paths return the same context.
+
+        The async driver and client are created on first use, inside the event loop that uses them.
+
+        Args:
+            kg (Neo4jGraph): A sync kg object, only used to keep the entity matcher up to date.
+            embedding_model (str, optional): The OpenAI embedding model. Defaults to the vector registry's model
+                so question and stored embeddings always match.
+        """
+        self.kg = kg
+        self.embedding_model = embedding_model or get_vector_registry().model
+
+        self._driver = None
+        self._client = None
+        self._client_api_key = None
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            self._driver = connect_to_neo4j_async()
+        return self._driver
+
+    @property
+    def client(self):
+        """
+        The async OpenAI client, rebuilt only if the OpenAI API key has changed.
+        """
+        api_key = OpenAiConfig.get_openai_api_key()
+        if self._client is None or api_key != self._client_api_key:
+            self._client = AsyncOpenAI(api_key=api_key, **openai_client_kwargs(use_async=True))
+            self._client_api_key = api_key
+        return self._client
+
+    async def _query(self, query, params):
+        """
+        Run a read query and return the records as dicts, like Neo4jGraph.query.
+        """
+        return await atraced_cypher(self._run_query, query, params)
+
+    async def _run_query(self, query, params):
+        database = getattr(self.kg, "_database", None)
+        records, _, _ = await self.driver.execute_query(query, params, database_=database, routing_="r")
+        return [record.data() for record in records]
+
+    async def embed(self, question):
+        """
+        Embed the question with the async OpenAI client.
+
+        Args:
+            question (str): The user's question.
+
+        Returns:
+            list: The embedding vector.
+        """
+        if uses_stand_in_models():
+            return await get_embedding_model(self.embedding_model).aembed_query(question)
+
+        with span("embedding.create", "embedding", model=self.embedding_model) as current:
+            current.add_bytes(bytes_in=payload_size(question))
+            response = await self.client.embeddings.create(model=self.embedding_model, input=question)
+            if response.usage is not None:
+                current.add_tokens(tokens_in=response.usage.prompt_tokens)
+            return response.data[0].embedding
+
+    async def _fulltext_search(self, index_name, question, top_k, project_id=None):
+        try:
+            result = await self._query(FULLTEXT_SEARCH_QUERY, _fulltext_search_params(index_name, question, top_k, project_id))
+        except Exception as e:
+            print(f"An error occurred while searching fulltext index [{index_name}]: {e}")
+            return []
+
+        return [(record["key"], record["score"]) for record in result if record.get("key") is not None]
+
+    async def _vector_search(self, index_name, embedding, top_k, project_id=None):
+        #Called directly rather than through Neo4jVector so it can go through the async driver
+        result = await self._query(VECTOR_SEARCH_QUERY, _vector_search_params(index_name, embedding, top_k, project_id))
+        return [(record["key"], record["score"]) for record in result if record.get("key") is not None]
+
+    async def _match_entities(self, question, project_id=None):
+        #Refreshing the matcher is sync and rarely does any work, keep it off the event loop anyway
+        matcher = await asyncio.to_thread(get_entity_matcher, self.kg, project_id)
+        return matcher.match(question)
+
+    @traced("AsyncRetriever.analyze_query", kind="retrieval")
+    async def analyze_query(self, question: str, top_k: int, index_names=None, fulltext_index_names=None, retrieval_backend="neo4j", project_id=None) -> QueryAnalysis:
+        """
+        Async version of analyze_query, see query_analysis.analyze_query.
+
+        Args:
+            question (str): The user's question.
+            top_k (int): The number of top results to retrieve from each index.
+            index_names (list, optional): Vector indexes to search. Defaults to every index in VECTOR_INDEX_SPECS.
+            fulltext_index_names (list, optional): Fulltext indexes to search. Defaults to every index in FULLTEXT_INDEX_SPECS.
+            retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+            project_id (str, optional): Only return nodes of this project. None searches every project.
+
+        Returns:
+            QueryAnalysis: The embedding, the scored results per index, and the matched entities.
+        """
+        if index_names is None:
+            index_names = list(VECTOR_INDEX_SPECS.keys())
+
+        if fulltext_index_names is None:
+            fulltext_index_names = list(FULLTEXT_INDEX_SPECS.keys())
+
+        if retrieval_backend not in ("neo4j", "local"):
+            raise ValueError(f"Unknown retrieval backend [{retrieval_backend}], use 'neo4j' or 'local'.")
+
+        #Nothing here needs the embedding, so it all runs while the embedding call is in flight
+        lexical_task = asyncio.gather(*[
+            self._fulltext_search(index_name, question, top_k, project_id) for index_name in fulltext_index_names
+        ])
+        entity_task = asyncio.ensure_future(self._match_entities(question, project_id))
+
+        use_local = False
+        if retrieval_backend == "local":
+            local_backend = get_local_vector_backend()
+            use_local, embedding = await asyncio.gather(
+                asyncio.to_thread(local_backend.ensure_fresh, self.kg, index_names),
+                self.embed(question)
+            )
+        else:
+            embedding = await self.embed(question)
+
+        if use_local:
+            vector_results = await asyncio.gather(*[
+                asyncio.to_thread(local_backend.search, index_name, embedding, top_k, project_id) for index_name in index_names
+            ])
+        else:
+            vector_results = await asyncio.gather(*[
+                self._vector_search(index_name, embedding, top_k, project_id) for index_name in index_names
+            ])
+
+        lexical_results = await lexical_task
+        entity_matches = await entity_task
+
+        return QueryAnalysis(
+            question=question,
+            embedding=embedding,
+            top_k=top_k,
+            results=dict(zip(index_names, vector_results)),
+            entity_matches=entity_matches,
+            lexical_results=dict(zip(fulltext_index_names, lexical_results)),
+            project_id=project_id
+        )
+
+    @traced("AsyncRetriever.collect_structured_context", kind="retrieval")
+    async def collect_structured_context(self, question: str, top_k: int = 1, next_chunk_limit: int = 1, query_analysis: QueryAnalysis = None, entity_limit: int = 5, fusion_weights: dict = None, retrieval_backend: str = "neo4j", token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, sections=("summary", "code"), project_id: str = None):
+        """
+        Async version of collect_structured_context, the file lookup, chunk neighborhoods and
+        code entity lookup run concurrently.
+
+        Args:
+            question (str): The user's question.
+            top_k (int): The number of top results to retrieve from the similarity search. Default is 1.
+            next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain. Default is 1.
+            query_analysis (QueryAnalysis, optional): A shared analysis of the question. If None the question is analyzed here.
+            entity_limit (int): The most nodes returned for any one entity name. Default is 5.
+            fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+            retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+            token_budget (int): Most tokens of context across both sections. None means no limit.
+            sections (tuple): Which sections to retrieve, 'summary' and/or 'code'. Skipped sections come back empty.
+            project_id (str, optional): Only look in this project, used when the question is analyzed here.
+                Otherwise the analysis' project is used. None looks in every project.
+
+        Returns:
+            AssembledContext: The 'summary' and 'code' sections plus what was kept and dropped.
+        """
+        if query_analysis is None:
+            index_names, fulltext_index_names = indexes_for_sections(sections)
+            query_analysis = await self.analyze_query(
+                question,
+                top_k=top_k,
+                index_names=index_names,
+                fulltext_index_names=fulltext_index_names,
+                retrieval_backend=retrieval_backend,
+                project_id=project_id
+            )
+        project_id = query_analysis.project_id
+
+        dir_file_scores = {}
+        if "summary" in sections:
+            dir_file_scores = _plan_dir_file_lookup(query_analysis, top_k, fusion_weights)
+
+        hit_scores, entities = {}, []
+        if "code" in sections:
+            hit_scores, entities = _plan_code_lookup(query_analysis, top_k, fusion_weights)
+
+        async def run_if(condition, query, params):
+            if not condition:
+                return []
+            return await self._query(query, params)
+
+        dir_file_records, neighborhood_records, entity_records = await asyncio.gather(
+            run_if(dir_file_scores, DIR_FILE_LOOKUP_QUERY, {"names": list(dir_file_scores.keys()), "project_id": project_id}),
+            run_if(hit_scores, CHUNK_NEIGHBORHOOD_QUERY, {"chunk_ids": list(hit_scores.keys()), "window": next_chunk_limit, "project_id": project_id}),
+            run_if(entities, CODE_ENTITY_LOOKUP_QUERY, _code_entity_lookup_params(entities, entity_limit, project_id))
+        )
+
+        pieces = _dir_file_pieces_from_records(dir_file_records, dir_file_scores)
+        pieces.extend(_code_pieces_from_records(neighborhood_records, entity_records, hit_scores, entities))
+
+        return assemble_context(pieces, token_budget=token_budget)
+
+    async def close(self):
+        """
+        Close the async driver and client.
+        """
+        if self._driver is not None:
+            await self._driver.close()
+            self._driver = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
@@ -0,0 +1,158 @@
+from functools import lru_cache
+
+import tiktoken
+
+from edoc.monitoring.tracing import span, payload_size
+
+#Total tokens of retrieved context handed to the LLM across every section
+DEFAULT_CONTEXT_TOKEN_BUDGET = 6000
+
+CONTEXT_SEPARATOR = "\n" + 75 * "=" + "\n"
+
+#Rough characters per token, only used when no tiktoken encoding can be loaded
+APPROX_CHARS_PER_TOKEN = 4
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        #Encodings are downloaded on first use, offline hosts estimate instead
+        print(f"Could not load a tokenizer for [{model}], estimating token counts: {e}")
+        return None
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """
+    Count the tokens a piece of text costs for the given model.
+
+    Args:
+        text (str): The text to count.
+        model (str): The model whose tokenizer to use. Default is 'gpt-4o-mini'.
+
+    Returns:
+        int: The number of tokens.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // APPROX_CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+class ContextPiece:
+    def __init__(self, section, text, score, keys, description):
+        """
+        One renderable unit of retrieved context.
+
+        Args:
+            section (str): Which context it belongs to, e.g. 'summary' or 'code'.
+            text (str): The rendered text.
+            score (float): Retrieval score, higher is better. Similarity hits are in (0, 1], named entities are 1.0.
+            keys (iterable): Identifiers of the graph nodes the text covers, used to drop repeats.
+            description (str): Short label for logs, e.g. 'File utils.py'.
+        """
+        self.section = section
+        self.text = text
+        self.score = score
+        self.keys = frozenset(keys)
+        self.description = description
+
+    def __repr__(self):
+        return f"ContextPiece({self.section}, {self.description}, score={self.score:.3f})"
+
+class AssembledContext:
+    def __init__(self, sections, included, dropped, tokens_used, token_budget):
+        """
+        The packed context and a record of what did not fit.
+
+        Args:
+            sections (dict): Section name -> rendered context string.
+            included (list): The ContextPieces that were kept, best first.
+            dropped (list): (ContextPiece, reason) tuples for pieces left out.
+            tokens_used (int): Tokens used by the kept pieces.
+            token_budget (int): The budget the pieces were packed into.
+        """
+        self.sections = sections
+        self.included = included
+        self.dropped = dropped
+        self.tokens_used = tokens_used
+        self.token_budget = token_budget
+
+    def count(self, section, key_label):
+        """
+        Count distinct nodes with the given label kept in a section, e.g. files or chunks.
+
+        Args:
+            section (str): The section to count in.
+            key_label (str): The first element of the piece keys, e.g. 'File' or 'Chunk'.
+
+        Returns:
+            int: The number of distinct matching keys.
+        """
+        keys = set()
+        for piece in self.included:
+            if piece.section == section:
+                keys.update(key for key in piece.keys if key[0] == key_label)
+        return len(keys)
+
+def assemble_context(pieces, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET, sections=("summary", "code"), model="gpt-4o-mini"):
+    """
+    Rank, deduplicate, and pack context pieces from every retriever into one token budget.
+
+    Pieces are taken best score first. A piece whose nodes are all already covered by kept
+    pieces is dropped as a repeat, and a piece that would overflow the budget is skipped so a
+    smaller, lower ranked piece can still fit. Every dropped piece is printed with the reason.
+
+    Args:
+        pieces (list): ContextPieces from any number of retrievers.
+        token_budget (int, optional): Most tokens across all sections. None means no limit.
+        sections (tuple): Section names to render, always present in the output even if empty.
+        model (str): The model whose tokenizer to count with. Default is 'gpt-4o-mini'.
+
+    Returns:
+        AssembledContext: The rendered sections plus what was kept and dropped.
+    """
+    #The span records how much context was kept, the size every answer pays for
+    with span("assemble_context", "retrieval", pieces=len(pieces)) as current:
+        ranked = sorted(pieces, key=lambda piece: piece.score, reverse=True)
+
+        seen_keys = set()
+        included = []
+        dropped = []
+        tokens_used = 0
+
+        for piece in ranked:
+            if piece.keys and piece.keys <= seen_keys:
+                dropped.append((piece, "duplicate"))
+                continue
+
+            # Separators are counted too, they are part of what gets sent
+            piece_tokens = count_tokens(piece.text + CONTEXT_SEPARATOR, model=model)
+            if token_budget is not None and tokens_used + piece_tokens > token_budget:
+                dropped.append((piece, f"over budget ({piece_tokens} tokens, {token_budget - tokens_used} left)"))
+                continue
+
+            included.append(piece)
+            seen_keys.update(piece.keys)
+            tokens_used += piece_tokens
+
+        for piece, reason in dropped:
+            print(f"Dropped context piece {piece.description}: {reason}")
+
+        rendered = {
+            section: CONTEXT_SEPARATOR.join(piece.text for piece in included if piece.section == section)
+            for section in sections
+        }
+
+        current.set(tokens_used=tokens_used, included=len(included), dropped=len(dropped))
+        current.add_bytes(bytes_out=sum(payload_size(text) for text in rendered.values()))
+
+    return AssembledContext(
+        sections=rendered,
+        included=included,
+        dropped=dropped,
+        tokens_used=tokens_used,
+        token_budget=token_budget
+    )
+
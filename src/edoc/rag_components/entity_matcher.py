@@ -0,0 +1,323 @@
+import re
+import threading
+
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.gpt_helpers.graph_version import get_graph_version, get_database_key
+
+ENTITY_LABELS = ["Directory", "File", "Function", "Class", "Import"]
+
+#Split on anything that is not a letter or digit (snake_case, dotted.paths, dir/paths, file.ext)
+_NON_IDENTIFIER = re.compile(r"[^0-9A-Za-z]+")
+#Split camelCase and PascalCase, keeping acronyms together (HTTPServer -> HTTP, Server)
+_CAMEL_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+
+#Single token names shorter than this are too likely to collide with plain words
+MIN_SINGLE_TOKEN_LENGTH = 3
+#Only squashed names at least this long are considered for fuzzy (one edit) matches
+MIN_FUZZY_LENGTH = 6
+#Longest run of question tokens tried as one fuzzy candidate
+MAX_FUZZY_TOKENS = 4
+
+_TERMINAL = "__names__"
+
+#graph_version of a matcher that has never loaded names, None is a real version (a graph never stamped)
+_NEVER_LOADED = object()
+
+def normalize_identifier(text):
+    """
+    Break an identifier or a piece of text into lowercase tokens.
+
+    `get_text_splitter`, `getTextSplitter`, `GetTextSplitter` and `get.text.splitter`
+    all become ('get', 'text', 'splitter').
+
+    Args:
+        text (str): The identifier or text to normalize.
+
+    Returns:
+        tuple: The lowercase tokens.
+    """
+    tokens = []
+    for part in _NON_IDENTIFIER.split(text):
+        if not part:
+            continue
+        tokens.extend(piece.lower() for piece in _CAMEL_BOUNDARY.split(part) if piece)
+    return tuple(tokens)
+
+def _single_deletes(word):
+    """
+    All strings one deletion away from word.
+    """
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+def _within_one_edit(a, b):
+    """
+    Check if two strings are at most one insert, delete, substitute or swap apart.
+    """
+    if a == b:
+        return True
+
+    len_a, len_b = len(a), len(b)
+    if abs(len_a - len_b) > 1:
+        return False
+
+    if len_a == len_b:
+        diffs = [i for i in range(len_a) if a[i] != b[i]]
+        if len(diffs) == 1:
+            return True
+        #Adjacent transposition
+        return len(diffs) == 2 and diffs[1] == diffs[0] + 1 and a[diffs[0]] == b[diffs[1]] and a[diffs[1]] == b[diffs[0]]
+
+    if len_a > len_b:
+        a, b = b, a
+    #b is one longer than a, find the first mismatch and skip it in b
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            return a[i:] == b[i + 1:]
+    return True
+
+class EntityMatcher:
+    def __init__(self, project_id=None):
+        """
+        Match question text against the names that actually exist in the graph.
+
+        Names are stored in a token trie keyed by their normalized identifier tokens, so a
+        question is scanned once, leftmost-longest, without any LLM calls. Names that are
+        one typo away are caught through a symmetric delete index of their squashed form.
+
+        Args:
+            project_id (str, optional): Only load names of this project. None loads every project.
+        """
+        self.project_id = project_id
+
+        self._lock = threading.RLock()
+
+        self._trie = {}
+        self._known = set()
+        self._squashed = {}
+        self._deletes = {}
+
+        self.graph_version = _NEVER_LOADED
+
+    def __len__(self):
+        return len(self._known)
+
+    def add(self, name, label):
+        """
+        Add a single name to the matcher.
+
+        Args:
+            name (str): The name of the node.
+            label (str): The label of the node (e.g., 'File', 'Function').
+        """
+        tokens = normalize_identifier(name)
+        if not tokens:
+            return
+        if len(tokens) == 1 and len(tokens[0]) < MIN_SINGLE_TOKEN_LENGTH:
+            return
+
+        with self._lock:
+            if (name, label) in self._known:
+                return
+            self._known.add((name, label))
+
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node.setdefault(_TERMINAL, set()).add((name, label))
+
+            squashed = "".join(tokens)
+            if len(squashed) >= MIN_FUZZY_LENGTH:
+                if squashed not in self._squashed:
+                    for variant in _single_deletes(squashed) | {squashed}:
+                        self._deletes.setdefault(variant, set()).add(squashed)
+                self._squashed.setdefault(squashed, set()).add((name, label))
+
+    def remove(self, name, label):
+        """
+        Remove a single name from the matcher.
+
+        Args:
+            name (str): The name of the node.
+            label (str): The label of the node.
+        """
+        tokens = normalize_identifier(name)
+
+        with self._lock:
+            if (name, label) not in self._known:
+                return
+            self._known.discard((name, label))
+
+            node = self._trie
+            for token in tokens:
+                node = node.get(token)
+                if node is None:
+                    break
+            else:
+                node.get(_TERMINAL, set()).discard((name, label))
+
+            squashed = "".join(tokens)
+            owners = self._squashed.get(squashed)
+            if owners is not None:
+                owners.discard((name, label))
+                if not owners:
+                    del self._squashed[squashed]
+                    for variant in _single_deletes(squashed) | {squashed}:
+                        candidates = self._deletes.get(variant)
+                        if candidates is not None:
+                            candidates.discard(squashed)
+                            if not candidates:
+                                del self._deletes[variant]
+
+    def refresh(self, kg: Neo4jGraph, force=False):
+        """
+        Bring the matcher in line with the graph, only adding and removing names that changed.
+
+        Args:
+            kg (Neo4jGraph): The kg object to connect too.
+            force (bool): Reload names even if the graph version has not changed.
+        """
+        graph_version = get_graph_version(kg)
+        if not force and graph_version == self.graph_version:
+            return
+
+        subqueries = "\nUNION ALL\n".join(
+            f"MATCH (n:{label}) WHERE $project_id IS NULL OR n.project_id = $project_id RETURN n.name AS name, '{label}' AS label"
+            for label in ENTITY_LABELS
+        )
+        result = kg.query(f"CALL {{\n{subqueries}\n}}\nRETURN DISTINCT name, label", {"project_id": self.project_id})
+
+        current = {(record["name"], record["label"]) for record in result if record.get("name")}
+
+        with self._lock:
+            for name, label in self._known - current:
+                self.remove(name, label)
+            for name, label in current - self._known:
+                self.add(name, label)
+            self.graph_version = graph_version
+
+    def _fuzzy_lookup(self, squashed):
+        """
+        Find names whose squashed form is one edit away from the given string.
+        """
+        candidates = set(self._deletes.get(squashed, set()))
+        for variant in _single_deletes(squashed):
+            candidates.update(self._deletes.get(variant, set()))
+
+        matches = set()
+        for candidate in candidates:
+            if _within_one_edit(squashed, candidate):
+                matches.update(self._squashed[candidate])
+        return matches
+
+    def match(self, text, fuzzy=True):
+        """
+        Find every known name mentioned in the text.
+
+        Args:
+            text (str): The text to scan, typically the user's question.
+            fuzzy (bool): Also match names one edit away from a run of question tokens.
+
+        Returns:
+            list: A list of dicts with keys name, label, matched_text and fuzzy, in text order.
+        """
+        tokens = normalize_identifier(text)
+        found = {}
+
+        with self._lock:
+            i = 0
+            while i < len(tokens):
+                node = self._trie
+                best_end, best_names = None, None
+
+                for j in range(i, len(tokens)):
+                    node = node.get(tokens[j])
+                    if node is None:
+                        break
+                    if node.get(_TERMINAL):
+                        best_end, best_names = j + 1, node[_TERMINAL]
+
+                if best_names:
+                    for name, label in best_names:
+                        found.setdefault((name, label), {
+                            "name": name,
+                            "label": label,
+                            "matched_text": " ".join(tokens[i:best_end]),
+                            "fuzzy": False,
+                        })
+                    i = best_end
+                    continue
+
+                if fuzzy:
+                    #Prefer the longest run of tokens that fuzzy matches something
+                    for end in range(min(len(tokens), i + MAX_FUZZY_TOKENS), i, -1):
+                        squashed = "".join(tokens[i:end])
+                        if len(squashed) < MIN_FUZZY_LENGTH:
+                            continue
+                        fuzzy_names = self._fuzzy_lookup(squashed)
+                        if fuzzy_names:
+                            for name, label in fuzzy_names:
+                                found.setdefault((name, label), {
+                                    "name": name,
+                                    "label": label,
+                                    "matched_text": " ".join(tokens[i:end]),
+                                    "fuzzy": True,
+                                })
+                            i = end - 1
+                            break
+
+                i += 1
+
+        return list(found.values())
+
+    def extract_entities(self, text, labels=None, fuzzy=True):
+        """
+        Get the distinct names mentioned in the text, a drop in for the LLM entity extractor.
+
+        Args:
+            text (str): The text to scan.
+            labels (list, optional): Only return names with one of these labels.
+            fuzzy (bool): Also return names one edit away.
+
+        Returns:
+            list: The matched names.
+        """
+        names = []
+        for entity in self.match(text, fuzzy=fuzzy):
+            if labels is not None and entity["label"] not in labels:
+                continue
+            if entity["name"] not in names:
+                names.append(entity["name"])
+        return names
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+def get_entity_matcher(kg: Neo4jGraph, project_id=None):
+    """
+    Get the process wide EntityMatcher for the kg's database and project, refreshed against the current graph version.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+        project_id (str, optional): Only match names of this project. None matches every project.
+
+    Returns:
+        EntityMatcher: The shared, up to date matcher.
+    """
+    matcher_key = (get_database_key(kg), project_id)
+
+    with _matchers_lock:
+        matcher = _matchers.get(matcher_key)
+        if matcher is None:
+            matcher = EntityMatcher(project_id=project_id)
+            _matchers[matcher_key] = matcher
+
+    matcher.refresh(kg)
+    return matcher
+
+def clear_entity_matchers():
+    """
+    Drop every process wide EntityMatcher, the next get_entity_matcher rebuilds its index from the graph.
+    """
+    with _matchers_lock:
+        _matchers.clear()
@@ -0,0 +1,540 @@
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+
+import numpy as np
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.gpt_helpers.graph_version import get_graph_version
+from edoc.rag_components.vector_registry import VECTOR_INDEX_SPECS
+
+#hnswlib is optional (pip install edoc[ann]), without it every search is an exact numpy scan
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+#Below this many vectors an exact scan is as fast as an ANN lookup and always correct
+EXACT_SEARCH_THRESHOLD = 20000
+#Rows pulled from Neo4j per round trip while exporting
+EXPORT_BATCH_SIZE = 5000
+#Properties each label is exported in order of, unique per node and led by a property with a range
+#index (create_all_lookup_indexes), so every page is an index seek from where the last one ended
+EXPORT_PAGE_KEYS = {
+    "File": ["path", "project_id"],
+    "Directory": ["path", "project_id"],
+    "Chunk": ["id", "project_id"],
+}
+#Bumped when the export files change, older exports are treated as stale
+EXPORT_FORMAT = 3
+#Files of one export, each written to a new version directory
+EXPORT_SUFFIXES = [".f32", ".ids.json", ".projects.json", ".meta.json", ".hnsw"]
+
+DEFAULT_CACHE_DIR = os.getenv("EDOC_VECTOR_CACHE_DIR", os.path.normpath("../../edocVectorCache"))
+#Seconds without a heartbeat after which an export lock is taken over, its exporter presumed dead
+EXPORT_LOCK_TIMEOUT = int(os.getenv("EDOC_VECTOR_EXPORT_LOCK_TIMEOUT", "1800"))
+
+def _export_page_query(label, embedding_property, key_property, first_page):
+    """
+    Build the query reading one page of an index's rows, ordered by the label's page keys and starting after $after.
+    """
+    leading, tie_break = EXPORT_PAGE_KEYS[label]
+    #Untagged nodes from graphs built before project_id sort first among their leading key
+    tie_break_value = f"coalesce(n.{tie_break}, '')"
+
+    if first_page:
+        where = ""
+    else:
+        #The range on the leading key is what the index seeks on, the tie break orders rows within it
+        where = f"AND n.{leading} >= $after[0] AND (n.{leading} > $after[0] OR {tie_break_value} > $after[1])"
+
+    return f"""
+        MATCH (n:{label}) WHERE n.{embedding_property} IS NOT NULL {where}
+        RETURN [n.{leading}, {tie_break_value}] AS page_key, n.{key_property} AS key, n.project_id AS project_id,
+               n.{embedding_property} AS embedding
+        ORDER BY n.{leading} ASC, {tie_break_value} ASC
+        LIMIT $limit
+    """
+
+class LocalVectorIndex:
+    def __init__(self, directory, index_name):
+        """
+        One vector index exported from the graph to a memory mapped float32 matrix.
+
+        Each export is written to a new directory, <index>/<version>/, and <index>/current is then
+        replaced to name it. Readers resolve current once and read every file of that version, so
+        they never mix files of two exports. The version before is kept for readers still opening it.
+
+        Files written per export:
+            <index>.f32        row major float32 matrix of unit length embeddings
+            <index>.ids.json   the node key (id or name) of each row
+            <index>.projects.json  the project_id of each row
+            <index>.meta.json  row count, dimensions and the graph version it was exported at
+            <index>.hnsw       optional HNSW graph over the rows, built when hnswlib is installed
+
+        Args:
+            directory (str): The directory holding the exported files.
+            index_name (str): The name of an index in VECTOR_INDEX_SPECS.
+        """
+        self.directory = directory
+        self.index_name = index_name
+        self.spec = VECTOR_INDEX_SPECS[index_name]
+
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._keys = None
+        self._meta = None
+        self._version = None
+        self._hnsw = None
+        self._project_rows = None
+
+    def _index_directory(self):
+        return os.path.join(self.directory, self.index_name)
+
+    def _pointer_path(self):
+        return os.path.join(self._index_directory(), "current")
+
+    def _path(self, suffix, version):
+        return os.path.join(self._index_directory(), version, f"{self.index_name}{suffix}")
+
+    def _current_version(self):
+        """
+        The version directory current names, or None if the index has not been exported.
+        """
+        try:
+            with open(self._pointer_path(), "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @property
+    def meta(self):
+        """
+        The export metadata, or None if the index has not been exported.
+
+        Reading it pins the version the rest of the files are loaded from.
+        """
+        if self._meta is None:
+            version = self._current_version()
+            if version is not None and os.path.exists(self._path(".meta.json", version)):
+                with open(self._path(".meta.json", version), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                self._version = version
+                self._meta = meta
+        return self._meta
+
+    def export(self, kg: Neo4jGraph, graph_version):
+        """
+        Export the index's embeddings from the graph, replacing any earlier export.
+
+        Rows are streamed straight into a memory mapped file so the whole index never sits in memory.
+        Files are written to a new version directory and current is swapped to it in one rename,
+        readers never see a half written export or files of two exports.
+
+        Args:
+            kg (Neo4jGraph): The kg object to connect too.
+            graph_version (str): The graph version stamp to record.
+        """
+        version = f"{time.time_ns()}-{os.getpid()}"
+        os.makedirs(os.path.join(self._index_directory(), version))
+
+        label = self.spec["node_label"]
+        embedding_property = self.spec["embedding_property"]
+        key_property = self.spec["text_properties"][0]
+
+        count_result = kg.query(f"MATCH (n:{label}) WHERE n.{embedding_property} IS NOT NULL RETURN count(n) AS count")
+        count = count_result[0]["count"] if count_result else 0
+        dimensions_result = kg.query(
+            f"MATCH (n:{label}) WHERE n.{embedding_property} IS NOT NULL "
+            f"RETURN size(n.{embedding_property}) AS dimensions LIMIT 1"
+        )
+        dimensions = (dimensions_result[0]["dimensions"] if dimensions_result else None) or 0
+
+        matrix_path = self._path(".f32", version)
+
+        keys = []
+        projects = []
+        if count and dimensions:
+            matrix = np.memmap(matrix_path, dtype=np.float32, mode="w+", shape=(count, dimensions))
+
+            offset = 0
+            after = None
+            while offset < count:
+                result = kg.query(
+                    _export_page_query(label, embedding_property, key_property, first_page=after is None),
+                    {"after": after, "limit": min(EXPORT_BATCH_SIZE, count - offset)}
+                )
+                if not result:
+                    break
+                after = result[-1]["page_key"]
+
+                batch = np.asarray([record["embedding"] for record in result], dtype=np.float32)
+                norms = np.linalg.norm(batch, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                matrix[offset:offset + len(batch)] = batch / norms
+                keys.extend(record["key"] for record in result)
+                projects.extend(record["project_id"] for record in result)
+                offset += len(batch)
+
+            matrix.flush()
+            del matrix
+            count = len(keys)
+        else:
+            open(matrix_path, "wb").close()
+            count = 0
+
+        with open(self._path(".ids.json", version), "w", encoding="utf-8") as f:
+            json.dump(keys, f)
+        with open(self._path(".projects.json", version), "w", encoding="utf-8") as f:
+            json.dump(projects, f)
+
+        hnsw_written = False
+        if hnswlib is not None and count >= EXACT_SEARCH_THRESHOLD:
+            vectors = np.memmap(matrix_path, dtype=np.float32, mode="r", shape=(count, dimensions))
+            hnsw = hnswlib.Index(space="ip", dim=dimensions)
+            hnsw.init_index(max_elements=count, ef_construction=200, M=16)
+            hnsw.add_items(vectors, np.arange(count))
+            hnsw.save_index(self._path(".hnsw", version))
+            hnsw_written = True
+            del vectors
+
+        meta = {
+            "index_name": self.index_name,
+            "format": EXPORT_FORMAT,
+            "graph_version": graph_version,
+            "count": count,
+            "dimensions": dimensions,
+            "hnsw": hnsw_written,
+        }
+        with open(self._path(".meta.json", version), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        previous_version = self._current_version()
+        pointer_tmp = f"{self._pointer_path()}.tmp{os.getpid()}"
+        with open(pointer_tmp, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(pointer_tmp, self._pointer_path())
+
+        self._remove_old_versions(keep={version, previous_version})
+        self.unload()
+
+    def _remove_old_versions(self, keep):
+        """
+        Delete version directories other than keep, and the flat files of exports before versions.
+
+        Only the exporter holding the export lock calls this, so no other export is being written.
+        """
+        for name in os.listdir(self._index_directory()):
+            path = os.path.join(self._index_directory(), name)
+            if name not in keep and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+        for suffix in EXPORT_SUFFIXES:
+            try:
+                os.remove(os.path.join(self.directory, f"{self.index_name}{suffix}"))
+            except FileNotFoundError:
+                pass
+
+    def unload(self):
+        """
+        Drop the mapped matrix and loaded index so the next search reads the files again.
+        """
+        with self._lock:
+            self._keys = None
+            self._matrix = None
+            self._meta = None
+            self._version = None
+            self._hnsw = None
+            self._project_rows = None
+
+    def _load(self):
+        """
+        Map the exported files, keys are set last since searches check them to see if loading is done.
+        """
+        with self._lock:
+            if self._keys is not None:
+                return
+
+            meta = self.meta
+            if meta is None:
+                raise FileNotFoundError(f"Local vector index [{self.index_name}] has not been exported to {self.directory}")
+            #Every file comes from the version the meta was read from
+            version = self._version
+
+            if meta["count"]:
+                #Read only mapping, every worker process shares the same page cached file
+                self._matrix = np.memmap(self._path(".f32", version), dtype=np.float32, mode="r", shape=(meta["count"], meta["dimensions"]))
+            else:
+                self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+            if meta.get("hnsw") and hnswlib is not None:
+                hnsw = hnswlib.Index(space="ip", dim=meta["dimensions"])
+                hnsw.load_index(self._path(".hnsw", version), max_elements=meta["count"])
+                hnsw.set_ef(64)
+                self._hnsw = hnsw
+
+            #Row numbers per project, so a scoped search only scores that project's rows
+            with open(self._path(".projects.json", version), "r", encoding="utf-8") as f:
+                project_rows = {}
+                for row, project_id in enumerate(json.load(f)):
+                    project_rows.setdefault(project_id, []).append(row)
+                self._project_rows = {project_id: np.asarray(rows, dtype=np.int64) for project_id, rows in project_rows.items()}
+
+            with open(self._path(".ids.json", version), "r", encoding="utf-8") as f:
+                self._keys = json.load(f)
+
+    def search(self, embedding, k, project_id=None):
+        """
+        Find the k rows closest to the embedding by cosine similarity.
+
+        A search scoped to a project is an exact scan of that project's rows, the HNSW graph
+        spans every project and could miss a small project's rows entirely.
+
+        Args:
+            embedding (list): The query vector.
+            k (int): The number of results.
+            project_id (str, optional): Only search rows of this project. None searches every row.
+
+        Returns:
+            list: A list of (key, score) tuples, best first. Scores use Neo4j's cosine scale, (1 + cos) / 2.
+        """
+        if self._keys is None:
+            self._load()
+
+        #Snapshot under the lock so a concurrent unload cannot swap the arrays mid search
+        with self._lock:
+            keys, matrix, hnsw, project_rows = self._keys, self._matrix, self._hnsw, self._project_rows
+        if keys is None:
+            return []
+
+        candidate_rows = None
+        if project_id is not None:
+            candidate_rows = project_rows.get(project_id)
+            if candidate_rows is None:
+                return []
+            hnsw = None
+
+        count = len(keys) if candidate_rows is None else len(candidate_rows)
+        if count == 0 or k <= 0:
+            return []
+        k = min(k, count)
+
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+
+        if hnsw is not None:
+            #ef must be at least k for HNSW to return k results
+            if k > 64:
+                hnsw.set_ef(2 * k)
+            rows, distances = hnsw.knn_query(query, k=k)
+            rows, similarities = rows[0], 1.0 - distances[0]
+        else:
+            similarities_all = matrix @ query if candidate_rows is None else matrix[candidate_rows] @ query
+            if k < count:
+                rows = np.argpartition(-similarities_all, k - 1)[:k]
+            else:
+                rows = np.arange(count)
+            rows = rows[np.argsort(-similarities_all[rows])]
+            similarities = similarities_all[rows]
+            if candidate_rows is not None:
+                rows = candidate_rows[rows]
+
+        return [(keys[int(row)], float((1.0 + similarity) / 2.0)) for row, similarity in zip(rows, similarities)]
+
+class LocalVectorBackend:
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        """
+        In process vector search over exported copies of the graph's vector indexes.
+
+        Exports are stamped with the graph version. When the graph moves on, the next search
+        starts re-exporting the index in a background thread, and until that finishes callers
+        are told to use Neo4j instead.
+
+        Args:
+            directory (str): Where exported indexes are stored. Defaults to EDOC_VECTOR_CACHE_DIR.
+        """
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._export_thread = None
+        self._indexes = {index_name: LocalVectorIndex(directory, index_name) for index_name in VECTOR_INDEX_SPECS}
+
+    def _export_lock_path(self):
+        return os.path.join(self.directory, ".export.lock")
+
+    def _lock_is_stale(self):
+        """
+        Whether the export lock was left behind by an exporter that is gone.
+
+        The lock holds the pid and host of its exporter and its mtime is touched after every
+        index. It is stale if that pid is no longer running on this host, or if the heartbeat
+        is older than EXPORT_LOCK_TIMEOUT (an exporter on another host, or a reused pid).
+        """
+        lock_path = self._export_lock_path()
+        try:
+            age = time.time() - os.path.getmtime(lock_path)
+            with open(lock_path, "r", encoding="utf-8") as f:
+                owner = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            #Killed between creating the lock and writing it
+            owner = {}
+
+        if age > EXPORT_LOCK_TIMEOUT:
+            return True
+
+        if owner.get("host") == socket.gethostname() and owner.get("pid"):
+            try:
+                os.kill(owner["pid"], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                #Running, under another user
+                return False
+        return False
+
+    def _acquire_export_lock(self):
+        """
+        Create the export lock, taking it over if its exporter died.
+
+        Returns:
+            bool: True if this process now holds the lock.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        lock_path = self._export_lock_path()
+
+        for _ in range(2):
+            try:
+                lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._lock_is_stale():
+                    return False
+                print(f"Taking over the stale vector export lock {lock_path}")
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+
+            with os.fdopen(lock_fd, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "host": socket.gethostname(), "created": time.time()}, f)
+            return True
+
+        return False
+
+    def _export(self, kg: Neo4jGraph, index_names, graph_version):
+        """
+        Export the given indexes under the export lock, run on the background export thread.
+        """
+        if not self._acquire_export_lock():
+            return
+
+        try:
+            for index_name in index_names:
+                print(f"Exporting vector index [{index_name}] to {self.directory}")
+                self._indexes[index_name].export(kg, graph_version)
+                #Heartbeat, so a long export is not mistaken for a dead one
+                os.utime(self._export_lock_path())
+        except Exception as e:
+            print(f"An error occurred while exporting vector indexes to {self.directory}: {e}")
+        finally:
+            os.remove(self._export_lock_path())
+
+    def ensure_fresh(self, kg: Neo4jGraph, index_names=None, graph_version=None, wait=False):
+        """
+        Make sure the exported indexes match the graph version, exporting them if not.
+
+        Stale indexes are exported in a background thread and False is returned at once, so the
+        question that notices a new graph version is answered from Neo4j rather than waiting on
+        the export. Only one process exports at a time; the others keep getting False until the
+        files are written.
+
+        Args:
+            kg (Neo4jGraph): The kg object to connect too.
+            index_names (list, optional): Indexes to check. Defaults to all.
+            graph_version (str, optional): The current version, read from the graph if None.
+            wait (bool): Wait for this process' export to finish instead of returning False. Default is False.
+
+        Returns:
+            bool: True if every requested index is up to date.
+        """
+        if index_names is None:
+            index_names = list(VECTOR_INDEX_SPECS.keys())
+        if graph_version is None:
+            graph_version = get_graph_version(kg)
+
+        def find_stale():
+            stale = []
+            for index_name in index_names:
+                meta = self._indexes[index_name].meta
+                if meta is None or meta.get("graph_version") != graph_version or meta.get("format") != EXPORT_FORMAT:
+                    # Another process or the export thread may have finished an export since we last looked
+                    self._indexes[index_name].unload()
+                    meta = self._indexes[index_name].meta
+                    if meta is None or meta.get("graph_version") != graph_version or meta.get("format") != EXPORT_FORMAT:
+                        stale.append(index_name)
+            return stale
+
+        stale = find_stale()
+        if not stale:
+            return True
+
+        with self._lock:
+            if self._export_thread is None or not self._export_thread.is_alive():
+                self._export_thread = threading.Thread(
+                    target=self._export,
+                    args=(kg, stale, graph_version),
+                    name="edoc-vector-export",
+                    daemon=True
+                )
+                self._export_thread.start()
+            export_thread = self._export_thread
+
+        if not wait:
+            return False
+
+        export_thread.join()
+        return not find_stale()
+
+    def search(self, index_name, embedding, k, project_id=None):
+        """
+        Search one exported index.
+
+        Args:
+            index_name (str): The name of an index in VECTOR_INDEX_SPECS.
+            embedding (list): The query vector.
+            k (int): The number of results.
+            project_id (str, optional): Only search nodes of this project. None searches every node.
+
+        Returns:
+            list: A list of (key, score) tuples, best first.
+        """
+        return self._indexes[index_name].search(embedding, k, project_id=project_id)
+
+    def unload(self):
+        """
+        Drop every mapped index, the next search reads the exported files again.
+        """
+        for index in self._indexes.values():
+            index.unload()
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_local_vector_backend():
+    """
+    Get the process wide LocalVectorBackend, creating it on first use.
+
+    Returns:
+        LocalVectorBackend: The shared backend.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = LocalVectorBackend()
+    return _backend
@@ -0,0 +1,361 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.rag_components.vector_registry import get_vector_registry, VECTOR_INDEX_SPECS
+from edoc.rag_components.entity_matcher import get_entity_matcher
+from edoc.rag_components.local_vector_backend import get_local_vector_backend
+from edoc.monitoring.tracing import span, traced, propagate, payload_size
+
+#Fulltext indexes searched alongside the vector indexes, matches GraphBuilder.create_all_lookup_indexes.
+#key_property is what the matching vector index returns as text, so both legs can be fused.
+FULLTEXT_INDEX_SPECS = {
+    "fileSummaryFulltextIndex": {"node_label": "File", "text_property": "summary", "key_property": "name"},
+    "chunkRawFulltextIndex": {"node_label": "Chunk", "text_property": "raw_code", "key_property": "id"},
+    "chunkSummaryFulltextIndex": {"node_label": "Chunk", "text_property": "summary", "key_property": "id"},
+}
+
+#Weights for each leg of the reciprocal rank fusion, a key can also be a single index name
+DEFAULT_FUSION_WEIGHTS = {"vector": 1.0, "lexical": 1.0}
+#Standard RRF damping constant, larger values flatten the difference between ranks
+RRF_K = 60
+
+#Searches scoped to a project fetch this many times top_k candidates from the shared index,
+#then keep the project's best top_k. Raise it if small projects in a large database come back short.
+PROJECT_CANDIDATE_FACTOR = int(os.getenv("EDOC_PROJECT_CANDIDATE_FACTOR", "10"))
+
+#Shared pool so a question does not pay for spinning up threads
+_search_executor = ThreadPoolExecutor(
+    max_workers=len(VECTOR_INDEX_SPECS) + len(FULLTEXT_INDEX_SPECS),
+    thread_name_prefix="edoc-search"
+)
+
+#Lucene query syntax characters that must be escaped in a term
+_LUCENE_SPECIAL_CHARACTERS = set('+-&|!(){}[]^"~*?:\\/')
+
+def escape_lucene(text):
+    """
+    Escape Lucene query syntax characters so text can be used as fulltext query terms.
+
+    Args:
+        text (str): The raw text.
+
+    Returns:
+        str: The escaped text.
+    """
+    return "".join(f"\\{char}" if char in _LUCENE_SPECIAL_CHARACTERS else char for char in text)
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K):
+    """
+    Merge ranked lists of keys with weighted reciprocal rank fusion.
+
+    Each key scores sum(weight / (k + rank)) over the lists it appears in, rank starting at 1.
+
+    Args:
+        ranked_lists (list): A list of (weight, [key, ...]) tuples, each list best first.
+        k (int): The RRF damping constant. Default is 60.
+
+    Returns:
+        list: A list of (key, fused_score) tuples, best first.
+    """
+    fused = {}
+    for weight, keys in ranked_lists:
+        for rank, key in enumerate(keys, start=1):
+            fused[key] = fused.get(key, 0.0) + weight / (k + rank)
+
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+def _page_content_key(page_content):
+    """
+    Get the property value from Neo4jVector page content, which is formatted as '\\n<property>: <value>'.
+    """
+    return page_content.lstrip("\n").split(": ", 1)[-1]
+
+def _candidate_count(top_k, project_id):
+    """
+    How many results to fetch from a shared index so top_k are left after the project filter.
+    """
+    return top_k if project_id is None else top_k * PROJECT_CANDIDATE_FACTOR
+
+#A null project_id searches every project
+FULLTEXT_SEARCH_QUERY = """
+CALL db.index.fulltext.queryNodes($index_name, $lucene_query, {limit: $candidates})
+YIELD node, score
+WHERE $project_id IS NULL OR node.project_id = $project_id
+RETURN node[$key_property] AS key, score
+ORDER BY score DESC
+LIMIT $top_k
+"""
+
+def _fulltext_search_params(index_name, question, top_k, project_id=None):
+    """
+    Build the parameters for FULLTEXT_SEARCH_QUERY.
+    """
+    return {
+        "index_name": index_name,
+        "lucene_query": escape_lucene(question),
+        "top_k": top_k,
+        "candidates": _candidate_count(top_k, project_id),
+        "project_id": project_id,
+        "key_property": FULLTEXT_INDEX_SPECS[index_name]["key_property"],
+    }
+
+#Same search Neo4jVector runs, with the project filter applied to the index's candidates
+VECTOR_SEARCH_QUERY = """
+CALL db.index.vector.queryNodes($index_name, $candidates, $embedding)
+YIELD node, score
+WHERE $project_id IS NULL OR node.project_id = $project_id
+RETURN node[$key_property] AS key, score
+ORDER BY score DESC
+LIMIT $top_k
+"""
+
+def _vector_search_params(index_name, embedding, top_k, project_id=None):
+    """
+    Build the parameters for VECTOR_SEARCH_QUERY.
+    """
+    return {
+        "index_name": index_name,
+        "top_k": top_k,
+        "candidates": _candidate_count(top_k, project_id),
+        "project_id": project_id,
+        "embedding": embedding,
+        "key_property": VECTOR_INDEX_SPECS[index_name]["text_properties"][0],
+    }
+
+def _fulltext_search(kg: Neo4jGraph, index_name, question, top_k, project_id=None):
+    """
+    Search a fulltext index with the words of the question.
+
+    Returns:
+        list: A list of (key, score) tuples, best first. Empty if the index does not exist yet.
+    """
+    try:
+        result = kg.query(FULLTEXT_SEARCH_QUERY, _fulltext_search_params(index_name, question, top_k, project_id))
+    except Exception as e:
+        print(f"An error occurred while searching fulltext index [{index_name}]: {e}")
+        return []
+
+    return [(record["key"], record["score"]) for record in result if record.get("key") is not None]
+
+class QueryAnalysis:
+    def __init__(self, question, embedding, top_k, results, entity_matches=None, lexical_results=None, project_id=None):
+        """
+        The result of analyzing a question once, to be shared by every retriever.
+
+        Args:
+            question (str): The user's question.
+            embedding (list): The embedding vector of the question.
+            top_k (int): The number of results fetched from each index.
+            results (dict): Vector index name -> list of (key, score) tuples, best first.
+            entity_matches (list, optional): Graph names found in the question, see EntityMatcher.match.
+            lexical_results (dict, optional): Fulltext index name -> list of (key, score) tuples, best first.
+            project_id (str, optional): The project the question was scoped to, None for every project.
+                Lookups made from this analysis are scoped to the same project.
+        """
+        self.question = question
+        self.embedding = embedding
+        self.top_k = top_k
+        self.results = results
+        self.entity_matches = entity_matches or []
+        self.lexical_results = lexical_results or {}
+        self.project_id = project_id
+
+    def scored_keys(self, index_name):
+        """
+        Get the (key, score) pairs returned by one vector or fulltext index, best first.
+
+        Args:
+            index_name (str): The index to read results from.
+
+        Returns:
+            list: A list of (key, score) tuples, keys are node ids or names.
+        """
+        if index_name in FULLTEXT_INDEX_SPECS:
+            return self.lexical_results.get(index_name, [])
+        return self.results.get(index_name, [])
+
+    def ranked_keys(self, index_name):
+        """
+        Get the node keys (id or name) returned by one vector or fulltext index, best first.
+
+        Args:
+            index_name (str): The index to read results from.
+
+        Returns:
+            list: The keys, best first.
+        """
+        return [key for key, _ in self.scored_keys(index_name)]
+
+    def fused_scored_keys(self, index_names, limit=None, fusion_weights=None):
+        """
+        Merge the results of several vector and fulltext indexes with reciprocal rank fusion.
+
+        Args:
+            index_names (list): The indexes to fuse, vector and fulltext names can be mixed.
+            limit (int, optional): The most keys to return.
+            fusion_weights (dict, optional): Weights by leg ('vector', 'lexical') or by index name.
+                Missing entries fall back to DEFAULT_FUSION_WEIGHTS.
+
+        Returns:
+            list: A list of (key, score) tuples, best first. Scores are relative to the best
+                possible fused score, so they fall in (0, 1].
+        """
+        weights = dict(DEFAULT_FUSION_WEIGHTS)
+        weights.update(fusion_weights or {})
+
+        ranked_lists = []
+        for index_name in index_names:
+            leg = "lexical" if index_name in FULLTEXT_INDEX_SPECS else "vector"
+            weight = weights.get(index_name, weights.get(leg, 1.0))
+            if weight > 0:
+                ranked_lists.append((weight, self.ranked_keys(index_name)))
+
+        fused = reciprocal_rank_fusion(ranked_lists)
+
+        #A key ranked first in every list scores sum(weight / (k + 1)), scale against that
+        best_possible = sum(weight for weight, _ in ranked_lists) / (RRF_K + 1)
+        if best_possible > 0:
+            fused = [(key, score / best_possible) for key, score in fused]
+
+        if limit is not None:
+            fused = fused[:limit]
+        return fused
+
+    def fused_keys(self, index_names, limit=None, fusion_weights=None):
+        """
+        Merge the results of several vector and fulltext indexes with reciprocal rank fusion.
+
+        Args:
+            index_names (list): The indexes to fuse, vector and fulltext names can be mixed.
+            limit (int, optional): The most keys to return.
+            fusion_weights (dict, optional): Weights by leg ('vector', 'lexical') or by index name.
+
+        Returns:
+            list: The fused keys, best first.
+        """
+        return [key for key, _ in self.fused_scored_keys(index_names, limit=limit, fusion_weights=fusion_weights)]
+
+    def entity_names(self, labels=None):
+        """
+        Get the distinct graph names mentioned in the question.
+
+        Args:
+            labels (list, optional): Only return names with one of these labels.
+
+        Returns:
+            list: The matched names.
+        """
+        names = []
+        for entity in self.entity_matches:
+            if labels is not None and entity["label"] not in labels:
+                continue
+            if entity["name"] not in names:
+                names.append(entity["name"])
+        return names
+
+def _neo4j_vector_search(vector_index, embedding, top_k):
+    """
+    Search a Neo4jVector store by vector.
+
+    Returns:
+        list: A list of (key, score) tuples, best first.
+    """
+    #Neo4jVector runs the search on its own driver, so it is not seen by the traced graph
+    with span("vector.search", "cypher", index=getattr(vector_index, "index_name", None)) as current:
+        results = [
+            (_page_content_key(document.page_content), score)
+            for document, score in vector_index.similarity_search_with_score_by_vector(embedding, k=top_k)
+        ]
+        current.add_bytes(bytes_out=payload_size(results))
+        return results
+
+def _project_vector_search(kg: Neo4jGraph, index_name, embedding, top_k, project_id):
+    """
+    Search a vector index for one project's nodes, through the kg rather than a Neo4jVector store.
+
+    Returns:
+        list: A list of (key, score) tuples, best first.
+    """
+    result = kg.query(VECTOR_SEARCH_QUERY, _vector_search_params(index_name, embedding, top_k, project_id))
+    return [(record["key"], record["score"]) for record in result if record.get("key") is not None]
+
+@traced("analyze_query", kind="retrieval")
+def analyze_query(kg: Neo4jGraph, question: str, top_k: int, index_names=None, fulltext_index_names=None, retrieval_backend="neo4j", project_id=None) -> QueryAnalysis:
+    """
+    Embed the question once and search every vector index with that single vector.
+
+    The vector searches and the fulltext searches over the question's words run concurrently,
+    so the cost is one embedding call plus the slowest index lookup. Names from the graph
+    mentioned in the question are matched locally at the same time.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too.
+        question (str): The user's question.
+        top_k (int): The number of top results to retrieve from each index.
+        index_names (list, optional): Vector indexes to search. Defaults to every index in VECTOR_INDEX_SPECS.
+        fulltext_index_names (list, optional): Fulltext indexes to search. Defaults to every index in FULLTEXT_INDEX_SPECS.
+        retrieval_backend (str): Where vector searches run, 'neo4j' or 'local' (memory mapped in process copy,
+            see LocalVectorBackend). 'local' falls back to 'neo4j' while its export is out of date. Default is 'neo4j'.
+        project_id (str, optional): Only return nodes of this project. None searches every project.
+
+    Returns:
+        QueryAnalysis: The embedding, the scored results per index, and the matched entities.
+    """
+    if index_names is None:
+        index_names = list(VECTOR_INDEX_SPECS.keys())
+
+    if fulltext_index_names is None:
+        fulltext_index_names = list(FULLTEXT_INDEX_SPECS.keys())
+
+    #The lexical leg does not need the embedding, start it first
+    lexical_futures = {
+        index_name: _search_executor.submit(propagate(_fulltext_search), kg, index_name, question, top_k, project_id)
+        for index_name in fulltext_index_names
+    }
+
+    registry = get_vector_registry()
+
+    use_local = False
+    if retrieval_backend == "local":
+        local_backend = get_local_vector_backend()
+        use_local = local_backend.ensure_fresh(kg, index_names=index_names)
+    elif retrieval_backend != "neo4j":
+        raise ValueError(f"Unknown retrieval backend [{retrieval_backend}], use 'neo4j' or 'local'.")
+
+    if use_local:
+        embedding = registry.embeddings.embed_query(question)
+        futures = {
+            index_name: _search_executor.submit(propagate(local_backend.search), index_name, embedding, top_k, project_id)
+            for index_name in index_names
+        }
+    elif project_id is not None:
+        embedding = registry.embeddings.embed_query(question)
+        futures = {
+            index_name: _search_executor.submit(propagate(_project_vector_search), kg, index_name, embedding, top_k, project_id)
+            for index_name in index_names
+        }
+    else:
+        vector_indexes = registry.get_vector_indexes(kg, index_names)
+        embedding = registry.embeddings.embed_query(question)
+        futures = {
+            index_name: _search_executor.submit(propagate(_neo4j_vector_search), vector_index, embedding, top_k)
+            for index_name, vector_index in zip(index_names, vector_indexes)
+        }
+
+    #Runs while the index searches are in flight
+    entity_matches = get_entity_matcher(kg, project_id).match(question)
+
+    results = {index_name: future.result() for index_name, future in futures.items()}
+    lexical_results = {index_name: future.result() for index_name, future in lexical_futures.items()}
+
+    return QueryAnalysis(
+        question=question,
+        embedding=embedding,
+        top_k=top_k,
+        results=results,
+        entity_matches=entity_matches,
+        lexical_results=lexical_results,
+        project_id=project_id
+    )
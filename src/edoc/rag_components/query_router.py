@@ -0,0 +1,216 @@
+import os
+import re
+import time
+import json
+import threading
+from collections import deque
+
+ROUTES = ("summary", "code", "both")
+
+#Which context sections each route retrieves
+ROUTE_SECTIONS = {
+    "summary": ("summary",),
+    "code": ("code",),
+    "both": ("summary", "code"),
+}
+
+#Words that point at the shape or purpose of the project rather than its source
+_SUMMARY_CUES = re.compile(
+    r"\b(folders?|director(y|ies)|dirs?|modules?|packages?|projects?|structure|overview|architecture|"
+    r"purpose|responsib\w*|organi[sz]ed?|layout|high[- ]level|summar\w*|describe|explain the (repo|project|codebase))\b",
+    re.IGNORECASE
+)
+#Words that point at specific source code
+_CODE_CUES = re.compile(
+    r"\b(param(eter)?s?|arg(ument)?s?|returns?|signature|implement\w*|source|code|functions?|methods?|"
+    r"class(es)?|imports?|variables?|raises?|exceptions?|bugs?|lines?|calls?|called|defaults?|types?|"
+    r"decorators?|loops?|logic|algorithm)\b",
+    re.IGNORECASE
+)
+#name() or name(...) in the question is always about code
+_CALL_SYNTAX = re.compile(r"\b[A-Za-z_]\w*\(")
+
+_SUMMARY_LABELS = {"Directory", "File"}
+_CODE_LABELS = {"Function", "Class", "Import"}
+
+class RouteDecision:
+    def __init__(self, route, reasons, routing_seconds):
+        """
+        Which retrievers a question needs.
+
+        Args:
+            route (str): 'summary', 'code' or 'both'.
+            reasons (list): Short notes on the signals that decided the route.
+            routing_seconds (float): Time spent routing.
+        """
+        self.route = route
+        self.reasons = reasons
+        self.routing_seconds = routing_seconds
+
+    @property
+    def sections(self):
+        """
+        The context sections to retrieve for this route.
+        """
+        return ROUTE_SECTIONS[self.route]
+
+    def __repr__(self):
+        return f"RouteDecision({self.route}, {self.reasons})"
+
+def route_query(question, entity_matches=None):
+    """
+    Pick the retrievers a question needs with cheap local signals, no LLM call.
+
+    Entity matches vote by label (directories and files for summaries, functions, classes and
+    imports for code) and cue words vote for either side. A question only skips a retriever when
+    every signal agrees, anything mixed or without signals runs both.
+
+    Args:
+        question (str): The user's question.
+        entity_matches (list, optional): Names found in the question, see EntityMatcher.match.
+
+    Returns:
+        RouteDecision: The chosen route and why.
+    """
+    start = time.perf_counter()
+
+    summary_votes = []
+    code_votes = []
+
+    for entity in entity_matches or []:
+        if entity["label"] in _SUMMARY_LABELS:
+            summary_votes.append(f"{entity['label']} {entity['name']}")
+        elif entity["label"] in _CODE_LABELS:
+            code_votes.append(f"{entity['label']} {entity['name']}")
+
+    summary_votes.extend(f"cue '{match.group(0).lower()}'" for match in _SUMMARY_CUES.finditer(question))
+    code_votes.extend(f"cue '{match.group(0).lower()}'" for match in _CODE_CUES.finditer(question))
+
+    if _CALL_SYNTAX.search(question):
+        code_votes.append("call syntax")
+
+    if summary_votes and not code_votes:
+        route, reasons = "summary", summary_votes
+    elif code_votes and not summary_votes:
+        route, reasons = "code", code_votes
+    else:
+        route = "both"
+        reasons = (summary_votes + code_votes) or ["no routing signal"]
+
+    return RouteDecision(route, reasons, time.perf_counter() - start)
+
+class RoutingLog:
+    def __init__(self, max_records=1000, log_path=None):
+        """
+        Record routing decisions and how long the answers they led to took.
+
+        Savings are estimated against questions that ran both retrievers: every routed answer
+        is credited with the mean 'both' latency minus its own. In 'combine' mode a routed
+        question also skips two LLM calls (one partial answer and the combining call).
+
+        Args:
+            max_records (int): Most recent decisions kept in memory. Default is 1000.
+            log_path (str, optional): JSONL file to append every decision to.
+        """
+        self.log_path = log_path
+
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max_records)
+        self._totals = {route: {"count": 0, "seconds": 0.0} for route in ROUTES}
+        self._llm_calls_saved = 0
+        self._routed_seconds = {"summary": 0.0, "code": 0.0}
+
+    def record(self, question, decision: RouteDecision, answer_seconds, mode="combine"):
+        """
+        Record one answered question.
+
+        Args:
+            question (str): The user's question.
+            decision (RouteDecision): The routing decision used.
+            answer_seconds (float): Time from routing to the finished answer.
+            mode (str): The answer mode used.
+        """
+        record = {
+            "time": time.time(),
+            "question": question,
+            "route": decision.route,
+            "reasons": decision.reasons,
+            "mode": mode,
+            "routing_ms": round(decision.routing_seconds * 1000, 3),
+            "answer_seconds": round(answer_seconds, 3),
+        }
+
+        with self._lock:
+            self._records.append(record)
+            self._totals[decision.route]["count"] += 1
+            self._totals[decision.route]["seconds"] += answer_seconds
+            if decision.route != "both":
+                self._routed_seconds[decision.route] += answer_seconds
+                if mode == "combine":
+                    self._llm_calls_saved += 2
+
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record) + "\n")
+                except OSError as e:
+                    print(f"Could not write routing log [{self.log_path}]: {e}")
+
+        print(
+            f"Routed question to {decision.route} in {record['routing_ms']:.3f}ms "
+            f"({', '.join(decision.reasons)}), answered in {answer_seconds:.2f}s"
+        )
+
+    def summary(self):
+        """
+        Summarize the recorded decisions.
+
+        Returns:
+            dict: Per route count and mean answer seconds, LLM calls saved, and the estimated seconds saved
+                (None until at least one question has run both retrievers).
+        """
+        with self._lock:
+            routes = {
+                route: {
+                    "count": totals["count"],
+                    "mean_seconds": totals["seconds"] / totals["count"] if totals["count"] else None,
+                }
+                for route, totals in self._totals.items()
+            }
+
+            both_mean = routes["both"]["mean_seconds"]
+            if both_mean is None:
+                seconds_saved = None
+            else:
+                routed_count = routes["summary"]["count"] + routes["code"]["count"]
+                seconds_saved = both_mean * routed_count - sum(self._routed_seconds.values())
+
+            return {
+                "routes": routes,
+                "llm_calls_saved": self._llm_calls_saved,
+                "estimated_seconds_saved": seconds_saved,
+            }
+
+    def recent(self, n=20):
+        """
+        Get the most recent decisions, newest last.
+        """
+        with self._lock:
+            return list(self._records)[-n:]
+
+_routing_log = None
+_routing_log_lock = threading.Lock()
+
+def get_routing_log():
+    """
+    Get the process wide RoutingLog, creating it on first use. Set EDOC_ROUTING_LOG to a file path
+    to also append every decision to a JSONL file.
+
+    Returns:
+        RoutingLog: The shared log.
+    """
+    global _routing_log
+    with _routing_log_lock:
+        if _routing_log is None:
+            _routing_log = RoutingLog(log_path=os.getenv("EDOC_ROUTING_LOG"))
+    return _routing_log
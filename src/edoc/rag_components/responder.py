@@ -1,33 +1,104 @@
+import time
+import asyncio
+import threading
+from operator import itemgetter
+
 from edoc.gpt_helpers.connect import connect_to_neo4j
-from edoc.rag_components.structured_retrievers import dir_file_structured_retriever, code_structured_retriever
+from edoc.rag_components.structured_retrievers import dir_file_structured_retriever, code_structured_retriever, collect_structured_context, indexes_for_sections
+from edoc.rag_components.query_analysis import analyze_query
+from edoc.rag_components.context_assembler import DEFAULT_CONTEXT_TOKEN_BUDGET, count_tokens
+from edoc.rag_components.async_retrievers import AsyncRetriever
+from edoc.rag_components.vector_registry import get_vector_registry, VECTOR_INDEX_SPECS
+from edoc.rag_components.entity_matcher import get_entity_matcher
+from edoc.rag_components.query_router import route_query, get_routing_log, RouteDecision, ROUTES
+from edoc.gpt_helpers.graph_version import get_graph_version
+from edoc.gpt_helpers.gpt_basics import get_chat_model
+from edoc.monitoring.tracing import traced
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel
+from langchain_core.runnables import RunnablePassthrough, RunnableParallel, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 
 from edoc.gpt_helpers.connect import OpenAiConfig
 
-OPENAI_API_KEY = OpenAiConfig.get_openai_api_key()
+def retrieval_status(context):
+    """
+    Describe what was retrieved for a question, shown while the answer is written.
+
+    Args:
+        context (AssembledContext): The assembled context.
+
+    Returns:
+        str: e.g. 'Retrieved 3 files / 7 chunks'.
+    """
+    return f"Retrieved {context.count('summary', 'File')} files / {context.count('code', 'Chunk')} chunks"
+
+#'combine' answers from the summary and code context separately then merges the two (three LLM calls),
+#'single_pass' puts both contexts in one prompt (one LLM call, larger prompt)
+ANSWER_MODES = ("combine", "single_pass")
+
+def _check_answer_mode(mode):
+    if mode not in ANSWER_MODES:
+        raise ValueError(f"Unknown answer mode [{mode}], use one of {ANSWER_MODES}.")
+
+#Seconds between health checks of a shared responder, checked when it is handed out
+HEALTH_CHECK_INTERVAL = 30
+
+def _summary_context(_dict):
+    """
+    Use the summary context already assembled for the question, or retrieve it.
+    """
+    if _dict.get("summary_context") is not None:
+        return _dict["summary_context"]
+    return dir_file_structured_retriever(_dict)
+
+def _code_context(_dict):
+    """
+    Use the code context already assembled for the question, or retrieve it.
+    """
+    if _dict.get("code_context") is not None:
+        return _dict["code_context"]
+    return code_structured_retriever(_dict)
 
 class BuildResponse:
     def __init__(self, model='gpt-4o-mini'):
         """
         Initialize CodebaseQA class with an LLM model and a Neo4j connection.
 
+        The chains are compiled here once and hold no per question state, everything a question
+        needs travels in the dict passed to invoke. One instance can be shared across threads,
+        see get_responder.
+
         Args:
             llm_model (str): The language model to use. Default is 'gpt-4o-mini'.
 
         """
-        self.llm = ChatOpenAI(
-            temperature=0,
-            model=model,
-            api_key=OPENAI_API_KEY
-        )
+        self.model = model
+        self.api_key = OpenAiConfig.get_openai_api_key()
+
+        self.llm = get_chat_model(model=model, temperature=0)
 
         # Connect to Neo4j database
         self.kg = connect_to_neo4j()
 
+        #Async driver and client are only opened if aget_full_response is used
+        self.async_retriever = AsyncRetriever(self.kg)
+
+        self.summary_chain = self._setup_partial_chain(structured_retriever=_summary_context)
+        self.code_chain = self._setup_partial_chain(structured_retriever=_code_context)
+        self.combine_chain = self._setup_combine_chain()
+        self.single_pass_chain = self._setup_single_pass_chain()
+        self.full_chain = (
+            RunnableParallel(
+                {
+                    "summary_response": RunnableLambda(self._get_summary_response),
+                    "code_response": RunnableLambda(self._get_code_response),
+                    "question": itemgetter("question"),
+                }
+            )
+            | self.combine_chain
+        )
+
     def _setup_partial_chain(self, structured_retriever):
         """
         Set up the prompt, template, and processing chain for answering questions.
@@ -51,7 +122,8 @@ class BuildResponse:
             RunnableParallel(
                 {
                     "context": RunnablePassthrough() | structured_retriever,
-                    "question": RunnablePassthrough(),
+                    #Only the question text, the dict also carries the kg and query analysis
+                    "question": itemgetter("question"),
                 }
             )
             | prompt
@@ -61,10 +133,56 @@ class BuildResponse:
 
         return chain
 
+    def _setup_combine_chain(self):
+        """
+        Set up the prompt and chain that combines the summary and code answers into one.
+        """
+
+        template = """Answer the question about a coding project by combining the two parital answers you are given.
+        The two responses focus on either summary knowledge, or code specific knowledge.
+        I would like for you to combine them to a single response that answers the question
+        in detail. If there is not sufficient info say so.
+
+        Question: {question}
+
+        Summary response: {summary_response}
+
+        Code response: {code_response}
+
+        Answer:"""
+
+
+        prompt = ChatPromptTemplate.from_template(template)
+
+        return prompt | self.llm | StrOutputParser()
+
+    def _setup_single_pass_chain(self):
+        """
+        Set up the prompt and chain that answers from the summary and code context in one call.
+        """
+
+        template = """Answer the question about a coding project using the following context, if you are unsure say so.
+        The summary context describes the files and directories involved, the code context holds the
+        relevant source code. Use both to answer the question in detail.
+
+        Question: {question}
+
+        Summary context: {summary_context}
+
+        Code context: {code_context}
+
+        Answer:"""
+
+
+        prompt = ChatPromptTemplate.from_template(template)
+
+        return prompt | self.llm | StrOutputParser()
+
     #A downside to langchain again, to combine the summary code and responses
     #We wanted to run code/summary in parallel via function call
     # Butthe function must take the same dict, so there is no way to differ the call
     #When running the chain. We must make two seperate functions that take same dict
+    @traced("BuildResponse.summary_response")
     def _get_summary_response(self, _dict):
         """
         Get the response by invoking the chain with the question and relevant context.
@@ -73,6 +191,11 @@ class BuildResponse:
             _dict (dict): keys include
                 question (str): The user's question.
                 top_k (int): The number of top results to consider. Default is 1.
+                query_analysis (QueryAnalysis, optional): A shared analysis of the question.
+                fusion_weights (dict, optional): Reciprocal rank fusion weights for the vector and lexical legs.
+                retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+                summary_context (str, optional): Context already assembled for this question, skips the retriever.
+                project_id (str, optional): Only look in this project. None looks in every project.
 
         Returns:
             str: The generated answer from the LLM.
@@ -82,20 +205,27 @@ class BuildResponse:
         #if called standalone 
         question = _dict.get("question") 
         top_k = _dict.get("top_k", 1) 
+        query_analysis = _dict.get("query_analysis")
+        fusion_weights = _dict.get("fusion_weights")
+        retrieval_backend = _dict.get("retrieval_backend", "neo4j")
 
-        retriever = dir_file_structured_retriever
+        summary_context = _dict.get("summary_context")
 
-        chain = self._setup_partial_chain(structured_retriever=retriever)
-
-        response = chain.invoke(
+        response = self.summary_chain.invoke(
             {
                 "question": question,
                 "kg": self.kg,
                 "top_k": top_k,
+                "query_analysis": query_analysis,
+                "fusion_weights": fusion_weights,
+                "retrieval_backend": retrieval_backend,
+                "summary_context": summary_context,
+                "project_id": _dict.get("project_id"),
             }
         )
         return response
     
+    @traced("BuildResponse.code_response")
     def _get_code_response(self, _dict):
         """
         Get the response by invoking the chain with the question and relevant context.
@@ -105,6 +235,11 @@ class BuildResponse:
                 question (str): The user's question.
                 top_k (int): The number of top results to consider. Default is 1.
                 next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+                query_analysis (QueryAnalysis, optional): A shared analysis of the question.
+                fusion_weights (dict, optional): Reciprocal rank fusion weights for the vector and lexical legs.
+                retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+                code_context (str, optional): Context already assembled for this question, skips the retriever.
+                project_id (str, optional): Only look in this project. None looks in every project.
 
         Returns:
             str: The generated answer from the LLM.
@@ -114,22 +249,67 @@ class BuildResponse:
         question = _dict.get("question") 
         top_k = _dict.get("top_k", 1) 
         next_chunk_limit = _dict.get("next_chunk_limit", 1) 
+        query_analysis = _dict.get("query_analysis")
+        fusion_weights = _dict.get("fusion_weights")
+        retrieval_backend = _dict.get("retrieval_backend", "neo4j")
 
-        retriever = code_structured_retriever
-
-        chain = self._setup_partial_chain(structured_retriever=retriever)
+        code_context = _dict.get("code_context")
 
-        response = chain.invoke(
+        response = self.code_chain.invoke(
             {
                 "question": question,
                 "kg": self.kg,
                 "top_k": top_k,
-                "next_chunk_limit" : next_chunk_limit
+                "next_chunk_limit" : next_chunk_limit,
+                "query_analysis": query_analysis,
+                "fusion_weights": fusion_weights,
+                "retrieval_backend": retrieval_backend,
+                "code_context": code_context,
+                "project_id": _dict.get("project_id"),
             }
         )
         return response
 
-    def get_full_response(self,  question, top_k: int = 1, next_chunk_limit: int = 1):
+    def _route(self, question, route, project_id=None):
+        """
+        Decide which context sections a question needs.
+
+        Args:
+            question (str): The user's question.
+            route (str): 'auto' to route with the local rules, or force 'summary', 'code' or 'both'.
+            project_id (str, optional): Only names of this project count as mentioned. None uses every project.
+
+        Returns:
+            RouteDecision: The decision.
+        """
+        if route == "auto":
+            return route_query(question, get_entity_matcher(self.kg, project_id).match(question))
+        if route not in ROUTES:
+            raise ValueError(f"Unknown route [{route}], use 'auto' or one of {ROUTES}.")
+        return RouteDecision(route, ["requested"], 0.0)
+
+    def _select_chain(self, mode, route):
+        """
+        Pick the chain that writes the answer. In 'combine' mode a question routed to one section
+        is answered straight from that section's chain, with nothing to combine.
+        """
+        if mode == "single_pass":
+            return self.single_pass_chain
+        return {"both": self.full_chain, "summary": self.summary_chain, "code": self.code_chain}[route]
+
+    @staticmethod
+    def _answer_input(question, context):
+        """
+        The input every answer chain takes, the contexts are already assembled so no retriever runs again.
+        """
+        return {
+            "question": question,
+            "summary_context": context.sections["summary"],
+            "code_context": context.sections["code"],
+        }
+
+    @traced("BuildResponse.get_full_response")
+    def get_full_response(self,  question, top_k: int = 1, next_chunk_limit: int = 1, fusion_weights: dict = None, retrieval_backend: str = "neo4j", context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, mode: str = "combine", route: str = "auto", project_id: str = None):
         """
         Get the response by invoking the chain with the question and relevant context.
 
@@ -137,48 +317,284 @@ class BuildResponse:
             question (str): The user's question.
             top_k (int): The number of top results to consider. Default is 1.
             next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+            fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+            retrieval_backend (str): Where vector searches run, 'neo4j' or 'local' (in process, memory mapped). Default is 'neo4j'.
+            context_token_budget (int): Most tokens of retrieved context shared by the summary and code answers.
+                Default is DEFAULT_CONTEXT_TOKEN_BUDGET, None means no limit.
+            mode (str): 'combine' answers from each context then merges the answers (three LLM calls),
+                'single_pass' answers from both contexts in one call. Default is 'combine'.
+            route (str): 'auto' runs only the retrievers the question needs (see route_query),
+                or force 'summary', 'code' or 'both'. Default is 'auto'.
+            project_id (str, optional): Only answer from this project's nodes. None searches every project.
 
         Returns:
             str: The generated answer from the LLM.
         """
+        _check_answer_mode(mode)
+
+        start = time.perf_counter()
+        decision = self._route(question, route, project_id)
+        index_names, fulltext_index_names = indexes_for_sections(decision.sections)
+
+        #Embed the question once, every retriever searches with the same vector
+        query_analysis = analyze_query(
+            self.kg,
+            question,
+            top_k=top_k,
+            index_names=index_names,
+            fulltext_index_names=fulltext_index_names,
+            retrieval_backend=retrieval_backend,
+            project_id=project_id
+        )
 
-        template = """Answer the question about a coding project by combining the two parital answers you are given.
-        The two responses focus on either summary knowledge, or code specific knowledge.
-        I would like for you to combine them to a single response that answers the question
-        in detail. If there is not sufficient info say so.
+        #Both retrievers share one budget, the best pieces win wherever they came from and nothing is sent twice
+        context = collect_structured_context(
+            self.kg,
+            question,
+            top_k=top_k,
+            next_chunk_limit=next_chunk_limit,
+            query_analysis=query_analysis,
+            fusion_weights=fusion_weights,
+            token_budget=context_token_budget,
+            sections=decision.sections
+        )
 
-        Question: {question}
+        full_response = self._select_chain(mode, decision.route).invoke(self._answer_input(question, context))
 
-        Summary response: {summary_response}
+        get_routing_log().record(question, decision, time.perf_counter() - start, mode=mode)
 
-        Code response: {code_response}
+        return full_response
 
-        Answer:"""
+    @traced("BuildResponse.retrieve", kind="retrieval")
+    async def _aretrieve(self, question, top_k, next_chunk_limit, fusion_weights, retrieval_backend, context_token_budget, route, project_id=None):
+        """
+        Route the question and assemble its context on the async path.
+        """
+        #Routing may refresh the entity matcher, which is sync
+        decision = await asyncio.to_thread(self._route, question, route, project_id)
+
+        context = await self.async_retriever.collect_structured_context(
+            question,
+            top_k=top_k,
+            next_chunk_limit=next_chunk_limit,
+            fusion_weights=fusion_weights,
+            retrieval_backend=retrieval_backend,
+            token_budget=context_token_budget,
+            sections=decision.sections,
+            project_id=project_id
+        )
+        return decision, context
 
+    async def _apartial_responses(self, question, context):
+        """
+        Await the summary and code answers together, used by 'combine' mode on the async path.
+        """
+        return await asyncio.gather(
+            self.summary_chain.ainvoke({"question": question, "summary_context": context.sections["summary"]}),
+            self.code_chain.ainvoke({"question": question, "code_context": context.sections["code"]})
+        )
 
-        prompt = ChatPromptTemplate.from_template(template)
+    @traced("BuildResponse.aget_full_response")
+    async def aget_full_response(self, question, top_k: int = 1, next_chunk_limit: int = 1, fusion_weights: dict = None, retrieval_backend: str = "neo4j", context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, mode: str = "combine", route: str = "auto", project_id: str = None):
+        """
+        Async version of get_full_response for async handlers.
 
+        Retrieval runs on the async Neo4j driver and OpenAI client (see AsyncRetriever), and the
+        summary and code answers are awaited together, so no thread is held while waiting on I/O.
 
+        Args:
+            question (str): The user's question.
+            top_k (int): The number of top results to consider. Default is 1.
+            next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+            fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+            retrieval_backend (str): Where vector searches run, 'neo4j' or 'local' (in process, memory mapped). Default is 'neo4j'.
+            context_token_budget (int): Most tokens of retrieved context shared by the summary and code answers.
+                Default is DEFAULT_CONTEXT_TOKEN_BUDGET, None means no limit.
+            mode (str): 'combine' or 'single_pass', see get_full_response. Default is 'combine'.
+            route (str): 'auto', 'summary', 'code' or 'both', see get_full_response. Default is 'auto'.
+            project_id (str, optional): Only answer from this project's nodes. None searches every project.
 
-        chain = (
-            RunnableParallel(
+        Returns:
+            str: The generated answer from the LLM.
+        """
+        _check_answer_mode(mode)
+
+        start = time.perf_counter()
+        decision, context = await self._aretrieve(
+            question, top_k, next_chunk_limit, fusion_weights, retrieval_backend, context_token_budget, route, project_id
+        )
+
+        if mode == "combine" and decision.route == "both":
+            summary_response, code_response = await self._apartial_responses(question, context)
+            full_response = await self.combine_chain.ainvoke(
                 {
-                    "summary_response": RunnablePassthrough() | self._get_summary_response,
-                    "code_response": RunnablePassthrough() | self._get_code_response,
-                    "question": RunnablePassthrough(),
+                    "question": question,
+                    "summary_response": summary_response,
+                    "code_response": code_response,
                 }
             )
-            | prompt
-            | self.llm
-            | StrOutputParser()
+        else:
+            full_response = await self._select_chain(mode, decision.route).ainvoke(self._answer_input(question, context))
+
+        get_routing_log().record(question, decision, time.perf_counter() - start, mode=mode)
+
+        return full_response
+
+    @traced("BuildResponse.stream_full_response")
+    def stream_full_response(self, question, top_k: int = 1, next_chunk_limit: int = 1, fusion_weights: dict = None, retrieval_backend: str = "neo4j", context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, mode: str = "combine", route: str = "auto", project_id: str = None):
+        """
+        Streaming version of get_full_response, the final answer is yielded token by token as the LLM writes it.
+
+        Args:
+            question (str): The user's question.
+            top_k (int): The number of top results to consider. Default is 1.
+            next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+            fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+            retrieval_backend (str): Where vector searches run, 'neo4j' or 'local' (in process, memory mapped). Default is 'neo4j'.
+            context_token_budget (int): Most tokens of retrieved context shared by the summary and code answers.
+            mode (str): 'combine' or 'single_pass', see get_full_response. Default is 'combine'.
+            route (str): 'auto', 'summary', 'code' or 'both', see get_full_response. Default is 'auto'.
+            project_id (str, optional): Only answer from this project's nodes. None searches every project.
+
+        Yields:
+            tuple: ('status', text) once retrieval is done, then ('token', text) pieces of the answer.
+        """
+        _check_answer_mode(mode)
+
+        start = time.perf_counter()
+        decision = self._route(question, route, project_id)
+        index_names, fulltext_index_names = indexes_for_sections(decision.sections)
+
+        query_analysis = analyze_query(
+            self.kg,
+            question,
+            top_k=top_k,
+            index_names=index_names,
+            fulltext_index_names=fulltext_index_names,
+            retrieval_backend=retrieval_backend,
+            project_id=project_id
         )
 
-        full_response = chain.invoke(
-            {
-                "question": question,
-                "top_k": top_k,
-                "next_chunk_limit" : next_chunk_limit
-            }
+        context = collect_structured_context(
+            self.kg,
+            question,
+            top_k=top_k,
+            next_chunk_limit=next_chunk_limit,
+            query_analysis=query_analysis,
+            fusion_weights=fusion_weights,
+            token_budget=context_token_budget,
+            sections=decision.sections
         )
 
-        return full_response
+        yield ("status", retrieval_status(context))
+
+        #In 'combine' mode the partial answers run in parallel first, only the final combining call streams
+        for token in self._select_chain(mode, decision.route).stream(self._answer_input(question, context)):
+            yield ("token", token)
+
+        get_routing_log().record(question, decision, time.perf_counter() - start, mode=mode)
+
+    @traced("BuildResponse.astream_full_response")
+    async def astream_full_response(self, question, top_k: int = 1, next_chunk_limit: int = 1, fusion_weights: dict = None, retrieval_backend: str = "neo4j", context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, mode: str = "combine", route: str = "auto", project_id: str = None):
+        """
+        Async version of stream_full_response, see aget_full_response.
+
+        Args:
+            question (str): The user's question.
+            top_k (int): The number of top results to consider. Default is 1.
+            next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+            fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+            retrieval_backend (str): Where vector searches run, 'neo4j' or 'local' (in process, memory mapped). Default is 'neo4j'.
+            context_token_budget (int): Most tokens of retrieved context shared by the summary and code answers.
+            mode (str): 'combine' or 'single_pass', see get_full_response. Default is 'combine'.
+            route (str): 'auto', 'summary', 'code' or 'both', see get_full_response. Default is 'auto'.
+            project_id (str, optional): Only answer from this project's nodes. None searches every project.
+
+        Yields:
+            tuple: ('status', text) once retrieval is done, then ('token', text) pieces of the answer.
+        """
+        _check_answer_mode(mode)
+
+        start = time.perf_counter()
+        decision, context = await self._aretrieve(
+            question, top_k, next_chunk_limit, fusion_weights, retrieval_backend, context_token_budget, route, project_id
+        )
+
+        yield ("status", retrieval_status(context))
+
+        if mode == "combine" and decision.route == "both":
+            summary_response, code_response = await self._apartial_responses(question, context)
+            tokens = self.combine_chain.astream(
+                {
+                    "question": question,
+                    "summary_response": summary_response,
+                    "code_response": code_response,
+                }
+            )
+        else:
+            tokens = self._select_chain(mode, decision.route).astream(self._answer_input(question, context))
+
+        async for token in tokens:
+            yield ("token", token)
+
+        get_routing_log().record(question, decision, time.perf_counter() - start, mode=mode)
+
+    def warm_up(self):
+        """
+        Pay the one time costs a first question would otherwise pay: the graph version read,
+        the vector stores, the entity matcher index, and the tokenizer.
+        """
+        start = time.perf_counter()
+
+        get_graph_version(self.kg)
+        get_vector_registry().get_vector_indexes(self.kg, list(VECTOR_INDEX_SPECS.keys()))
+        get_entity_matcher(self.kg)
+        count_tokens("warm up")
+
+        print(f"Responder warmed up in {time.perf_counter() - start:.2f}s")
+
+    def health_check(self):
+        """
+        Check the Neo4j connection still answers.
+
+        Returns:
+            bool: True if the graph answered a trivial query.
+        """
+        try:
+            self.kg.query("RETURN 1 AS ok")
+            return True
+        except Exception as e:
+            print(f"Responder health check failed: {e}")
+            return False
+
+_responders = {}
+_responders_lock = threading.Lock()
+
+def get_responder(model='gpt-4o-mini'):
+    """
+    Get the process wide BuildResponse for a model, building it on first use.
+
+    The responder is rebuilt if the OpenAI API key changes or a periodic health check fails,
+    so callers never pay connection setup per message.
+
+    Args:
+        model (str): The language model to use. Default is 'gpt-4o-mini'.
+
+    Returns:
+        BuildResponse: The shared responder.
+    """
+    api_key = OpenAiConfig.get_openai_api_key()
+
+    with _responders_lock:
+        entry = _responders.get(model)
+
+        rebuild = entry is None or entry["responder"].api_key != api_key
+        if not rebuild and time.monotonic() - entry["checked"] > HEALTH_CHECK_INTERVAL:
+            rebuild = not entry["responder"].health_check()
+            entry["checked"] = time.monotonic()
+
+        if rebuild:
+            entry = {"responder": BuildResponse(model=model), "checked": time.monotonic()}
+            _responders[model] = entry
+
+    return entry["responder"]
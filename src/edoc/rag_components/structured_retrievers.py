@@ -1,110 +1,198 @@
-from edoc.rag_components.unstructured_retrievers import create_vector_index, perform_similarity_search, extract_code_entities
+from edoc.rag_components.query_analysis import analyze_query, escape_lucene, QueryAnalysis
+from edoc.rag_components.context_assembler import ContextPiece, assemble_context, DEFAULT_CONTEXT_TOKEN_BUDGET
+from edoc.monitoring.tracing import traced
 from langchain_community.graphs import Neo4jGraph
 
-def _dir_file_structured_retriever(kg: Neo4jGraph, question: str, top_k: int) -> str:
+DIR_FILE_INDEXES = ["fileSummaryVectorIndex", "dirSummaryVectorIndex"]
+CHUNK_INDEXES = ["chunkSummaryVectorIndex", "chunkRawVectorIndex"]
+DIR_FILE_FULLTEXT_INDEXES = ["fileSummaryFulltextIndex"]
+CHUNK_FULLTEXT_INDEXES = ["chunkRawFulltextIndex", "chunkSummaryFulltextIndex"]
+
+#The (vector, fulltext) indexes each context section is retrieved from
+SECTION_INDEXES = {
+    "summary": (DIR_FILE_INDEXES, DIR_FILE_FULLTEXT_INDEXES),
+    "code": (CHUNK_INDEXES, CHUNK_FULLTEXT_INDEXES),
+}
+
+def indexes_for_sections(sections):
+    """
+    Get the vector and fulltext indexes needed to retrieve the given context sections.
+
+    Args:
+        sections (iterable): Section names, 'summary' and/or 'code'.
+
+    Returns:
+        tuple: (vector index names, fulltext index names)
+    """
+    index_names = []
+    fulltext_index_names = []
+    for section in sections:
+        index_names.extend(SECTION_INDEXES[section][0])
+        fulltext_index_names.extend(SECTION_INDEXES[section][1])
+    return index_names, fulltext_index_names
+
+#Score given to context for names the user typed, at least as good as the best similarity hit
+ENTITY_MATCH_SCORE = 1.0
+
+#One round trip for every name: each branch is an index seek on File/Directory name or path.
+#Ancestors come from the stored `ancestors` list, graphs built before it existed fall back to walking CONTAINS.
+#A null project_id looks names up in every project.
+DIR_FILE_LOOKUP_QUERY = """
+UNWIND range(0, size($names) - 1) AS idx
+WITH idx, $names[idx] AS name_or_path
+CALL {
+    WITH name_or_path
+    MATCH (n:File {name: name_or_path}) RETURN n
+    UNION
+    WITH name_or_path
+    MATCH (n:File {path: name_or_path}) RETURN n
+    UNION
+    WITH name_or_path
+    MATCH (n:Directory {name: name_or_path}) RETURN n
+    UNION
+    WITH name_or_path
+    MATCH (n:Directory {path: name_or_path}) RETURN n
+}
+WITH n, idx WHERE $project_id IS NULL OR n.project_id = $project_id
+WITH n, min(idx) AS first_idx
+RETURN CASE WHEN n:File THEN 'File' ELSE 'Directory' END AS node_type,
+       n.name AS name, n.path AS path, n.summary AS summary,
+       CASE WHEN n.ancestors IS NOT NULL THEN n.ancestors
+            ELSE [(parent_dir:Directory)-[:CONTAINS*]->(n) | parent_dir.name] END AS parent_dirs
+ORDER BY first_idx ASC, CASE WHEN n:File THEN 0 ELSE 1 END ASC
+"""
+
+def _collect_dir_file_pieces(kg: Neo4jGraph, question: str, top_k: int, query_analysis: QueryAnalysis = None, fusion_weights: dict = None, retrieval_backend: str = "neo4j", project_id: str = None) -> list:
     """
     Collects the neighborhood of entities mentioned in the question by:
     1. Performing a similarity search to find relevant files and directories.
-    2. Extracting named entities (files, directories, functions, classes, imports) from the question.
+    2. Matching names of files and directories in the graph that are mentioned in the question.
     3. Querying the knowledge graph for the entities and related information, including directory and file summaries.
     
     Args:
         kg (Neo4jGraph): The kg object to connect too
         question (str): The user question for which to retrieve structured information.
         top_k (int): The number of top results to retrieve from the similarity search.
+        query_analysis (QueryAnalysis, optional): A shared analysis of the question. If None the question is analyzed here.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+        retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+        project_id (str, optional): Only look in this project, used when the question is analyzed here.
+            Otherwise the analysis' project is used. None looks in every project.
     
     Returns:
-        str: A formatted string containing the results of the neighborhood search.
+        list: ContextPieces in the 'summary' section, one per file or directory.
     """
-    file_summary_index = create_vector_index(
-        vector_index_name="fileSummaryVectorIndex", 
-        node_label="File", 
-        embedding_property="summary_embedding", 
-        text_properties=["name"]
-    )
+    if query_analysis is None:
+        query_analysis = analyze_query(
+            kg,
+            question,
+            top_k=top_k,
+            index_names=DIR_FILE_INDEXES,
+            fulltext_index_names=DIR_FILE_FULLTEXT_INDEXES,
+            retrieval_backend=retrieval_backend,
+            project_id=project_id
+        )
+    
+    scores = _plan_dir_file_lookup(query_analysis, top_k, fusion_weights)
+
+    entities = list(scores.keys())
+
+    if entities:
+        result = kg.query(DIR_FILE_LOOKUP_QUERY, {"names": entities, "project_id": query_analysis.project_id})
+    else:
+        result = []
+
+    return _dir_file_pieces_from_records(result, scores)
 
-    dir_summary_index = create_vector_index(
-        vector_index_name="dirSummaryVectorIndex",  
-        node_label="Directory", 
-        embedding_property="summary_embedding", 
-        text_properties=["name"]
+def _plan_dir_file_lookup(query_analysis: QueryAnalysis, top_k: int, fusion_weights: dict = None) -> dict:
+    """
+    Decide which file and directory names to look up for a question.
+
+    Args:
+        query_analysis (QueryAnalysis): The analysis of the question.
+        top_k (int): The number of top results to retrieve from the similarity search.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+
+    Returns:
+        dict: Name or path -> retrieval score, in lookup order.
+    """
+    # Vector and lexical hits merged by rank, capped at what the vector search alone returned before
+    similarity_hits = query_analysis.fused_scored_keys(
+        DIR_FILE_INDEXES + DIR_FILE_FULLTEXT_INDEXES,
+        limit=top_k * len(DIR_FILE_INDEXES),
+        fusion_weights=fusion_weights
     )
 
-    vector_indexes = [file_summary_index, dir_summary_index]
-    
-    similarity_results = perform_similarity_search(vector_indexes, question, top_k=top_k)
-    files_from_similarity_search = [item.replace('\nname: ', '') for item in similarity_results]
-    
-    entities = extract_code_entities(question)
-    entities.extend(files_from_similarity_search)
-    entities = list(set(entities))
+    #Each name keeps its best score, names typed by the user score highest
+    scores = {name: ENTITY_MATCH_SCORE for name in query_analysis.entity_names(labels=["Directory", "File"])}
+    for name, score in similarity_hits:
+        scores[name] = max(scores.get(name, 0.0), score)
 
-    final_summaries = []
-    
-    search_attributes = ['name', 'path']
+    return scores
 
-    for name_or_path in entities:
-        
-        file_query_template = """
-        OPTIONAL MATCH (file:File {{{attribute}: $name_or_path}})
-        WITH file
-        OPTIONAL MATCH (parent_dir:Directory)-[:CONTAINS*]->(file)
-        RETURN file.path AS file_path, file.name AS file_name, file.summary AS file_summary,
-               collect(parent_dir.name) AS parent_dirs
-        """
+def _dir_file_pieces_from_records(records, scores) -> list:
+    """
+    Render DIR_FILE_LOOKUP_QUERY records as summary ContextPieces.
 
-        dir_query_template = """
-        OPTIONAL MATCH (dir:Directory {{{attribute}: $name_or_path}})
-        WITH dir
-        OPTIONAL MATCH (parent_dir:Directory)-[:CONTAINS*]->(dir)
-        RETURN dir.path AS dir_path, dir.name AS dir_name, dir.summary AS dir_summary,
-               collect(parent_dir.name) AS parent_dirs
-        """
-        
-        params = {"name_or_path": name_or_path}
-        
-        # Iterate over the search attributes (name, path) to dynamically search for files
-        for attr in search_attributes:
-            file_query = file_query_template.format(attribute=attr)
-            file_result = kg.query(file_query, params)
-            
-            # If a file is found, process the result and store context
-            if file_result:
-                for record in file_result:
-                    file_path = record.get("file_path")
-                    file_name = record.get("file_name")
-                    file_summary = record.get("file_summary", "No summary available")
-                    parent_dirs = record.get("parent_dirs", [])
-                    
-                    if file_name is not None:
-                        summary_context = (f"File: {file_name} ({file_path})\n"
-                                        f"File Summary: {file_summary}\n"
-                                        f"Parent Directories: {', '.join(parent_dirs)}")
-                        final_summaries.append(summary_context)
-        
-        # Iterate over the search attributes (name, path) to dynamically search for directories
-        for attr in search_attributes:
-            dir_query = dir_query_template.format(attribute=attr)
-            dir_result = kg.query(dir_query, params)
-            
-            # If a directory is found, process the result and store context
-            if dir_result:
-                for record in dir_result:
-                    dir_path = record.get("dir_path")
-                    dir_name = record.get("dir_name")
-                    dir_summary = record.get("dir_summary", "No summary available")
-                    parent_dirs = record.get("parent_dirs", [])
-                    
-                    if dir_name is not None:
-                        summary_context = (f"Directory: {dir_name} ({dir_path})\n"
-                                        f"Directory Summary: {dir_summary}\n"
-                                        f"Parent Directories: {', '.join(parent_dirs)}")
-                        final_summaries.append(summary_context)
+    Args:
+        records (list): Records returned by DIR_FILE_LOOKUP_QUERY.
+        scores (dict): Name or path -> retrieval score, from _plan_dir_file_lookup.
+
+    Returns:
+        list: ContextPieces in the 'summary' section.
+    """
+    pieces = []
+    for record in records:
+        node_type = record.get("node_type")
+        node_path = record.get("path")
+        node_name = record.get("name")
+        node_summary = record.get("summary", "No summary available")
+        parent_dirs = record.get("parent_dirs") or []
+
+        summary_context = (f"{node_type}: {node_name} ({node_path})\n"
+                        f"{node_type} Summary: {node_summary}\n"
+                        f"Parent Directories: {', '.join(parent_dirs)}")
+
+        pieces.append(ContextPiece(
+            section="summary",
+            text=summary_context,
+            score=max(scores.get(node_name, 0.0), scores.get(node_path, 0.0)),
+            keys=[(node_type, node_path)],
+            description=f"{node_type} {node_path}"
+        ))
+    
+    return pieces
+
+@traced("dir_file_structured_retriever", kind="retrieval")
+def _dir_file_structured_retriever(kg: Neo4jGraph, question: str, top_k: int, query_analysis: QueryAnalysis = None, fusion_weights: dict = None, retrieval_backend: str = "neo4j", token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, project_id: str = None) -> str:
+    """
+    Get the file and directory summary context for a question, packed into a token budget.
+    See _collect_dir_file_pieces for how the context is found.
+    
+    Args:
+        kg (Neo4jGraph): The kg object to connect too
+        question (str): The user question for which to retrieve structured information.
+        top_k (int): The number of top results to retrieve from the similarity search.
+        query_analysis (QueryAnalysis, optional): A shared analysis of the question. If None the question is analyzed here.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+        retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+        token_budget (int): Most tokens of context to return. None means no limit.
+        project_id (str, optional): Only look in this project. None looks in every project.
     
-    sep = "\n"+75*"="+"\n"
-    dir_file_context = sep.join(final_summaries)
+    Returns:
+        str: A formatted string containing the results of the neighborhood search.
+    """
+    pieces = _collect_dir_file_pieces(
+        kg,
+        question,
+        top_k=top_k,
+        query_analysis=query_analysis,
+        fusion_weights=fusion_weights,
+        retrieval_backend=retrieval_backend,
+        project_id=project_id
+    )
     
-    return dir_file_context
+    return assemble_context(pieces, token_budget=token_budget).sections["summary"]
 
 #Langchain used functions expect a single dict param, wrap the input to pass to our function
 def dir_file_structured_retriever(_dict):
@@ -116,6 +204,11 @@ def dir_file_structured_retriever(_dict):
                 kg (Neo4jGraph): The kg object to connect too.
                 question (str): The user's question.
                 top_k (int): The number of top results to consider. Default is 1.
+                query_analysis (QueryAnalysis, optional): A shared analysis of the question.
+                fusion_weights (dict, optional): Reciprocal rank fusion weights by leg or index name.
+                retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+                token_budget (int): Most tokens of context to return. Default is DEFAULT_CONTEXT_TOKEN_BUDGET.
+                project_id (str, optional): Only look in this project. None looks in every project.
 
         Returns:
             str: The generated context.
@@ -123,7 +216,16 @@ def dir_file_structured_retriever(_dict):
     if "top_k" not in _dict.keys():
         _dict["top_k"] = 1
     
-    return _dir_file_structured_retriever(kg=_dict["kg"], question=_dict["question"], top_k=_dict["top_k"])
+    return _dir_file_structured_retriever(
+        kg=_dict["kg"],
+        question=_dict["question"],
+        top_k=_dict["top_k"],
+        query_analysis=_dict.get("query_analysis"),
+        fusion_weights=_dict.get("fusion_weights"),
+        retrieval_backend=_dict.get("retrieval_backend", "neo4j"),
+        token_budget=_dict.get("token_budget", DEFAULT_CONTEXT_TOKEN_BUDGET),
+        project_id=_dict.get("project_id")
+    )
 
 def _get_code_entity_node_attributes(node, node_type):
     """
@@ -167,11 +269,96 @@ def _build_entity_context(result):
     
     return entity_context
 
-def _code_structured_retriever(kg: Neo4jGraph, question: str, top_k: int, next_chunk_limit: int) -> str:
+#Expand every hit to its neighbours by (file, ordinal +/- window), a range seek on the
+#Chunk(file_path, ordinal) index instead of a NEXT* traversal per hit. Neighbours come from
+#the hit's own project, the same path can be in several projects.
+CHUNK_NEIGHBORHOOD_QUERY = """
+UNWIND $chunk_ids AS chunk_id
+MATCH (hit:Chunk {id: chunk_id})
+WHERE $project_id IS NULL OR hit.project_id = $project_id
+WITH DISTINCT hit.project_id AS project_id, hit.file_path AS file_path, hit.ordinal AS ordinal
+MATCH (chunk:Chunk)
+WHERE chunk.file_path = file_path
+  AND chunk.ordinal >= ordinal - $window AND chunk.ordinal <= ordinal + $window
+  AND (chunk.project_id = project_id OR (project_id IS NULL AND chunk.project_id IS NULL))
+RETURN DISTINCT chunk.file_path AS file_path, chunk.ordinal AS ordinal,
+       chunk.id AS id, chunk.raw_code AS raw_code
+ORDER BY file_path ASC, ordinal ASC
+"""
+
+def _merge_chunk_windows(records, hit_ids):
+    """
+    Merge chunk records into contiguous spans per file.
+
+    Args:
+        records (list): Chunk records with file_path, ordinal, id and raw_code, sorted by file and ordinal.
+        hit_ids (list): The similarity hit chunk ids, best first.
+
+    Returns:
+        list: A list of spans (lists of records), ordered by the best hit each span contains.
+    """
+    spans = []
+    for record in records:
+        previous = spans[-1][-1] if spans else None
+        if (
+            previous is not None
+            and previous.get("file_path") == record.get("file_path")
+            and record.get("ordinal") == previous.get("ordinal") + 1
+        ):
+            spans[-1].append(record)
+        else:
+            spans.append([record])
+
+    hit_rank = {chunk_id: rank for rank, chunk_id in enumerate(hit_ids)}
+
+    def best_rank(span):
+        return min(hit_rank.get(record.get("id"), len(hit_rank)) for record in span)
+
+    return sorted(spans, key=best_rank)
+
+def _build_code_entity_lucene_query(entity):
+    """
+    Build a fulltext query for an entity name that matches it exactly, by prefix, or within one edit.
+
+    Args:
+        entity (str): The entity name.
+
+    Returns:
+        str: The Lucene query string.
+    """
+    escaped = escape_lucene(entity)
+    if any(char.isspace() for char in entity):
+        return f'"{escaped}"'
+
+    return f'"{escaped}"^4 OR {escaped}*^2 OR {escaped}~1'
+
+#Ranked lookup of code entities through the codeEntityNameIndex fulltext index. Exact name
+#matches rank above case-insensitive ones, which rank above prefix/fuzzy hits by score.
+#Each entity is capped so common names like `main` cannot flood the context.
+CODE_ENTITY_LOOKUP_QUERY = """
+UNWIND $lookups AS lookup
+CALL {
+    WITH lookup
+    CALL db.index.fulltext.queryNodes('codeEntityNameIndex', lookup.lucene_query) YIELD node, score
+    WHERE $project_id IS NULL OR node.project_id = $project_id
+    WITH node, score,
+         CASE WHEN node.name = lookup.entity THEN 2
+              WHEN toLower(node.name) = toLower(lookup.entity) THEN 1
+              ELSE 0 END AS exactness
+    ORDER BY exactness DESC, score DESC
+    LIMIT $entity_limit
+    RETURN node, score, exactness
+}
+OPTIONAL MATCH (file:File)-[r]->(node)
+RETURN lookup.entity AS entity, node AS n, file, labels(node) AS label, score, exactness
+ORDER BY lookup.idx ASC, exactness DESC, score DESC
+"""
+
+def _collect_code_pieces(kg: Neo4jGraph, question: str, top_k: int, next_chunk_limit: int, query_analysis: QueryAnalysis = None, entity_limit: int = 5, fusion_weights: dict = None, retrieval_backend: str = "neo4j", project_id: str = None) -> list:
     """
     Collects the neighborhood of entities mentioned in the question by:
     1. Performing a similarity search to find relevant chunks.
-    2. Extracting named entities (functions, classes, imports) from the question.
+    2. Matching names of functions, classes, and imports in the graph that are mentioned in the question.
     3. Querying the knowledge graph for the entities and related information, including directory and file summaries.
     
     Args:
@@ -179,77 +366,179 @@ def _code_structured_retriever(kg: Neo4jGraph, question: str, top_k: int, next_c
         question (str): The user question for which to retrieve structured information.
         top_k (int): The number of top results to retrieve from the similarity search.
         next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+        query_analysis (QueryAnalysis, optional): A shared analysis of the question. If None the question is analyzed here.
+        entity_limit (int): The most nodes returned for any one entity name. Default is 5.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+        retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+        project_id (str, optional): Only look in this project, used when the question is analyzed here.
+            Otherwise the analysis' project is used. None looks in every project.
     
     Returns:
-        str: A formatted string containing the results of the neighborhood search.
+        list: ContextPieces in the 'code' section, one per chunk span and one per entity.
     """
+    if query_analysis is None:
+        query_analysis = analyze_query(
+            kg,
+            question,
+            top_k=top_k,
+            index_names=CHUNK_INDEXES,
+            fulltext_index_names=CHUNK_FULLTEXT_INDEXES,
+            retrieval_backend=retrieval_backend,
+            project_id=project_id
+        )
+    
+    hit_scores, entities = _plan_code_lookup(query_analysis, top_k, fusion_weights)
+    chunks_from_similarity_search = list(hit_scores.keys())
+    
+    # 3. Look up chunk neighborhoods (N chunks before and after), all hits in one query
+    if chunks_from_similarity_search:
+        neighborhood_records = kg.query(
+            CHUNK_NEIGHBORHOOD_QUERY,
+            {"chunk_ids": chunks_from_similarity_search, "window": next_chunk_limit, "project_id": query_analysis.project_id}
+        )
+    else:
+        neighborhood_records = []
 
-    chunk_summary_index = create_vector_index(
-        vector_index_name="chunkSummaryVectorIndex", 
-        node_label="Chunk", 
-        embedding_property="summary_embedding", 
-        text_properties=["id"]
-    )
+    # 4. Look up imports, functions, and classes, capturing relationships, all entities in one query
+    if entities:
+        entity_records = kg.query(CODE_ENTITY_LOOKUP_QUERY, _code_entity_lookup_params(entities, entity_limit, query_analysis.project_id))
+    else:
+        entity_records = []
 
-    chunk_raw_index = create_vector_index(
-        vector_index_name="chunkRawVectorIndex", 
-        node_label="Chunk", 
-        embedding_property="chunk_embedding", 
-        text_properties=["id"]
-    )
+    return _code_pieces_from_records(neighborhood_records, entity_records, hit_scores, entities)
 
-    vector_indexes = [chunk_summary_index, chunk_raw_index]
-    
-    similarity_results = perform_similarity_search(vector_indexes, question, top_k=top_k)
-    chunks_from_similarity_search = [item.replace('\nid: ', '') for item in similarity_results]
-    
-    entities = extract_code_entities(question)
-    entities = list(set(entities))
+def _plan_code_lookup(query_analysis: QueryAnalysis, top_k: int, fusion_weights: dict = None):
+    """
+    Decide which chunks and code entities to look up for a question.
+
+    Args:
+        query_analysis (QueryAnalysis): The analysis of the question.
+        top_k (int): The number of top results to retrieve from the similarity search.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
 
-    final_summaries = []
+    Returns:
+        tuple: (chunk id -> retrieval score best first, list of entity names)
+    """
+    # Vector and lexical hits merged by rank, capped at what the vector search alone returned before
+    similarity_hits = query_analysis.fused_scored_keys(
+        CHUNK_INDEXES + CHUNK_FULLTEXT_INDEXES,
+        limit=top_k * len(CHUNK_INDEXES),
+        fusion_weights=fusion_weights
+    )
     
-    # 3. Look up chunk neighborhoods (N chunks before and after)
-    for chunk_id in chunks_from_similarity_search:
-        query = f"""
-        MATCH (c:Chunk {{id: $chunk_id}})
-        OPTIONAL MATCH (prev_chunks)-[:NEXT*..{next_chunk_limit}]->(c)
-        OPTIONAL MATCH (c)-[:NEXT*..{next_chunk_limit}]->(next_chunks)
-        WITH collect(prev_chunks.id) + collect(c.id) + collect(next_chunks.id) AS all_chunk_ids
-        UNWIND all_chunk_ids AS unique_chunk_id
-        MATCH (chunk:Chunk {{id: unique_chunk_id}})
-        RETURN DISTINCT chunk.id, chunk.raw_code
-        ORDER BY chunk.id ASC
-        """
-        result = kg.query(query, {"chunk_id": chunk_id})  # You can adjust N to include more/less chunks
+    entities = query_analysis.entity_names(labels=["Function", "Class", "Import"])
+
+    return dict(similarity_hits), entities
+
+def _code_entity_lookup_params(entities, entity_limit, project_id=None):
+    """
+    Build the parameters for CODE_ENTITY_LOOKUP_QUERY.
+    """
+    return {
+        "lookups": [
+            {"idx": idx, "entity": entity, "lucene_query": _build_code_entity_lucene_query(entity)}
+            for idx, entity in enumerate(entities)
+        ],
+        "entity_limit": entity_limit,
+        "project_id": project_id,
+    }
+
+def _code_pieces_from_records(neighborhood_records, entity_records, hit_scores, entities) -> list:
+    """
+    Render CHUNK_NEIGHBORHOOD_QUERY and CODE_ENTITY_LOOKUP_QUERY records as code ContextPieces.
+
+    Args:
+        neighborhood_records (list): Records returned by CHUNK_NEIGHBORHOOD_QUERY.
+        entity_records (list): Records returned by CODE_ENTITY_LOOKUP_QUERY.
+        hit_scores (dict): Chunk id -> retrieval score best first, from _plan_code_lookup.
+        entities (list): The entity names that were looked up.
+
+    Returns:
+        list: ContextPieces in the 'code' section.
+    """
+    pieces = []
 
-        # Combine chunk neighborhood into the context
-        chunk_context = ""
-        for record in result:
-            chunk_id = record.get("chunk.id")
-            raw_code = record.get("chunk.raw_code", "")
+    # Overlapping windows are merged so each chunk is only rendered once
+    for span in _merge_chunk_windows(neighborhood_records, list(hit_scores.keys())):
+        span_label = f"{span[0].get('file_path')} (chunks {span[0].get('ordinal')}-{span[-1].get('ordinal')})"
+        chunk_context = f"File: {span_label}\n"
+        for record in span:
+            chunk_id = record.get("id")
+            raw_code = record.get("raw_code", "")
             chunk_context += f"Chunk ID: {chunk_id}\nCode:\n{raw_code}\n\n"
 
-        final_summaries.append(chunk_context)
+        pieces.append(ContextPiece(
+            section="code",
+            text=chunk_context,
+            score=max(hit_scores.get(record.get("id"), 0.0) for record in span),
+            keys=[("Chunk", record.get("id")) for record in span],
+            description=f"Chunks {span_label}"
+        ))
+
+    records_by_entity = {}
+    for record in entity_records:
+        records_by_entity.setdefault(record.get("entity"), []).append(record)
 
-    # 4. Look up imports, functions, and classes, capturing relationships
     for entity in entities:
-        query = """
-        OPTIONAL MATCH (n)
-        WHERE (n:Import OR n:Function OR n:Class) AND n.name = $entity
-        OPTIONAL MATCH (file:File)-[r]->(n)
-        RETURN n, file, labels(n) AS label
-        """
-        result = kg.query(query, {"entity": entity})
+        entity_records = records_by_entity.get(entity, [])
+        if not entity_records:
+            continue
 
         # Build the context for this entity
-        entity_context = _build_entity_context(result)
+        entity_context = _build_entity_context(entity_records)
+
+        #Exact name matches keep the full entity score, prefix/fuzzy matches a little less
+        exact = any(record.get("exactness") == 2 for record in entity_records)
         
-        final_summaries.append(entity_context)
+        pieces.append(ContextPiece(
+            section="code",
+            text=entity_context,
+            score=ENTITY_MATCH_SCORE if exact else 0.9 * ENTITY_MATCH_SCORE,
+            keys=[
+                (_get_code_entity_node_attributes(record.get("n") or {}, record.get("label") or []).get("node_type"),
+                 (record.get("n") or {}).get("name"),
+                 (record.get("file") or {}).get("path"))
+                for record in entity_records
+            ],
+            description=f"Entity {entity}"
+        ))
+    
+    return pieces
+
+@traced("code_structured_retriever", kind="retrieval")
+def _code_structured_retriever(kg: Neo4jGraph, question: str, top_k: int, next_chunk_limit: int, query_analysis: QueryAnalysis = None, entity_limit: int = 5, fusion_weights: dict = None, retrieval_backend: str = "neo4j", token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, project_id: str = None) -> str:
+    """
+    Get the code context for a question, packed into a token budget.
+    See _collect_code_pieces for how the context is found.
     
-    sep = "\n"+75*"="+"\n"
-    code_context = sep.join(final_summaries)
+    Args:
+        kg (Neo4jGraph): The kg object to connect too
+        question (str): The user question for which to retrieve structured information.
+        top_k (int): The number of top results to retrieve from the similarity search.
+        next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain
+        query_analysis (QueryAnalysis, optional): A shared analysis of the question. If None the question is analyzed here.
+        entity_limit (int): The most nodes returned for any one entity name. Default is 5.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+        retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+        token_budget (int): Most tokens of context to return. None means no limit.
+        project_id (str, optional): Only look in this project. None looks in every project.
     
-    return code_context
+    Returns:
+        str: A formatted string containing the results of the neighborhood search.
+    """
+    pieces = _collect_code_pieces(
+        kg,
+        question,
+        top_k=top_k,
+        next_chunk_limit=next_chunk_limit,
+        query_analysis=query_analysis,
+        entity_limit=entity_limit,
+        fusion_weights=fusion_weights,
+        retrieval_backend=retrieval_backend,
+        project_id=project_id
+    )
+
+    return assemble_context(pieces, token_budget=token_budget).sections["code"]
 
 #Langchain used functions expect a single dict param, wrap the input to pass to our function
 def code_structured_retriever(_dict):
@@ -262,6 +551,12 @@ def code_structured_retriever(_dict):
                 question (str): The user's question.
                 top_k (int): The number of top results to consider. Default is 1.
                 next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain.
+                query_analysis (QueryAnalysis, optional): A shared analysis of the question.
+                entity_limit (int): The most nodes returned for any one entity name. Default is 5.
+                fusion_weights (dict, optional): Reciprocal rank fusion weights by leg or index name.
+                retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+                token_budget (int): Most tokens of context to return. Default is DEFAULT_CONTEXT_TOKEN_BUDGET.
+                project_id (str, optional): Only look in this project. None looks in every project.
 
         Returns:
             str: The generated context.
@@ -273,4 +568,74 @@ def code_structured_retriever(_dict):
     if "next_chunk_limit" not in _dict.keys():
         _dict["next_chunk_limit"] = 1
     
-    return _code_structured_retriever(kg=_dict["kg"], question=_dict["question"], top_k=_dict["top_k"], next_chunk_limit=_dict["next_chunk_limit"])
\ No newline at end of file
+    return _code_structured_retriever(
+        kg=_dict["kg"],
+        question=_dict["question"],
+        top_k=_dict["top_k"],
+        next_chunk_limit=_dict["next_chunk_limit"],
+        query_analysis=_dict.get("query_analysis"),
+        entity_limit=_dict.get("entity_limit", 5),
+        fusion_weights=_dict.get("fusion_weights"),
+        retrieval_backend=_dict.get("retrieval_backend", "neo4j"),
+        token_budget=_dict.get("token_budget", DEFAULT_CONTEXT_TOKEN_BUDGET),
+        project_id=_dict.get("project_id")
+    )
+
+@traced("collect_structured_context", kind="retrieval")
+def collect_structured_context(kg: Neo4jGraph, question: str, top_k: int = 1, next_chunk_limit: int = 1, query_analysis: QueryAnalysis = None, entity_limit: int = 5, fusion_weights: dict = None, retrieval_backend: str = "neo4j", token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, sections=("summary", "code"), project_id: str = None):
+    """
+    Run both retrievers against one analysis of the question and pack their results into one shared budget.
+
+    Packing both together means the best pieces win regardless of which retriever found them, and
+    anything both retrievers found is only sent once.
+
+    Args:
+        kg (Neo4jGraph): The kg object to connect too
+        question (str): The user's question.
+        top_k (int): The number of top results to retrieve from the similarity search. Default is 1.
+        next_chunk_limit (int): The number of chunks to the left/right to search in the NEXT chain. Default is 1.
+        query_analysis (QueryAnalysis, optional): A shared analysis of the question. If None the question is analyzed here.
+        entity_limit (int): The most nodes returned for any one entity name. Default is 5.
+        fusion_weights (dict, optional): Reciprocal rank fusion weights by leg ('vector', 'lexical') or index name.
+        retrieval_backend (str): Where vector searches run, 'neo4j' or 'local'. Default is 'neo4j'.
+        token_budget (int): Most tokens of context across both sections. None means no limit.
+        sections (tuple): Which sections to retrieve, 'summary' and/or 'code'. Skipped sections come back empty.
+        project_id (str, optional): Only look in this project, used when the question is analyzed here.
+            Otherwise the analysis' project is used. None looks in every project.
+
+    Returns:
+        AssembledContext: The 'summary' and 'code' sections plus what was kept and dropped.
+    """
+    if query_analysis is None:
+        index_names, fulltext_index_names = indexes_for_sections(sections)
+        query_analysis = analyze_query(
+            kg,
+            question,
+            top_k=top_k,
+            index_names=index_names,
+            fulltext_index_names=fulltext_index_names,
+            retrieval_backend=retrieval_backend,
+            project_id=project_id
+        )
+
+    pieces = []
+    if "summary" in sections:
+        pieces.extend(_collect_dir_file_pieces(
+            kg,
+            question,
+            top_k=top_k,
+            query_analysis=query_analysis,
+            fusion_weights=fusion_weights
+        ))
+    if "code" in sections:
+        pieces.extend(_collect_code_pieces(
+            kg,
+            question,
+            top_k=top_k,
+            next_chunk_limit=next_chunk_limit,
+            query_analysis=query_analysis,
+            entity_limit=entity_limit,
+            fusion_weights=fusion_weights
+        ))
+
+    return assemble_context(pieces, token_budget=token_budget)
@@ -4,22 +4,18 @@ from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from typing import List
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
 from langchain_community.vectorstores import Neo4jVector
-from langchain_openai import OpenAIEmbeddings
 from edoc.gpt_helpers.connect import connect_to_neo4j
+from edoc.gpt_helpers.gpt_basics import get_chat_model, get_embedding_model
+from edoc.gpt_helpers.stand_ins import uses_stand_in_models, stand_in_code_entities
 
 load_dotenv()
 NEO4J_USERNAME = os.getenv('NEO4J_USERNAME')
 NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD')
 URL = os.getenv("NEO4J_URL", "bolt://localhost:7687")
 
-from edoc.gpt_helpers.connect import OpenAiConfig
-
-OPENAI_API_KEY = OpenAiConfig.get_openai_api_key()
-
 class ProgrammingNamedEntities(BaseModel):
     """Identifying information about code entities."""
     
@@ -43,10 +39,13 @@ def extract_code_entities(string_with_entities, model='gpt-4o-mini'):
         entities: An instance of ProgrammingNamedEntities containing the extracted directories, files, imports, functions, and classes.
     """
 
-    llm=ChatOpenAI(
-        model_name=model,
-        api_key=OPENAI_API_KEY
-    )
+    if uses_stand_in_models():
+        #The stand in chat model has no structured output, the names are picked out locally
+        code_entities = stand_in_code_entities(string_with_entities)
+        return ([item["module"] for item in code_entities["imports"]]
+                + [item["name"] for item in code_entities["functions"] + code_entities["classes"]])
+
+    llm = get_chat_model(model=model)
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -68,7 +67,7 @@ def extract_code_entities(string_with_entities, model='gpt-4o-mini'):
 
     return entities
 
-def create_vector_index(vector_index_name, node_label, embedding_property, text_properties, model="text-embedding-3-small", search_type="vector"):
+def create_vector_index(vector_index_name, node_label, embedding_property, text_properties, model="text-embedding-3-small", search_type="vector", embeddings=None):
     """
     Create a vector index for a given node label and embedding type.
     Quirk is text proprties are returned by string only
@@ -80,12 +79,16 @@ def create_vector_index(vector_index_name, node_label, embedding_property, text_
         text_properties (list): List of text properties to include in the index (e.g., ['id', 'summary', 'raw_code']).
         model (str): The OpenAI model to use. Default is 'text-embedding-3-small'.
         search_type (str): The type of search ('hybrid', 'vector', etc.). Default is 'vector'.
+        embeddings (Embeddings, optional): A shared embedding client. If None a new one is created from `model`.
 
     Returns:
         Neo4jVector: The vector index object.
     """
+    if embeddings is None:
+        embeddings = get_embedding_model(model)
+
     return Neo4jVector.from_existing_graph(
-        OpenAIEmbeddings(model=model, api_key=OPENAI_API_KEY),
+        embeddings,
         url=URL,
         username=NEO4J_USERNAME,
         password=NEO4J_PASSWORD,
@@ -0,0 +1,152 @@
+import threading
+
+from langchain_community.graphs import Neo4jGraph
+
+from edoc.gpt_helpers.connect import OpenAiConfig
+from edoc.gpt_helpers.gpt_basics import get_embedding_model
+from edoc.gpt_helpers.stand_ins import uses_stand_in_graph, StandInVectorStore
+from edoc.gpt_helpers.graph_version import get_graph_version, get_database_key
+from edoc.rag_components.unstructured_retrievers import create_vector_index
+
+#Every vector index the retrievers search, matches GraphBuilder.create_all_vector_indexes
+VECTOR_INDEX_SPECS = {
+    "fileSummaryVectorIndex": {
+        "node_label": "File",
+        "embedding_property": "summary_embedding",
+        "text_properties": ["name"],
+    },
+    "dirSummaryVectorIndex": {
+        "node_label": "Directory",
+        "embedding_property": "summary_embedding",
+        "text_properties": ["name"],
+    },
+    "chunkSummaryVectorIndex": {
+        "node_label": "Chunk",
+        "embedding_property": "summary_embedding",
+        "text_properties": ["id"],
+    },
+    "chunkRawVectorIndex": {
+        "node_label": "Chunk",
+        "embedding_property": "chunk_embedding",
+        "text_properties": ["id"],
+    },
+}
+
+class VectorIndexRegistry:
+    def __init__(self, model="text-embedding-3-small"):
+        """
+        Keep Neo4jVector stores alive for the life of the process.
+
+        Building a Neo4jVector opens a driver, checks the index, and may scan for nodes
+        missing embeddings, so we build each store once per database and only rebuild when
+        the graph version changes. All stores share one embedding client.
+
+        Args:
+            model (str): The OpenAI embedding model to use. Default is 'text-embedding-3-small'.
+        """
+        self.model = model
+
+        self._lock = threading.Lock()
+        self._embeddings = None
+        self._embeddings_api_key = None
+        self._stores = {}
+        self._graph_versions = {}
+
+    @property
+    def embeddings(self):
+        """
+        The shared embedding client, rebuilt only if the OpenAI API key has changed.
+        """
+        api_key = OpenAiConfig.get_openai_api_key()
+
+        if self._embeddings is None or api_key != self._embeddings_api_key:
+            self._embeddings = get_embedding_model(self.model)
+            self._embeddings_api_key = api_key
+            #Stores hold on to the old client, drop them so they pick up the new one
+            self._close_stores(list(self._stores.keys()))
+
+        return self._embeddings
+
+    def _close_stores(self, store_keys):
+        """
+        Close and forget the given stores.
+        """
+        for store_key in store_keys:
+            store = self._stores.pop(store_key, None)
+            driver = getattr(store, "_driver", None)
+            if driver is not None:
+                try:
+                    driver.close()
+                except Exception as e:
+                    print(f"An error occurred while closing vector store [{store_key[1]}]: {e}")
+
+    def get_vector_indexes(self, kg: Neo4jGraph, index_names):
+        """
+        Get the vector stores for the given index names, building any that are missing.
+
+        The graph version is checked once per call. If it differs from the version the
+        stores were built against, every store for that database is rebuilt.
+
+        Args:
+            kg (Neo4jGraph): The kg object to connect too.
+            index_names (list): Names of indexes from VECTOR_INDEX_SPECS.
+
+        Returns:
+            list: Neo4jVector objects in the same order as index_names.
+        """
+        database_key = get_database_key(kg)
+        graph_version = get_graph_version(kg)
+
+        with self._lock:
+            if self._graph_versions.get(database_key, graph_version) != graph_version:
+                stale = [key for key in self._stores if key[0] == database_key]
+                self._close_stores(stale)
+            self._graph_versions[database_key] = graph_version
+
+            embeddings = self.embeddings
+
+            vector_indexes = []
+            for index_name in index_names:
+                store_key = (database_key, index_name)
+
+                if store_key not in self._stores and uses_stand_in_graph():
+                    self._stores[store_key] = StandInVectorStore()
+
+                if store_key not in self._stores:
+                    spec = VECTOR_INDEX_SPECS[index_name]
+                    self._stores[store_key] = create_vector_index(
+                        vector_index_name=index_name,
+                        node_label=spec["node_label"],
+                        embedding_property=spec["embedding_property"],
+                        text_properties=spec["text_properties"],
+                        model=self.model,
+                        embeddings=embeddings
+                    )
+
+                vector_indexes.append(self._stores[store_key])
+
+        return vector_indexes
+
+    def clear(self):
+        """
+        Drop every cached store, they will be rebuilt on next use.
+        """
+        with self._lock:
+            self._close_stores(list(self._stores.keys()))
+            self._graph_versions = {}
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_vector_registry():
+    """
+    Get the process wide VectorIndexRegistry, creating it on first use.
+
+    Returns:
+        VectorIndexRegistry: The shared registry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = VectorIndexRegistry()
+    return _registry
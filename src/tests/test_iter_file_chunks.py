@@ -0,0 +1,58 @@
+import glob
+import os
+import random
+
+import pytest
+
+from edoc.kg_construction.build_tools.utils import iter_file_chunks, get_text_splitter
+
+#Bits of text that hit the separators of the splitters get_text_splitter picks
+TOKENS = ["\nclass ", "\ndef ", "\n\tdef ", "\n\n", "\n", " ", "    ", "foo", "bar_baz", "(", "):", "return",
+          "\n# Title\n", "\n## Part ", "\n---\n", "\n===\n", "```", "<div>", "é", "\t"]
+
+SOURCE_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "edoc", "**", "*.py"), recursive=True))
+
+def _random_text(seed, size):
+    rng = random.Random(seed)
+    return "".join(rng.choice(TOKENS) if rng.random() < 0.5 else rng.choice("abcdefghij") for _ in range(size))
+
+def _assert_matches_split_text(file_path, text, chunk_size, chunk_overlap, block_chunks):
+    text_splitter, _ = get_text_splitter(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    #Files larger than a block, so chunks are cut across the blocks they are read in
+    assert len(text) > chunk_size * block_chunks
+
+    streamed = list(iter_file_chunks(file_path, text_splitter, chunk_size, block_chunks=block_chunks))
+
+    assert [chunk for _, chunk in streamed] == text_splitter.split_text(text)
+    for start_index, chunk in streamed:
+        assert text[start_index:start_index + len(chunk)] == chunk
+
+@pytest.mark.parametrize("extension", [".py", ".md", ".rst", ".html", ".txt"])
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(10, 0), (40, 13), (100, 10), (300, 100)])
+@pytest.mark.parametrize("block_chunks", [1, 4])
+def test_iter_file_chunks_matches_split_text(tmp_path, extension, chunk_size, chunk_overlap, block_chunks):
+    for seed in range(5):
+        file_path = tmp_path / f"file_{seed}{extension}"
+        text = _random_text(seed, 8000)
+        file_path.write_text(text, encoding="utf-8")
+        _assert_matches_split_text(str(file_path), text, chunk_size, chunk_overlap, block_chunks)
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(50, 10), (200, 0), (1000, 100)])
+def test_iter_file_chunks_matches_split_text_on_source_files(chunk_size, chunk_overlap):
+    checked = 0
+    for file_path in SOURCE_FILES:
+        with open(file_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if len(text) <= chunk_size:
+            continue
+        _assert_matches_split_text(file_path, text, chunk_size, chunk_overlap, block_chunks=1)
+        checked += 1
+    assert checked
+
+def test_iter_file_chunks_raises_on_invalid_utf8(tmp_path):
+    file_path = tmp_path / "binary.py"
+    file_path.write_bytes(b"def ok():\n    pass\n" * 100 + b"\xff\xfe")
+    text_splitter, _ = get_text_splitter(str(file_path), chunk_size=50, chunk_overlap=0)
+
+    with pytest.raises(UnicodeDecodeError):
+        list(iter_file_chunks(str(file_path), text_splitter, 50))